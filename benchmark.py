@@ -0,0 +1,475 @@
+"""Benchmark the proxy against local mock providers.
+
+Starts stand-in servers that speak the OpenAI, Anthropic, Mistral and Ollama
+wire formats (including SSE / NDJSON streaming at a configurable token rate
+and latency), launches ollama-prompt.py pointed at them, drives
+/api/v1/chat, /api/v1/embeddings and /api/v1/models at each concurrency
+level, and writes the results as JSON so runs can be compared.
+
+    python benchmark.py --concurrency 1,8,32 --requests 200 --output bench.json
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+PROXY_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ollama-prompt.py')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+class MockSettings:
+    """Shape of the fake upstream responses"""
+
+    def __init__(self, latency=0.05, token_rate=50.0, tokens=64, dimensions=1536):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.tokens = tokens
+        self.dimensions = dimensions
+
+
+class MockProviderHandler(BaseHTTPRequestHandler):
+    """One handler serving the OpenAI, Mistral, Anthropic and Ollama endpoints"""
+
+    protocol_version = 'HTTP/1.1'
+    settings = MockSettings()
+
+    def setup(self):
+        super().setup()
+        # Headers and body go out as separate writes; avoid Nagle/delayed-ACK stalls
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def start_stream(self, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def write_chunk(self, data):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def end_stream(self):
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+    def tokens(self):
+        """Yield token strings, paced at the configured rate"""
+        interval = 1.0 / self.settings.token_rate if self.settings.token_rate else 0
+        for i in range(self.settings.tokens):
+            if interval:
+                time.sleep(interval)
+            yield f"tok{i} "
+
+    def do_GET(self):
+        time.sleep(self.settings.latency)
+        if self.path == '/v1/models':
+            self.send_json({"data": [{"id": "gpt-4o"}, {"id": "gpt-3.5-turbo"}, {"id": "whisper-1"}]})
+        elif self.path == '/api/tags':
+            self.send_json({"models": [{"model": "llama3.1:8b", "name": "llama3.1:8b", "size": 1}]})
+        elif self.path == '/api/ps':
+            self.send_json({"models": [{"model": "llama3.1:8b", "name": "llama3.1:8b", "size": 1, "size_vram": 1}]})
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        body = self.read_json()
+        time.sleep(self.settings.latency)
+        if self.path == '/v1/chat/completions':
+            self.openai_chat(body)
+        elif self.path == '/v1/messages':
+            self.anthropic_chat(body)
+        elif self.path == '/api/chat':
+            self.ollama_chat(body)
+        elif self.path == '/v1/embeddings':
+            inputs = body.get('input')
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            self.send_json({"data": [{"object": "embedding", "index": i, "embedding": self.vector(i)}
+                                     for i in range(len(inputs))]})
+        elif self.path == '/api/embed':
+            inputs = body.get('input')
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            self.send_json({"model": body.get('model'), "embeddings": [self.vector(i) for i in range(len(inputs))]})
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def prompt_tokens(self, body):
+        """Rough prompt size (~4 characters per token) for the mock usage blocks"""
+        text = json.dumps(body.get('messages', [])) + json.dumps(body.get('system', ''))
+        return len(text) // 4
+
+    def vector(self, seed):
+        return [((seed + i) % 97) / 97.0 for i in range(self.settings.dimensions)]
+
+    def openai_chat(self, body):
+        model = body.get('model')
+        if not body.get('stream'):
+            text = "".join(self.tokens())
+            self.send_json({"id": "chatcmpl-mock", "object": "chat.completion", "model": model,
+                            "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                                         "finish_reason": "stop"}],
+                            "usage": {"prompt_tokens": self.prompt_tokens(body),
+                                      "prompt_tokens_details": {"cached_tokens": 0}}})
+            return
+        self.start_stream('text/event-stream')
+        for token in self.tokens():
+            chunk = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "model": model,
+                     "choices": [{"index": 0, "delta": {"content": token}}]}
+            self.write_chunk(b"data: " + json.dumps(chunk).encode('utf-8') + b"\n\n")
+        self.write_chunk(b"data: [DONE]\n\n")
+        self.end_stream()
+
+    def anthropic_chat(self, body):
+        model = body.get('model')
+        if not body.get('stream'):
+            text = "".join(self.tokens())
+            self.send_json({"id": "msg_mock", "type": "message", "role": "assistant", "model": model,
+                            "content": [{"type": "text", "text": text}], "stop_reason": "end_turn",
+                            "usage": self.anthropic_usage(body)})
+            return
+        self.start_stream('text/event-stream')
+
+        def event(name, data):
+            self.write_chunk(f"event: {name}\ndata: {json.dumps(data)}\n\n".encode('utf-8'))
+
+        event("message_start", {"type": "message_start", "message": {"id": "msg_mock", "model": model,
+                                                                     "usage": self.anthropic_usage(body)}})
+        event("content_block_start", {"type": "content_block_start", "index": 0,
+                                      "content_block": {"type": "text", "text": ""}})
+        for token in self.tokens():
+            event("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                          "delta": {"type": "text_delta", "text": token}})
+        event("content_block_stop", {"type": "content_block_stop", "index": 0})
+        event("message_stop", {"type": "message_stop"})
+        self.end_stream()
+
+    def anthropic_usage(self, body):
+        # Pretend everything before a cache breakpoint's final turn was already cached
+        tokens = self.prompt_tokens(body)
+        if 'cache_control' not in json.dumps(body.get('messages', [])):
+            return {"input_tokens": tokens}
+        latest = len(json.dumps(body['messages'][-1])) // 4
+        return {"input_tokens": latest, "cache_read_input_tokens": tokens - latest}
+
+    def ollama_chat(self, body):
+        model = body.get('model')
+        created_at = "2024-01-01T00:00:00Z"
+        if not body.get('stream', True):
+            text = "".join(self.tokens())
+            self.send_json({"model": model, "created_at": created_at,
+                            "message": {"role": "assistant", "content": text}, "done": True,
+                            "prompt_eval_count": self.prompt_tokens(body)})
+            return
+        self.start_stream('application/x-ndjson')
+        for token in self.tokens():
+            chunk = {"model": model, "created_at": created_at,
+                     "message": {"role": "assistant", "content": token}, "done": False}
+            self.write_chunk(json.dumps(chunk).encode('utf-8') + b"\n")
+        done = {"model": model, "created_at": created_at, "message": {"role": "assistant", "content": ""},
+                "done": True, "prompt_eval_count": self.prompt_tokens(body)}
+        self.write_chunk(json.dumps(done).encode('utf-8') + b"\n")
+        self.end_stream()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive connections at shutdown are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def start_mock_server(settings):
+    handler = type('Handler', (MockProviderHandler,), {'settings': settings})
+    server = MockServer(('127.0.0.1', free_port()), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_proxy(mock_url, server_mode, extra_env=None):
+    """Launch the proxy as a subprocess pointed at the mock providers"""
+    port = free_port()
+    env = {
+        **os.environ,
+        'HOST': '127.0.0.1',
+        'PORT': str(port),
+        'SERVER_MODE': server_mode,
+        'OPENAI_API_KEY': 'mock',
+        'ANTHROPIC_API_KEY': 'mock',
+        'MISTRAL_API_KEY': 'mock',
+        'OPENAI_BASE_URL': mock_url,
+        'ANTHROPIC_BASE_URL': mock_url,
+        'MISTRAL_BASE_URL': mock_url,
+        'OLLAMA_HOST': mock_url,
+        **(extra_env or {})
+    }
+    process = subprocess.Popen([sys.executable, PROXY_SCRIPT], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Proxy exited with status {process.returncode}")
+        try:
+            if requests.get(f"{base_url}/health", timeout=1).status_code == 200:
+                return process, base_url
+        except requests.RequestException:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Proxy did not become healthy within 30 seconds")
+
+
+def process_tree(pid):
+    """pid and its descendants, i.e. the supervisor and its workers when WORKERS > 1"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                parent = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, ()))
+    return tree
+
+
+def process_usage(pid):
+    """CPU seconds (user + system) and resident memory in bytes of a process and its children, from /proc"""
+    cpu, rss = None, None
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/stat") as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            member_cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+            with open(f"/proc/{member}/status") as f:
+                member_rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:'))
+        except (OSError, StopIteration, IndexError, ValueError):
+            # A child may exit between the listing and the read
+            continue
+        cpu = (cpu or 0) + member_cpu
+        rss = (rss or 0) + member_rss
+    return cpu, rss
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def chat_body(provider, model, stream, i):
+    # Unique content per request so coalescing and caching do not skew results
+    return {"provider": provider, "model": model, "system": "You are a benchmark.", "stream": stream,
+            "messages": [{"role": "user", "content": f"benchmark request {i}"}]}
+
+
+def run_request(session, base_url, scenario, i, run_tag=""):
+    """Issue one request; returns (latency, ttft, ok)"""
+    kind = scenario['kind']
+    start = time.perf_counter()
+    ttft = None
+    try:
+        if kind == 'models':
+            response = session.get(f"{base_url}/api/v1/models", timeout=120)
+            ok = response.status_code == 200
+        elif kind == 'embeddings':
+            # The tag keeps texts unique across runs, or later runs would be served from the embedding cache
+            texts = [f"benchmark chunk {run_tag}-{i}-{j}" for j in range(scenario['batch'])]
+            response = session.post(f"{base_url}/api/v1/embeddings", timeout=120,
+                                    json={"provider": scenario['provider'], "text": texts})
+            ok = response.status_code == 200
+        elif scenario['stream']:
+            response = session.post(f"{base_url}/api/v1/chat", timeout=120, stream=True,
+                                    json=chat_body(scenario['provider'], scenario['model'], True, i))
+            ok = response.status_code == 200
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                if line.startswith(b'data: {"error"'):
+                    ok = False
+        else:
+            response = session.post(f"{base_url}/api/v1/chat", timeout=120,
+                                    json=chat_body(scenario['provider'], scenario['model'], False, i))
+            ok = response.status_code == 200
+    except requests.RequestException:
+        ok = False
+    return time.perf_counter() - start, ttft, ok
+
+
+def run_scenario(base_url, pid, scenario, concurrency, total):
+    latencies, ttfts, failures = [], [], [0]
+    lock = threading.Lock()
+    counter = iter(range(total))
+    run_tag = f"{concurrency}-{os.urandom(4).hex()}"
+
+    def worker():
+        session = requests.Session()
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            latency, ttft, ok = run_request(session, base_url, scenario, i, run_tag)
+            with lock:
+                latencies.append(latency)
+                if ttft is not None:
+                    ttfts.append(ttft)
+                if not ok:
+                    failures[0] += 1
+
+    cpu_before, rss_before = process_usage(pid)
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    cpu_after, rss_after = process_usage(pid)
+
+    result = {
+        **scenario,
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": failures[0],
+        "duration_s": elapsed,
+        "throughput_rps": total / elapsed if elapsed else None,
+        "latency_p50_s": percentile(latencies, 0.5),
+        "latency_p99_s": percentile(latencies, 0.99),
+        "latency_mean_s": statistics.fmean(latencies) if latencies else None,
+        "ttft_p50_s": percentile(ttfts, 0.5),
+        "ttft_p99_s": percentile(ttfts, 0.99),
+        "proxy_cpu_ms_per_request": None,
+        "proxy_rss_bytes": rss_after,
+        "proxy_rss_growth_bytes": None
+    }
+    if cpu_before is not None and cpu_after is not None:
+        result["proxy_cpu_ms_per_request"] = (cpu_after - cpu_before) * 1000 / total
+        result["proxy_rss_growth_bytes"] = rss_after - rss_before
+    return result
+
+
+DEFAULT_MODELS = {"openai": "gpt-4o", "anthropic": "claude-3-haiku-20240307",
+                  "mistral": "mistral-small", "ollama": "llama3.1:8b"}
+
+
+def build_scenarios(providers, embedding_batch):
+    scenarios = []
+    for provider in providers:
+        for stream in (False, True):
+            scenarios.append({"name": f"chat-{provider}-{'stream' if stream else 'sync'}", "kind": "chat",
+                              "provider": provider, "model": DEFAULT_MODELS[provider], "stream": stream})
+    for provider in ('openai', 'ollama'):
+        if provider in providers:
+            scenarios.append({"name": f"embeddings-{provider}", "kind": "embeddings", "provider": provider,
+                              "batch": embedding_batch})
+    scenarios.append({"name": "models", "kind": "models"})
+    return scenarios
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the proxy against local mock providers")
+    parser.add_argument('--concurrency', default='1,8,32', help="Comma-separated concurrency levels")
+    parser.add_argument('--requests', type=int, default=200, help="Requests per scenario and concurrency level")
+    parser.add_argument('--providers', default='openai,anthropic,mistral,ollama')
+    parser.add_argument('--scenarios', default=None, help="Comma-separated scenario names to run (default: all)")
+    parser.add_argument('--latency', type=float, default=0.05, help="Mock upstream latency before responding (s)")
+    parser.add_argument('--token-rate', type=float, default=200.0, help="Mock streamed tokens per second (0: unpaced)")
+    parser.add_argument('--tokens', type=int, default=64, help="Tokens per mock completion")
+    parser.add_argument('--dimensions', type=int, default=1536, help="Mock embedding dimensions")
+    parser.add_argument('--embedding-batch', type=int, default=16, help="Texts per embeddings request")
+    parser.add_argument('--server-mode', default='wsgi', choices=('wsgi', 'asgi'))
+    parser.add_argument('--proxy-url', default=None,
+                        help="Benchmark an already running proxy instead of launching one")
+    parser.add_argument('--output', default=None, help="Write JSON results here (default: stdout)")
+    args = parser.parse_args(argv)
+
+    settings = MockSettings(args.latency, args.token_rate, args.tokens, args.dimensions)
+    mock = start_mock_server(settings)
+    mock_url = f"http://127.0.0.1:{mock.server_address[1]}"
+
+    process = None
+    if args.proxy_url:
+        base_url, pid = args.proxy_url.rstrip('/'), None
+    else:
+        process, base_url = start_proxy(mock_url, args.server_mode)
+        pid = process.pid
+
+    providers = [p.strip() for p in args.providers.split(',') if p.strip()]
+    scenarios = build_scenarios(providers, args.embedding_batch)
+    if args.scenarios:
+        wanted = set(args.scenarios.split(','))
+        scenarios = [s for s in scenarios if s['name'] in wanted]
+
+    results = []
+    try:
+        for scenario in scenarios:
+            for concurrency in (int(c) for c in args.concurrency.split(',')):
+                result = run_scenario(base_url, pid, scenario, concurrency, args.requests)
+                results.append(result)
+                print(f"{result['name']:<28} c={concurrency:<4} {result['throughput_rps']:8.1f} req/s  "
+                      f"p50={result['latency_p50_s'] * 1000:7.1f}ms  p99={result['latency_p99_s'] * 1000:7.1f}ms  "
+                      f"errors={result['errors']}", file=sys.stderr)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+        mock.shutdown()
+
+    report = {
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        "config": {"server_mode": args.server_mode, "latency_s": args.latency, "token_rate": args.token_rate,
+                   "tokens": args.tokens, "dimensions": args.dimensions, "embedding_batch": args.embedding_batch,
+                   "requests": args.requests, "python": sys.version.split()[0]},
+        "results": results
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,12 @@
 import warnings
 
 warnings.filterwarnings("ignore")
-from contextlib import suppress
+from contextlib import suppress, contextmanager, asynccontextmanager
 from typing import Type
 
 with suppress(BaseException):
-    from flask import Flask, request, jsonify, Response
+    from flask import Flask, request, jsonify, Response, send_file, g
+    from flask.json.provider import DefaultJSONProvider
 import logging
 import os
 from dotenv import load_dotenv
@@ -13,580 +14,5912 @@ from pydantic import BaseModel, Field, ValidationError
 from typing import List, Dict, Optional
 import requests
 import json
-from logging.handlers import RotatingFileHandler
+import threading
+import asyncio
+import socket
+import sqlite3
+import hashlib
+import time
+import bisect
+import heapq
+import math
+import re
+import sys
+import uuid
+import contextvars
+import argparse
+import atexit
+import queue
+import random
+import signal
+import struct
+import mmap
+import zlib
+import shutil
+import gzip
+import base64
+import numpy as np
+from collections import OrderedDict, deque
+from array import array
+from abc import ABC, abstractmethod
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import ollama
+import httpx
+import httpcore
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from werkzeug.serving import make_server
+
+# Optional dependencies for the async (ASGI) serving mode
+Starlette = None
+uvicorn = None
+with suppress(ImportError):
+    from starlette.applications import Starlette
+    from starlette.responses import JSONResponse as StarletteJSONResponse, StreamingResponse
+    from starlette.routing import Route, Mount
+    from starlette.middleware import Middleware
+    from starlette.middleware.gzip import GZipMiddleware
+    from starlette.background import BackgroundTask, BackgroundTasks
+    try:
+        from a2wsgi import WSGIMiddleware
+    except ImportError:
+        from starlette.middleware.wsgi import WSGIMiddleware
+with suppress(ImportError):
+    import uvicorn
+
+if Starlette is not None:
+    class JSONResponse(StarletteJSONResponse):
+        """Starlette JSON response encoded with the configured codec (see json_dumps)"""
+
+        def render(self, content):
+            return json_dumps(content)
+
+# JSON codec: orjson when installed (JSON_CODEC=auto), else the standard library.
+# json_dumps returns compact UTF-8 bytes; json_loads takes bytes or str.
+JSON_CODEC = os.getenv('JSON_CODEC', 'auto').lower()
+orjson = None
+if JSON_CODEC != 'stdlib':
+    with suppress(ImportError):
+        import orjson
+
+def json_default(value):
+    """Encode NumPy arrays and scalars (embeddings) for codecs without native support, and raw bytes"""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, bytes):
+        # e.g. the unparsable body echoed in a validation error
+        return value.decode('utf-8', 'replace')
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+if orjson is not None:
+    ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def json_dumps(value, default=json_default, sort_keys=False):
+        return orjson.dumps(value, default=default,
+                            option=ORJSON_OPTIONS | orjson.OPT_SORT_KEYS if sort_keys else ORJSON_OPTIONS)
+
+    json_loads = orjson.loads
+else:
+    def json_dumps(value, default=json_default, sort_keys=False):
+        return json.dumps(value, default=default, sort_keys=sort_keys, separators=(',', ':'),
+                          ensure_ascii=False).encode('utf-8')
+
+    json_loads = json.loads
+
+# Cross-process file locks for multi-worker mode (Unix only)
+fcntl = None
+with suppress(ImportError):
+    import fcntl
 
 load_dotenv()
 OLLAMA_API_KEY = os.getenv('OLLAMA_API_KEY')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 ANTHROPIC_API_KEY = os.getenv('ANTHROPIC_API_KEY')
 MISTRAL_API_KEY = os.getenv('MISTRAL_API_KEY')
+OLLAMA_HOST = os.getenv('OLLAMA_HOST')
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com').rstrip('/')
+ANTHROPIC_BASE_URL = os.getenv('ANTHROPIC_BASE_URL', 'https://api.anthropic.com').rstrip('/')
+MISTRAL_BASE_URL = os.getenv('MISTRAL_BASE_URL', 'https://api.mistral.ai').rstrip('/')
+
+# Upstream connection pool settings
+POOL_CONNECTIONS = int(os.getenv('POOL_CONNECTIONS', 10))
+POOL_MAXSIZE = int(os.getenv('POOL_MAXSIZE', 32))
+POOL_KEEPALIVE = int(os.getenv('POOL_KEEPALIVE', 60))
+CONNECT_TIMEOUT = float(os.getenv('CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.getenv('READ_TIMEOUT', 120))
+
+# Multi-process serving: WORKERS processes accept on one listening socket and
+# keep conversations, caches and limiter state in files under STATE_DIR.
+WORKERS = os.getenv('WORKERS', '1')
+WORKERS = (os.cpu_count() or 1) if WORKERS.lower() == 'auto' else max(1, int(WORKERS))
+STATE_DIR = os.getenv('STATE_DIR', '.')
+worker_index = 0  # Set in each forked worker
+if WORKERS > 1:
+    os.makedirs(STATE_DIR, exist_ok=True)
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider (request.json, jsonify) backed by json_dumps/json_loads"""
+
+    def dumps(self, obj, **kwargs):
+        return json_dumps(obj, sort_keys=self.sort_keys).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return json_loads(s)
+
+    def response(self, *args, **kwargs):
+        # Encode straight to bytes instead of going through a str
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(json_dumps(obj, sort_keys=self.sort_keys) + b"\n", mimetype=self.mimetype)
+
+app = Flask(__name__)
+app.json = FastJSONProvider(app)
+
+# Logging: the request path only queues records; a listener thread formats
+# them (JSON lines by default) and writes them to stderr and a rotating file.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+LOG_FILE = os.getenv('LOG_FILE', 'app.log')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 5))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+LOG_CHUNK_SAMPLE_RATE = float(os.getenv('LOG_CHUNK_SAMPLE_RATE', 0))
+
+request_id = contextvars.ContextVar('request_id', default=None)
+request_trace = contextvars.ContextVar('request_trace', default=None)
+
+# Attributes every LogRecord has; anything else came in through ``extra``
+LOG_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+    'message', 'asctime', 'request_id', 'worker', 'trace_id', 'color_message'}
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record, with the request ID, worker and any ``extra`` fields"""
+
+    def format(self, record):
+        entry = {
+            "time": time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        if record.request_id:
+            entry["request_id"] = record.request_id
+        if record.trace_id:
+            entry["trace_id"] = record.trace_id
+        if WORKERS > 1:
+            entry["worker"] = record.worker
+        for key, value in vars(record).items():
+            if key not in LOG_RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json_dumps(entry, default=str).decode('utf-8')
+
+class ContextFilter(logging.Filter):
+    """Stamp records with the request and trace IDs and worker while still on the request's thread"""
+
+    def filter(self, record):
+        record.request_id = request_id.get()
+        record.worker = worker_index
+        trace = request_trace.get()
+        record.trace_id = trace.trace_id if trace is not None else None
+        return True
+
+class SamplingFilter(logging.Filter):
+    """Pass a random fraction of records, for high-volume events such as stream chunks"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return random.random() < self.rate
+
+class LogQueueHandler(QueueHandler):
+    """Queue records for the listener; drop them rather than block when it falls behind"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Same process, no pickling: leave all formatting to the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+log_handler = LogQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+log_handler.addFilter(ContextFilter())
+log_listener = None
+
+def start_logging(path=LOG_FILE):
+    """Start the listener thread that writes queued records (once per process)"""
+    global log_listener
+    if LOG_FORMAT == 'json':
+        formatter = JSONFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s')
+    handlers = [logging.StreamHandler()]
+    if path:
+        handlers.append(RotatingFileHandler(path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    log_listener = QueueListener(log_handler.queue, *handlers, respect_handler_level=True)
+    log_listener.start()
+
+def stop_logging():
+    """Flush the queue and stop the listener"""
+    if log_listener is not None:
+        log_listener.stop()
+
+# A forked worker gets a fresh queue: the inherited one may be locked by the parent's listener
+os.register_at_fork(after_in_child=lambda: setattr(log_handler, 'queue', queue.Queue(LOG_QUEUE_SIZE)))
+atexit.register(stop_logging)
+
+logging.root.setLevel(LOG_LEVEL)
+logging.root.handlers = [log_handler]
+start_logging()
+logger = logging.getLogger(__name__)
+access_logger = logging.getLogger(f"{__name__}.access")
+# Per-chunk stream events are logged at DEBUG and sampled
+chunk_logger = logging.getLogger(f"{__name__}.chunks")
+chunk_logger.setLevel(logging.DEBUG if LOG_CHUNK_SAMPLE_RATE > 0 else logging.INFO)
+chunk_logger.addFilter(SamplingFilter(LOG_CHUNK_SAMPLE_RATE))
+# httpx logs every upstream call at INFO
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+# Request tracing: each request records its phases as spans, reported in the
+# Server-Timing header and the access log, and optionally exported as OTLP/HTTP JSON.
+TRACING = os.getenv('TRACING', 'true').lower() in ('1', 'true', 'yes', 'on')
+TRACE_EXPORT_URL = os.getenv('TRACE_EXPORT_URL', '')
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 1.0))
+TRACE_EXPORT_QUEUE = int(os.getenv('TRACE_EXPORT_QUEUE', 2048))
+TRACE_EXPORT_BATCH = int(os.getenv('TRACE_EXPORT_BATCH', 512))
+TRACE_SERVICE_NAME = os.getenv('TRACE_SERVICE_NAME', 'ollama-prompt')
+
+# Span new spans nest under; only set around blocks that do not yield
+active_span = contextvars.ContextVar('active_span', default=None)
+
+def parse_traceparent(value):
+    """(trace ID, parent span ID, sampled) from a W3C traceparent header; a new trace ID without one"""
+    match = re.fullmatch(r'[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})', (value or '').strip())
+    if match is None or not int(match[1], 16) or not int(match[2], 16):
+        return os.urandom(16).hex(), None, None
+    return match[1], match[2], bool(int(match[3], 16) & 1)
+
+class Trace:
+    """Timed phases of one request.
+
+    Spans are (name, span ID, parent ID, start, end, attributes) with
+    perf_counter_ns times. Threads working for the request share the trace
+    through their copied context.
+    """
+
+    def __init__(self, name, traceparent=None):
+        self.name = name
+        self.trace_id, self.parent_id, sampled = parse_traceparent(traceparent)
+        self.sampled = sampled if sampled is not None else random.random() < TRACE_SAMPLE_RATE
+        self.span_id = os.urandom(8).hex()
+        self.wall_start = time.time_ns()
+        self.start = time.perf_counter_ns()
+        self.attributes = {}
+        self.spans = []
+        self.finished = False
+        self.lock = threading.Lock()
+
+    def add(self, name, start, end=None, parent_id=None, **attributes):
+        """Record a finished span; returns its ID"""
+        span_id = os.urandom(8).hex()
+        with self.lock:
+            self.spans.append((name, span_id, parent_id or self.span_id, start,
+                               time.perf_counter_ns() if end is None else end, attributes))
+        return span_id
+
+    def phases(self):
+        """Milliseconds per phase, summed over repeats, in first-seen order"""
+        totals = {}
+        with self.lock:
+            for name, _, _, start, end, _ in self.spans:
+                totals[name] = totals.get(name, 0) + end - start
+        return {name: round(total / 1e6, 2) for name, total in totals.items()}
+
+    def server_timing(self):
+        elapsed = (time.perf_counter_ns() - self.start) / 1e6
+        return ", ".join([f"{name};dur={duration}" for name, duration in self.phases().items()] +
+                         [f"total;dur={elapsed:.2f}"])
+
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def finish(self, status=None):
+        """End the request; queue its spans for export if sampled (first call only)"""
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+        if status is not None:
+            self.attributes["http.status_code"] = status
+        if span_exporter is not None and self.sampled:
+            span_exporter.submit(self.otlp_spans(time.perf_counter_ns(), status))
+
+    def otlp_spans(self, end, status=None):
+        def wall(ns):
+            return str(self.wall_start + ns - self.start)
+
+        root = {"traceId": self.trace_id, "spanId": self.span_id, "name": self.name, "kind": 2,
+                "startTimeUnixNano": wall(self.start), "endTimeUnixNano": wall(end),
+                "attributes": otlp_attributes(self.attributes)}
+        if self.parent_id:
+            root["parentSpanId"] = self.parent_id
+        if status is not None and status >= 500:
+            root["status"] = {"code": 2}
+        with self.lock:
+            spans = list(self.spans)
+        return [root] + [{"traceId": self.trace_id, "spanId": span_id, "parentSpanId": parent_id, "name": name,
+                          "kind": 1, "startTimeUnixNano": wall(start), "endTimeUnixNano": wall(span_end),
+                          "attributes": otlp_attributes(attributes)}
+                         for name, span_id, parent_id, start, span_end, attributes in spans]
+
+def otlp_attributes(attributes):
+    values = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            values.append({"key": key, "value": {"boolValue": value}})
+        elif isinstance(value, int):
+            values.append({"key": key, "value": {"intValue": str(value)}})
+        elif isinstance(value, float):
+            values.append({"key": key, "value": {"doubleValue": value}})
+        else:
+            values.append({"key": key, "value": {"stringValue": str(value)}})
+    return values
+
+@contextmanager
+def span(name, **attributes):
+    """Time a block as a phase of the current request (a no-op outside one); the block must not yield"""
+    trace = request_trace.get()
+    if trace is None:
+        yield
+        return
+    span_id = os.urandom(8).hex()
+    parent_id = active_span.get()
+    token = active_span.set(span_id)
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        active_span.reset(token)
+        end = time.perf_counter_ns()
+        with trace.lock:
+            trace.spans.append((name, span_id, parent_id or trace.span_id, start, end, attributes))
+
+def annotate(**attributes):
+    """Attach attributes to the current request's trace"""
+    trace = request_trace.get()
+    if trace is not None:
+        trace.attributes.update(attributes)
+
+def record_span(name, start, **attributes):
+    """Record a phase that began at start (perf_counter_ns) and ends now"""
+    trace = request_trace.get()
+    if trace is not None:
+        trace.add(name, start, parent_id=active_span.get(), **attributes)
+
+def httpx_trace(asynchronous=False):
+    """httpx request extensions that record new upstream connections as 'connect' spans"""
+    trace = request_trace.get()
+    if trace is None:
+        return {}
+    parent_id = active_span.get()
+    started = {}
+
+    def on_event(name, info):
+        if name in ("connection.connect_tcp.started", "connection.start_tls.started"):
+            started.setdefault("connect", time.perf_counter_ns())
+        elif name in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+            started["end"] = time.perf_counter_ns()
+        elif name.startswith(("http11.send_request_headers.started", "http2.send_request_headers.started")):
+            if "connect" in started:
+                trace.add("connect", started.pop("connect"), started.pop("end", None), parent_id)
+
+    async def on_event_async(name, info):
+        on_event(name, info)
+
+    return {"trace": on_event_async if asynchronous else on_event}
+
+class SpanExporter:
+    """Posts finished spans to an OTLP/HTTP (JSON) collector in batches from a background thread.
+
+    Spans are dropped rather than queued without bound when the collector is slow or down.
+    """
+
+    def __init__(self, url, queue_size=2048, batch_size=512):
+        self.url = url
+        self.batch_size = batch_size
+        self.queue = queue.Queue(queue_size)
+        self.session = requests.Session()
+        self.exported = 0
+        self.dropped = 0
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def submit(self, spans):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    # Forked workers start their own thread (and queue)
+                    self.queue = queue.Queue(self.queue.maxsize)
+                    threading.Thread(target=self._run, name='span-exporter', daemon=True).start()
+                    self.pid = os.getpid()
+        try:
+            self.queue.put_nowait(spans)
+        except queue.Full:
+            self.dropped += len(spans)
+
+    def _run(self):
+        pending = self.queue
+        while True:
+            spans = list(pending.get())
+            # Linger briefly so bursts go out as one request
+            deadline = time.monotonic() + 1
+            while len(spans) < self.batch_size:
+                try:
+                    spans.extend(pending.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            body = {"resourceSpans": [{
+                "resource": {"attributes": otlp_attributes({"service.name": TRACE_SERVICE_NAME,
+                                                            "service.instance.id": f"{socket.gethostname()}/{os.getpid()}"})},
+                "scopeSpans": [{"scope": {"name": TRACE_SERVICE_NAME}, "spans": spans}]}]}
+            try:
+                response = self.session.post(self.url, data=json_dumps(body), timeout=10,
+                                             headers={"Content-Type": "application/json"})
+                response.raise_for_status()
+                self.exported += len(spans)
+            except Exception as e:
+                self.dropped += len(spans)
+                logger.warning("Span export failed: %s", e)
+
+span_exporter = SpanExporter(TRACE_EXPORT_URL, TRACE_EXPORT_QUEUE, TRACE_EXPORT_BATCH) if TRACE_EXPORT_URL else None
+
+@app.errorhandler(404)
+def not_found_error(error):
+    return jsonify({"error": "Resource not found"}), 404
+
+@app.errorhandler(500)
+def internal_error(error):
+    return jsonify({"error": "Internal server error"}), 500
+
+# A hedged attempt runs under a cancel scope. When another attempt wins, the
+# scope frees the loser's admission and shuts down the sockets of the pooled
+# connections it is using, so a blocking call returns instead of running on.
+class CancelScope:
+    """Cleanups to run if a hedged attempt loses the race, keyed by what they clean up"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.cleanups = {}
+
+    def watch(self, key, cleanup):
+        with self.lock:
+            if not self.cancelled:
+                self.cleanups[key] = cleanup
+                return
+        cleanup()
+
+    def unwatch(self, key):
+        with self.lock:
+            self.cleanups.pop(key, None)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            cleanups, self.cleanups = self.cleanups, {}
+        for cleanup in cleanups.values():
+            try:
+                cleanup()
+            except Exception as e:
+                logger.warning("Cancelling hedged attempt: %s", e)
+
+cancel_scope = contextvars.ContextVar('cancel_scope', default=None)
+
+def attempt_cancelled():
+    scope = cancel_scope.get()
+    return scope is not None and scope.cancelled
+
+def release_on_cancel(admission):
+    scope = cancel_scope.get()
+    if scope is not None:
+        scope.watch(admission, admission.release)
+
+def shutdown_socket(sock):
+    """Make a blocked send or read on a socket fail at once; the pool then discards its connection"""
+    if sock is not None:
+        with suppress(OSError):
+            sock.shutdown(socket.SHUT_RDWR)
+
+def shutdown_connection(conn):
+    shutdown_socket(getattr(conn, 'sock', None))
+
+class TracedHTTPConnection(HTTPConnection):
+    def connect(self):
+        with span("connect", host=self.host):
+            super().connect()
+        if getattr(self, 'cancel_scope', None) is not None and self.cancel_scope.cancelled:
+            shutdown_connection(self)
+
+class TracedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        with span("connect", host=self.host):
+            super().connect()
+        if getattr(self, 'cancel_scope', None) is not None and self.cancel_scope.cancelled:
+            shutdown_connection(self)
+
+class CancellablePool:
+    """Pool mixin: connections checked out under a cancel scope are shut down if it is cancelled"""
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        scope = cancel_scope.get()
+        if scope is not None:
+            conn.cancel_scope = scope
+            scope.watch(conn, lambda: shutdown_connection(conn))
+        return conn
+
+    def _put_conn(self, conn):
+        # Back in the pool the connection may serve another request, so it leaves the scope
+        scope = getattr(conn, 'cancel_scope', None)
+        if scope is not None:
+            conn.cancel_scope = None
+            scope.unwatch(conn)
+        super()._put_conn(conn)
+
+class TracedHTTPConnectionPool(CancellablePool, HTTPConnectionPool):
+    ConnectionCls = TracedHTTPConnection
+
+class TracedHTTPSConnectionPool(CancellablePool, HTTPSConnectionPool):
+    ConnectionCls = TracedHTTPSConnection
+
+class CancellableNetworkStream(httpcore.NetworkStream):
+    """httpcore stream whose blocking reads and writes abort when the current cancel scope is cancelled"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def shutdown(self):
+        shutdown_socket(self.stream.get_extra_info('socket'))
+
+    def call(self, fn, *args):
+        # httpx has no checkout hook, so the socket is in the scope only while blocked on it
+        scope = cancel_scope.get()
+        if scope is None:
+            return fn(*args)
+        scope.watch(self, self.shutdown)
+        try:
+            return fn(*args)
+        finally:
+            scope.unwatch(self)
+
+    def read(self, max_bytes, timeout=None):
+        return self.call(self.stream.read, max_bytes, timeout)
+
+    def write(self, buffer, timeout=None):
+        self.call(self.stream.write, buffer, timeout)
+
+    def close(self):
+        self.stream.close()
+
+    def start_tls(self, ssl_context, server_hostname=None, timeout=None):
+        return CancellableNetworkStream(self.stream.start_tls(ssl_context, server_hostname, timeout))
+
+    def get_extra_info(self, info):
+        return self.stream.get_extra_info(info)
+
+class CancellableBackend(httpcore.NetworkBackend):
+    def __init__(self):
+        self.backend = httpcore.SyncBackend()
+
+    def connect_tcp(self, *args, **kwargs):
+        return CancellableNetworkStream(self.backend.connect_tcp(*args, **kwargs))
+
+    def connect_unix_socket(self, *args, **kwargs):
+        return CancellableNetworkStream(self.backend.connect_unix_socket(*args, **kwargs))
+
+    def sleep(self, seconds):
+        self.backend.sleep(seconds)
+
+class KeepAliveAdapter(HTTPAdapter):
+    """HTTPAdapter that enables TCP keep-alive on pooled connections and traces new connections"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        # Keep urllib3's defaults (TCP_NODELAY) and add keep-alive probing
+        socket_options = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            socket_options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, POOL_KEEPALIVE))
+        kwargs['socket_options'] = socket_options
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": TracedHTTPConnectionPool,
+                                                   "https": TracedHTTPSConnectionPool}
+
+# One session per upstream provider, created lazily and shared across threads
+provider_sessions = {}
+provider_sessions_lock = threading.Lock()
+
+def get_session(provider):
+    """Return the shared keep-alive session for a provider"""
+    session = provider_sessions.get(provider)
+    if session is None:
+        with provider_sessions_lock:
+            session = provider_sessions.get(provider)
+            if session is None:
+                session = requests.Session()
+                adapter = KeepAliveAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                provider_sessions[provider] = session
+    return session
+
+class FileLock:
+    """Exclusive lock shared by threads and by worker processes on the host.
+
+    flock() is held per open file, so each process opens its own descriptor
+    (an inherited one would be shared with the parent) and threads take a
+    process-local lock first.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pid = None
+        self.fd = None
+
+    def acquire(self, blocking=True):
+        """Take the lock; without blocking, return False at once if anyone else holds it"""
+        if not self.lock.acquire(blocking):
+            return False
+        if self.pid != os.getpid():
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self.pid = os.getpid()
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock.release()
+            return False
+        return True
+
+    def release(self):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.lock.release()
+
+    def close(self):
+        """Close this process's descriptor, dropping the lock if held"""
+        if self.fd is not None and self.pid == os.getpid():
+            os.close(self.fd)
+        self.fd = self.pid = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+# Per-request deadline (monotonic time), set from X-Request-Timeout or the
+# chat "timeout" field; threads that work for a request copy the context.
+request_deadline = contextvars.ContextVar('request_deadline', default=None)
+
+class DeadlineExceeded(Exception):
+    """The request's deadline passed before the upstream answered"""
+
+class UpstreamError(Exception):
+    """Error returned by an upstream provider, carrying its HTTP status"""
+
+    def __init__(self, message, status_code=502):
+        super().__init__(message)
+        self.status_code = status_code
+
+def remaining_time():
+    deadline = request_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+def deadline_expired():
+    remaining = remaining_time()
+    return remaining is not None and remaining <= 0
+
+def check_deadline(deadline):
+    if deadline is not None and time.monotonic() >= deadline:
+        raise DeadlineExceeded("Request deadline exceeded")
+
+def upstream_timeout():
+    """Connect/read timeout tuple applied to every upstream call, clipped to the request deadline"""
+    remaining = remaining_time()
+    if remaining is None:
+        return (CONNECT_TIMEOUT, READ_TIMEOUT)
+    if remaining <= 0:
+        raise DeadlineExceeded("Request deadline exceeded")
+    return (min(CONNECT_TIMEOUT, remaining), min(READ_TIMEOUT, remaining))
+
+def httpx_timeout():
+    connect, read = upstream_timeout()
+    return httpx.Timeout(read, connect=connect)
+
+class DeadlineWatchdog:
+    """One thread that cancels the scopes of upstream calls whose request deadline has passed"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.heap = []
+        self.sequence = 0
+        self.thread = None
+
+    def arm(self, deadline, scope):
+        with self.condition:
+            # Started lazily so that each forked worker runs its own
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="deadline-watchdog", daemon=True)
+                self.thread.start()
+            self.sequence += 1
+            entry = [deadline, self.sequence, scope]
+            heapq.heappush(self.heap, entry)
+            if self.heap[0] is entry:
+                self.condition.notify()
+        return entry
+
+    def disarm(self, entry):
+        # Left in the heap and skipped when it comes up
+        with self.condition:
+            entry[2] = None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.heap and self.heap[0][2] is None:
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                delay = self.heap[0][0] - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                scope = heapq.heappop(self.heap)[2]
+            scope.cancel()
+
+deadline_watchdog = DeadlineWatchdog()
+
+@contextmanager
+def deadline_scope():
+    """Cancel scope for an upstream call that the watchdog cancels when the request deadline passes.
+
+    Connect and read timeouts only bound each wait, so an upstream that keeps
+    trickling bytes would otherwise hold the call past the deadline.
+    """
+    scope = cancel_scope.get() or CancelScope()
+    deadline = request_deadline.get()
+    if deadline is None:
+        yield scope
+        return
+    entry = deadline_watchdog.arm(deadline, scope)
+    try:
+        yield scope
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        if time.monotonic() >= deadline:
+            raise DeadlineExceeded("Request deadline exceeded") from e
+        raise
+    finally:
+        deadline_watchdog.disarm(entry)
+
+def call_in_scope(scope, fn, *args):
+    token = cancel_scope.set(scope)
+    try:
+        return fn(*args)
+    finally:
+        cancel_scope.reset(token)
+
+def parse_timeout(value):
+    """Absolute deadline for a timeout given in seconds, or None"""
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        return None
+    return time.monotonic() + seconds if seconds > 0 else None
+
+def apply_timeout(seconds):
+    """Tighten the request deadline with a per-request timeout; returns the deadline in force"""
+    deadline = request_deadline.get()
+    if seconds is not None:
+        deadline = min(filter(None, (deadline, parse_timeout(seconds))))
+        request_deadline.set(deadline)
+    return deadline
+
+@app.before_request
+def set_request_deadline():
+    request_deadline.set(parse_timeout(request.headers.get('X-Request-Timeout')))
+
+def ollama_limits():
+    return httpx.Limits(
+        max_connections=POOL_MAXSIZE,
+        max_keepalive_connections=POOL_MAXSIZE,
+        keepalive_expiry=POOL_KEEPALIVE
+    )
+
+# Ollama fleet: requests go to the least busy healthy host, preferring hosts
+# that already have the model resident so they don't pay for a model load.
+OLLAMA_HOSTS = [host.strip() for host in os.getenv('OLLAMA_HOSTS', OLLAMA_HOST or '').split(',') if host.strip()] or [None]
+OLLAMA_PROBE_INTERVAL = float(os.getenv('OLLAMA_PROBE_INTERVAL', 15))
+OLLAMA_EJECT_FAILURES = int(os.getenv('OLLAMA_EJECT_FAILURES', 3))
+OLLAMA_EJECT_SECONDS = float(os.getenv('OLLAMA_EJECT_SECONDS', 30))
+OLLAMA_AFFINITY_SLACK = int(os.getenv('OLLAMA_AFFINITY_SLACK', 2))
+OLLAMA_AFFINITY_SIZE = int(os.getenv('OLLAMA_AFFINITY_SIZE', 10000))
+
+def ollama_model_name(model):
+    """Ollama treats a bare model name as its ':latest' tag"""
+    return model if ':' in model else f"{model}:latest"
+
+def ollama_failure(exc):
+    """Whether an error says the host is unhealthy rather than the request being bad"""
+    if deadline_expired():
+        # Timeouts caused by the client's own deadline say nothing about the host
+        return False
+    if isinstance(exc, ollama.ResponseError):
+        return exc.status_code >= 500
+    return isinstance(exc, (httpx.TransportError, ConnectionError, TimeoutError))
+
+class OllamaHost:
+    """One Ollama endpoint with its clients, load and probed model state"""
+
+    def __init__(self, host):
+        self.host = host
+        self.client = ollama.Client(host=host, timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+                                    limits=ollama_limits())
+        self.name = str(self.client._client.base_url).rstrip('/')
+        # Chat calls go straight to the HTTP API so each one can carry its own timeout
+        self.headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
+        if OLLAMA_API_KEY:
+            self.headers['Authorization'] = f'Bearer {OLLAMA_API_KEY}'
+        transport = httpx.HTTPTransport(limits=ollama_limits())
+        # Lets a cancel scope (hedge loser, passed deadline) abort a blocked read
+        transport._pool._network_backend = CancellableBackend()
+        self.http = httpx.Client(base_url=self.name, headers=self.headers, transport=transport,
+                                 timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT))
+        self.ahttp = None
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.loaded = set()
+        self.available = set()
+        # Model -> bytes: memory footprint for loaded models, download size for the rest
+        self.sizes = {}
+        self.probed_at = None
+
+    def async_http(self):
+        if self.ahttp is None:
+            self.ahttp = httpx.AsyncClient(base_url=self.name, headers=self.headers, limits=ollama_limits(),
+                                           timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT))
+        return self.ahttp
+
+    def healthy(self, now):
+        return self.ejected_until <= now
+
+class OllamaPool:
+    """Least-outstanding-requests scheduling over Ollama hosts with model affinity.
+
+    A background thread probes every host with ``ps`` (resident models) and
+    ``list`` (pulled models). Hosts that fail a probe, or fail
+    OLLAMA_EJECT_FAILURES requests in a row, are ejected for
+    OLLAMA_EJECT_SECONDS.
+    """
+
+    def __init__(self, hosts):
+        self.hosts = [OllamaHost(host) for host in hosts]
+        self.lock = threading.Lock()
+        self.prober = None
+        # (prefix scope, model) -> host that holds that conversation's KV cache
+        self.affinity = OrderedDict()
+
+    def start_probing(self):
+        if self.prober is None:
+            with self.lock:
+                if self.prober is None:
+                    self.prober = threading.Thread(target=self.probe_loop, name='ollama-probe', daemon=True)
+                    self.prober.start()
+
+    def probe_loop(self):
+        while True:
+            for host in self.hosts:
+                self.probe(host)
+            time.sleep(OLLAMA_PROBE_INTERVAL)
+
+    def probe(self, host):
+        try:
+            running = as_dict(host.client.ps()).get('models', [])
+            pulled = as_dict(host.client.list()).get('models', [])
+        except Exception as e:
+            with self.lock:
+                if host.healthy(time.monotonic()):
+                    logger.warning("Ollama host %s failed probe, ejecting: %s", host.name, e)
+                host.ejected_until = time.monotonic() + OLLAMA_EJECT_SECONDS
+            return
+        with self.lock:
+            if not host.healthy(time.monotonic()):
+                logger.info("Ollama host %s is back in rotation", host.name)
+            host.loaded = {model.get('model') or model.get('name') for model in running}
+            host.available = {model.get('model') or model.get('name') for model in pulled}
+            host.sizes = {model.get('model') or model.get('name'): model.get('size') or 0
+                          for model in pulled + running}
+            host.failures = 0
+            host.ejected_until = 0.0
+            host.probed_at = time.time()
+
+    def acquire(self, model, scope=None):
+        """Pick a host for a model and count the request against it.
+
+        Requests sharing a prefix scope (a conversation) stick to the host that
+        served the last one, where the prompt prefix is still cached, unless it
+        is OLLAMA_AFFINITY_SLACK requests busier than the best alternative.
+        """
+        if len(self.hosts) > 1:
+            self.start_probing()
+        model = ollama_model_name(model)
+        with self.lock:
+            now = time.monotonic()
+            candidates = [host for host in self.hosts if host.healthy(now)]
+            if not candidates:
+                # Everything is ejected: try whichever host comes back first
+                candidates = [min(self.hosts, key=lambda host: host.ejected_until)]
+            for preferred in ([h for h in candidates if model in h.loaded],
+                              [h for h in candidates if model in h.available]):
+                if preferred:
+                    candidates = preferred
+                    break
+            host = min(candidates, key=lambda host: host.outstanding)
+            if scope is not None and len(self.hosts) > 1:
+                # First turn: rendezvous-hash the scope, so every worker process picks the same host
+                sticky = self.affinity.get((scope, model)) or max(
+                    candidates, key=lambda host: zlib.crc32(f"{scope}|{host.name}".encode('utf-8')))
+                if (sticky.healthy(now)
+                        and sticky.outstanding <= host.outstanding + OLLAMA_AFFINITY_SLACK):
+                    host = sticky
+                self.affinity[(scope, model)] = host
+                self.affinity.move_to_end((scope, model))
+                if len(self.affinity) > OLLAMA_AFFINITY_SIZE:
+                    self.affinity.popitem(last=False)
+            host.outstanding += 1
+            host.requests += 1
+            if OLLAMA_SCHEDULER:
+                model_scheduler.record(model, host)
+                if worker_index == 0:
+                    model_scheduler.start()
+            return host
+
+    def release(self, host, model, error=None):
+        with self.lock:
+            host.outstanding -= 1
+            if error is None:
+                host.failures = 0
+                # A model that just answered is resident until Ollama unloads it
+                host.loaded.add(ollama_model_name(model))
+            elif ollama_failure(error):
+                host.failures += 1
+                if host.failures >= OLLAMA_EJECT_FAILURES and host.healthy(time.monotonic()):
+                    logger.warning("Ollama host %s failed %s requests, ejecting", host.name, host.failures)
+                    host.ejected_until = time.monotonic() + OLLAMA_EJECT_SECONDS
+
+    @contextmanager
+    def lease(self, model, scope=None):
+        host = self.acquire(model, scope)
+        error = None
+        try:
+            yield host
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.release(host, model, error)
+
+    @asynccontextmanager
+    async def alease(self, model, scope=None):
+        host = self.acquire(model, scope)
+        error = None
+        try:
+            yield host
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.release(host, model, error)
+
+    def healthy_hosts(self):
+        now = time.monotonic()
+        return [host for host in self.hosts if host.healthy(now)] or self.hosts
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            return [{
+                "host": host.name,
+                "healthy": host.healthy(now),
+                "ejected_for": round(max(0.0, host.ejected_until - now), 1),
+                "outstanding": host.outstanding,
+                "requests": host.requests,
+                "consecutive_failures": host.failures,
+                "loaded_models": sorted(host.loaded),
+                "loaded_bytes": sum(host.sizes.get(model, 0) for model in host.loaded),
+                "available_models": sorted(host.available),
+                "probed_at": host.probed_at
+            } for host in self.hosts]
+
+ollama_pool = OllamaPool(OLLAMA_HOSTS)
+
+def pool_stats():
+    """Collect connection pool statistics for each provider session"""
+    stats = {}
+    for provider, session in list(provider_sessions.items()):
+        hosts = {}
+        adapter = session.get_adapter('https://')
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            hosts[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                "connections_created": pool.num_connections,
+                "requests": pool.num_requests,
+                "idle_connections": sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0,
+                "maxsize": pool.pool.maxsize if pool.pool else POOL_MAXSIZE
+            }
+        stats[provider] = hosts
+    return {
+        "pool_connections": POOL_CONNECTIONS,
+        "pool_maxsize": POOL_MAXSIZE,
+        "keepalive": POOL_KEEPALIVE,
+        "timeouts": {"connect": CONNECT_TIMEOUT, "read": READ_TIMEOUT},
+        "providers": stats
+    }
+
+# Metrics (Prometheus text exposition on /metrics)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+RATE_BUCKETS = (1, 5, 10, 20, 50, 100, 200, 500)
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Model names come from clients, so only configured or known models get their own
+# series; the rest share "other", which keeps the label set (and memory) bounded
+METRIC_MODELS = {model.strip() for model in os.getenv('METRIC_MODELS', '').split(',') if model.strip()}
+METRIC_MAX_MODELS = int(os.getenv('METRIC_MAX_MODELS', 500))
+
+known_models = set()
+
+def mark_model_known(model):
+    """Remember a model an upstream accepted (or listed) as a metric label"""
+    if model not in known_models and len(known_models) < METRIC_MAX_MODELS:
+        known_models.add(model)
+
+def model_label(model):
+    if model in known_models or model in METRIC_MODELS or model in MODEL_CONCURRENCY \
+            or model in MODEL_TOKENS_PER_MINUTE:
+        return model
+    return "other"
+
+def bounded_labels(labels, index):
+    """Label values with the model at ``index`` folded by model_label"""
+    label = model_label(labels[index])
+    return labels if label == labels[index] else labels[:index] + (label,) + labels[index + 1:]
+
+def format_labels(labelnames, labels, extra=None):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class MetricCounter:
+    """Monotonic counter keyed by a tuple of label values"""
+
+    kind = "counter"
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.model_index = labelnames.index("model") if "model" in labelnames else None
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        if self.model_index is not None:
+            labels = bounded_labels(labels, self.model_index)
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def snapshot(self):
+        """labels -> value"""
+        with self.lock:
+            return dict(self.values)
+
+class MetricHistogram:
+    """Histogram with fixed buckets keyed by a tuple of label values"""
+
+    kind = "histogram"
+
+    def __init__(self, name, description, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.model_index = labelnames.index("model") if "model" in labelnames else None
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        if self.model_index is not None:
+            labels = bounded_labels(labels, self.model_index)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def snapshot(self):
+        """labels -> (bucket counts, sum, count)"""
+        with self.lock:
+            return {labels: (list(state[0]), state[1], state[2]) for labels, state in self.values.items()}
+
+def render_counter(name, labelnames, values):
+    return [f"{name}{format_labels(labelnames, labels)} {value}" for labels, value in values.items()]
+
+def render_histogram(name, labelnames, buckets, values):
+    lines = []
+    for labels, (counts, total, count) in values.items():
+        cumulative = 0
+        for bound, bucket_count in zip(buckets, counts):
+            cumulative += bucket_count
+            bucket_labels = format_labels(labelnames, labels, 'le="%s"' % bound)
+            lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+        bucket_labels = format_labels(labelnames, labels, 'le="+Inf"')
+        lines.append(f"{name}_bucket{bucket_labels} {count}")
+        lines.append(f"{name}_sum{format_labels(labelnames, labels)} {total}")
+        lines.append(f"{name}_count{format_labels(labelnames, labels)} {count}")
+    return lines
+
+def add_metric_values(kind, values, saved):
+    """Add saved (labels, value) pairs of a counter or histogram into values"""
+    for labels, value in saved:
+        labels = tuple(labels)
+        if kind == "counter":
+            values[labels] = values.get(labels, 0) + value
+        else:
+            counts, total, count = values.get(labels) or ([0] * len(value[0]), 0.0, 0)
+            values[labels] = ([a + b for a, b in zip(counts, value[0])], total + value[1], count + value[2])
+
+metrics_registry = []
+
+def register_metric(metric):
+    metrics_registry.append(metric)
+    return metric
+
+http_requests = register_metric(MetricCounter(
+    "proxy_http_requests_total", "HTTP requests handled", ("route", "method", "status")))
+http_duration = register_metric(MetricHistogram(
+    "proxy_http_request_duration_seconds", "Time to produce response headers", ("route", "method")))
+chat_requests = register_metric(MetricCounter(
+    "proxy_chat_requests_total", "Chat requests by provider and model", ("provider", "model", "stream")))
+upstream_requests = register_metric(MetricCounter(
+    "proxy_upstream_requests_total", "Upstream calls", ("provider", "model", "mode")))
+upstream_errors = register_metric(MetricCounter(
+    "proxy_upstream_errors_total", "Upstream calls that failed", ("provider", "model", "mode")))
+upstream_latency = register_metric(MetricHistogram(
+    "proxy_upstream_latency_seconds", "Upstream call duration (whole stream for streams)", ("provider", "model", "mode")))
+upstream_ttft = register_metric(MetricHistogram(
+    "proxy_time_to_first_token_seconds", "Time until the first streamed chunk", ("provider", "model")))
+stream_chunks = register_metric(MetricCounter(
+    "proxy_stream_chunks_total", "Streamed chunks relayed (roughly one token each)", ("provider", "model")))
+stream_rate = register_metric(MetricHistogram(
+    "proxy_stream_tokens_per_second", "Streamed chunks per second after the first token", ("provider", "model"),
+    RATE_BUCKETS))
+embedding_texts = register_metric(MetricCounter(
+    "proxy_embedding_texts_total", "Distinct texts embedded, by where the vector came from", ("provider", "model", "source")))
+
+def timed_request(provider, model, fn, *args, mode="request"):
+    """Call an upstream function, recording latency and errors"""
+    upstream_requests.inc((provider, model, mode))
+    start = time.perf_counter()
+    # The circuit breakers gate chat routing, so only chat calls speak for them
+    chat = mode == "request"
+    try:
+        with deadline_scope() as scope:
+            result = call_in_scope(scope, fn, *args)
+        if chat:
+            circuit_breaker(provider).record(True)
+        mark_model_known(model)
+        return result
+    except Exception as e:
+        upstream_errors.inc((provider, model, mode))
+        if chat:
+            record_failure(provider, e)
+        raise
+    finally:
+        upstream_latency.observe((provider, model, mode), time.perf_counter() - start)
+
+def timed_stream(provider, model, chunks):
+    """Relay an upstream stream, recording time-to-first-token and token rate"""
+    upstream_requests.inc((provider, model, "stream"))
+    start = time.perf_counter()
+    first = None
+    count = 0
+    try:
+        chunks = iter(chunks)
+        # The stream is read from other threads after the first chunk, so the
+        # scope it started under is put back in place around every read
+        with deadline_scope() as scope:
+            # The provider's request is only sent once the first chunk is asked for
+            with span("first_token", provider=provider, model=model):
+                chunk = call_in_scope(scope, next, chunks, None)
+            if chunk is not None:
+                first = time.perf_counter()
+                mark_model_known(model)
+                upstream_ttft.observe((provider, model), first - start)
+                count = 1
+                yield chunk
+                while True:
+                    try:
+                        chunk = call_in_scope(scope, next, chunks)
+                    except StopIteration:
+                        break
+                    count += 1
+                    yield chunk
+    except Exception as e:
+        upstream_errors.inc((provider, model, "stream"))
+        record_failure(provider, e)
+        raise
+    finally:
+        record_stream(provider, model, start, first, count)
+    circuit_breaker(provider).record(True)
+
+async def atimed_request(provider, model, coroutine):
+    upstream_requests.inc((provider, model, "request"))
+    start = time.perf_counter()
+    try:
+        result = await coroutine
+        circuit_breaker(provider).record(True)
+        mark_model_known(model)
+        return result
+    except Exception as e:
+        upstream_errors.inc((provider, model, "request"))
+        record_failure(provider, e)
+        raise
+    finally:
+        upstream_latency.observe((provider, model, "request"), time.perf_counter() - start)
+
+async def atimed_stream(provider, model, chunks):
+    upstream_requests.inc((provider, model, "stream"))
+    start = time.perf_counter()
+    first = None
+    count = 0
+    try:
+        with span("first_token", provider=provider, model=model):
+            chunk = await anext(chunks, None)
+        if chunk is not None:
+            first = time.perf_counter()
+            mark_model_known(model)
+            upstream_ttft.observe((provider, model), first - start)
+            count = 1
+            yield chunk
+            async for chunk in chunks:
+                count += 1
+                yield chunk
+    except Exception as e:
+        upstream_errors.inc((provider, model, "stream"))
+        record_failure(provider, e)
+        raise
+    finally:
+        record_stream(provider, model, start, first, count)
+    circuit_breaker(provider).record(True)
+
+def record_stream(provider, model, start, first, count):
+    end = time.perf_counter()
+    upstream_latency.observe((provider, model, "stream"), end - start)
+    stream_chunks.inc((provider, model), count)
+    if first is not None and count > 1 and end > first:
+        stream_rate.observe((provider, model), (count - 1) / (end - first))
+
+# With several workers each one saves its counters and histograms under
+# METRICS_DIR, and /metrics adds up every worker's, whichever one answers.
+METRICS_DIR = os.path.join(STATE_DIR, 'metrics')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 5))
+
+# What this worker slot had counted before it was restarted, so sums stay monotonic
+carried_metrics = {}
+
+def metric_families():
+    """This worker's counters and histograms: (name, kind, description, labelnames, buckets, values)"""
+    families = [(metric.name, metric.kind, metric.description, metric.labelnames, getattr(metric, 'buckets', None),
+                 metric.snapshot()) for metric in metrics_registry]
+    families.append(("proxy_coalescing_total", "counter", "Upstream calls made vs requests that joined one in flight",
+                     ("kind", "outcome"), None,
+                     {(kind, outcome): value for kind, counts in coalescing_stats.items()
+                      for outcome, value in counts.items()}))
+    families.append(("proxy_response_cache_total", "counter", "Response cache lookups", ("result",), None,
+                     {("hit",): response_cache.hits, ("miss",): response_cache.misses}))
+    families.append(("proxy_log_dropped_total", "counter", "Log records dropped because the log queue was full",
+                     (), None, {(): log_handler.dropped}))
+    if span_exporter is not None:
+        families.append(("proxy_trace_spans_total", "counter", "Spans sent to the trace collector, by outcome",
+                         ("result",), None, {("exported",): span_exporter.exported,
+                                             ("dropped",): span_exporter.dropped}))
+    for name, kind, _, _, _, values in families:
+        add_metric_values(kind, values, carried_metrics.get(name, ()))
+    return families
+
+def worker_metrics_path(index):
+    return os.path.join(METRICS_DIR, f"worker-{index}.json")
+
+def save_worker_metrics():
+    """Write this worker's metrics for the others to add up"""
+    data = {name: [[list(labels), value] for labels, value in values.items()]
+            for name, _, _, _, _, values in metric_families()}
+    path = worker_metrics_path(worker_index)
+    partial = f"{path}.{os.getpid()}.tmp"
+    with open(partial, 'wb') as f:
+        f.write(json_dumps(data))
+    os.replace(partial, path)
+
+def load_worker_metrics(index):
+    try:
+        with open(worker_metrics_path(index), 'rb') as f:
+            return json_loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
+def start_metrics_flusher():
+    """Carry over what a replaced worker counted, then save this worker's metrics periodically"""
+    carried_metrics.update(load_worker_metrics(worker_index))
+
+    def run():
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                save_worker_metrics()
+            except Exception as e:
+                logger.warning("Saving worker metrics failed: %s", e)
+
+    threading.Thread(target=run, name='metrics-flusher', daemon=True).start()
+
+def render_metrics():
+    """All metrics in Prometheus text format, summed over every worker when there are several"""
+    families = metric_families()
+    if shared_limits is not None:
+        # Other workers' saved metrics are at most METRICS_FLUSH_INTERVAL old
+        for index in range(shared_limits.workers):
+            if index != worker_index:
+                saved = load_worker_metrics(index)
+                for name, kind, _, _, _, values in families:
+                    add_metric_values(kind, values, saved.get(name, ()))
+    lines = []
+    for name, kind, description, labelnames, buckets, values in families:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "counter":
+            lines.extend(render_counter(name, labelnames, values))
+        else:
+            lines.extend(render_histogram(name, labelnames, buckets, values))
+    hosts = ollama_pool.stats()
+    for name, field, description in (("proxy_ollama_host_outstanding", "outstanding", "Requests in flight per Ollama host"),
+                                     ("proxy_ollama_host_healthy", "healthy", "Whether an Ollama host is in rotation")):
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} gauge")
+        for host in hosts:
+            lines.append(f"{name}{format_labels(('host',), (host['host'],))} {int(host[field])}")
+    return "\n".join(lines) + "\n"
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    request_id.set(request.headers.get('X-Request-ID') or uuid.uuid4().hex)
+    request_trace.set(start_trace(request.method, request.url_rule.rule if request.url_rule else request.path,
+                                  request.headers.get('traceparent')))
+
+def start_trace(method, route, traceparent=None):
+    """New trace for a request, or None with tracing off"""
+    if not TRACING:
+        return None
+    trace = Trace(f"{method} {route}", traceparent)
+    trace.attributes.update({"http.method": method, "http.route": route, "request_id": request_id.get()})
+    return trace
+
+def trace_response(trace, headers, status, streamed):
+    """Add Server-Timing and traceparent headers; finish the trace unless the body is still to be streamed"""
+    headers['Server-Timing'] = trace.server_timing()
+    headers['traceparent'] = trace.traceparent()
+    if not streamed:
+        trace.finish(status)
+
+def log_access(method, path, status, elapsed, phases=None):
+    """Structured access log entry; for streams the duration is time to the response headers"""
+    extra = {"method": method, "path": path, "status": status, "duration_ms": round(elapsed * 1000, 2)}
+    if phases:
+        extra["phases"] = phases
+    access_logger.info("%s %s %s", method, path, status, extra=extra)
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    http_requests.inc((route, request.method, response.status_code))
+    trace = request_trace.get()
+    start = g.get('request_start')
+    if start is not None:
+        elapsed = time.perf_counter() - start
+        http_duration.observe((route, request.method), elapsed)
+        log_access(request.method, request.path, response.status_code, elapsed,
+                   trace.phases() if trace is not None else None)
+    if request_id.get():
+        response.headers['X-Request-ID'] = request_id.get()
+    if trace is not None:
+        trace_response(trace, response.headers, response.status_code, response.is_streamed)
+        if response.is_streamed:
+            response.call_on_close(lambda: trace.finish(response.status_code))
+    return response
+
+# gzip for large buffered responses; streams and already-encoded bodies pass through untouched
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', 1))
+
+@app.after_request
+def compress_response(response):
+    if (COMPRESS_LEVEL <= 0 or response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or request.accept_encodings.quality('gzip') <= 0):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+    with span("compress"):
+        response.set_data(gzip.compress(body, compresslevel=COMPRESS_LEVEL, mtime=0))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus scrape endpoint"""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# Opt-in sampling profiler: periodically snapshots every thread's stack
+PROFILER_ENABLED = os.getenv('PROFILER_ENABLED', 'false').lower() in ('1', 'true', 'yes', 'on')
+PROFILER_MAX_SECONDS = float(os.getenv('PROFILER_MAX_SECONDS', 60))
+profiler_lock = threading.Lock()
+
+def thread_cpu_clock(ident):
+    """Reader for a thread's CPU time, or None where the platform has no per-thread clocks"""
+    try:
+        clock = time.pthread_getcpuclockid(ident)
+        time.clock_gettime(clock)
+    except (AttributeError, OSError):
+        return None
+    return lambda: time.clock_gettime(clock)
+
+def sample_stacks(seconds, interval, cpu_only=True):
+    """Count folded stacks ("thread;outer;...;inner") seen over a time window.
+
+    With cpu_only, a thread's stack is only counted when its CPU clock advanced
+    since the previous sample, so idle threads waiting on sockets and locks
+    drop out and the counts show where CPU time goes.
+    """
+    own = threading.get_ident()
+    counts = {}
+    clocks = {}
+    last_cpu = {}
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            if cpu_only:
+                if ident not in clocks:
+                    clocks[ident] = thread_cpu_clock(ident)
+                clock = clocks[ident]
+                if clock is not None:
+                    try:
+                        cpu = clock()
+                    except OSError:
+                        continue
+                    busy = cpu > last_cpu.get(ident, cpu)
+                    last_cpu[ident] = cpu
+                    if not busy:
+                        continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            key = ";".join([names.get(ident, str(ident))] + stack[::-1])
+            counts[key] = counts.get(key, 0) + 1
+        samples += 1
+        time.sleep(interval)
+    return counts, samples
+
+@app.route('/api/v1/profile', methods=['GET'])
+def profile():
+    """Sample all threads' stacks for a while and report the hottest (opt-in with PROFILER_ENABLED)"""
+    if not PROFILER_ENABLED:
+        return jsonify({"error": "Profiler disabled (set PROFILER_ENABLED=true)"}), 404
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        interval = float(request.args.get('interval', 0.01))
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({"error": "'seconds', 'interval' and 'limit' must be numbers"}), 400
+    if not 0 < seconds <= PROFILER_MAX_SECONDS or not 0.001 <= interval <= 1:
+        return jsonify({"error": f"'seconds' must be in (0, {PROFILER_MAX_SECONDS}] and 'interval' in [0.001, 1]"}), 400
+    mode = request.args.get('mode', 'cpu')
+    if mode not in ('cpu', 'wall'):
+        return jsonify({"error": "'mode' must be 'cpu' or 'wall'"}), 400
+    if not profiler_lock.acquire(blocking=False):
+        return jsonify({"error": "A profile is already running"}), 409
+    try:
+        counts, samples = sample_stacks(seconds, interval, cpu_only=mode == 'cpu')
+    finally:
+        profiler_lock.release()
+
+    stacks = sorted(counts.items(), key=lambda item: item[1], reverse=True)
+    if request.args.get('format') == 'folded':
+        # Input for flamegraph.pl, speedscope and similar tools
+        return Response("".join(f"{stack} {count}\n" for stack, count in stacks), mimetype='text/plain')
+    functions = {}
+    for stack, count in stacks:
+        leaf = stack.rsplit(";", 1)[-1]
+        functions[leaf] = functions.get(leaf, 0) + count
+    return jsonify({
+        "seconds": seconds, "interval": interval, "mode": mode, "samples": samples,
+        "stacks": [{"count": count, "stack": stack.split(";")} for stack, count in stacks[:limit]],
+        "functions": [{"function": name, "count": count}
+                      for name, count in sorted(functions.items(), key=lambda item: item[1], reverse=True)[:limit]]
+    })
+
+class LRUCache:
+    """Thread-safe in-memory LRU cache with an optional per-entry TTL"""
+
+    def __init__(self, max_size=256, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at is not None and expires_at < time.time():
+                del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires_at = time.time() + self.ttl if self.ttl else None
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            return self.entries.pop(key, None) is not None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {"backend": "memory", "size": len(self), "max_size": self.max_size,
+                "ttl": self.ttl, "hits": self.hits, "misses": self.misses}
+
+class SqliteCache:
+    """LRU cache persisted to an SQLite file so entries survive restarts and are shared by workers"""
+
+    def __init__(self, path, max_size=256, ttl=None):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.pid = None
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL, accessed_at REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed_at)")
+        self.db.commit()
+
+    @property
+    def db(self):
+        # A forked worker opens its own connection: SQLite handles must not cross fork()
+        if self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.pid = os.getpid()
+        return self.connection
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] < now):
+                if row is not None:
+                    self.db.execute("DELETE FROM cache WHERE key = ?", (key,))
+                    self.db.commit()
+                self.misses += 1
+                return None
+            self.db.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self.db.commit()
+            self.hits += 1
+        return json_loads(row[0])
+
+    def set(self, key, value):
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl else None
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json_dumps(value).decode('utf-8'), expires_at, now)
+            )
+            # Evict least recently used entries beyond the size limit
+            self.db.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_size,)
+            )
+            self.db.commit()
+
+    def delete(self, key):
+        with self.lock:
+            deleted = self.db.execute("DELETE FROM cache WHERE key = ?", (key,)).rowcount
+            self.db.commit()
+        return deleted > 0
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM cache")
+            self.db.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def stats(self):
+        return {"backend": "sqlite", "path": self.path, "size": len(self), "max_size": self.max_size,
+                "ttl": self.ttl, "hits": self.hits, "misses": self.misses}
+
+# Opt-in cache for deterministic (temperature=0) non-streaming chat responses
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'False').lower() in ('true', '1', 't')
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 1024))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', 3600)) or None
+RESPONSE_CACHE_PATH = os.getenv('RESPONSE_CACHE_PATH',
+                                os.path.join(STATE_DIR, 'responses.sqlite3') if WORKERS > 1 else None)
+
+if RESPONSE_CACHE_PATH:
+    response_cache = SqliteCache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+else:
+    response_cache = LRUCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+def canonical_hash(data):
+    """Stable SHA-256 of a JSON-serializable value"""
+    return hashlib.sha256(json_dumps(data, sort_keys=True)).hexdigest()
+
+def response_cache_key(validated_data, cache_control=None):
+    """Cache key for a validated chat request, or None if it must not be cached"""
+    if not RESPONSE_CACHE_ENABLED or validated_data.stream or validated_data.temperature != 0:
+        return None
+    if cache_control and 'no-store' in cache_control.lower():
+        return None
+    if validated_data.use_history and validated_data.conversation_id:
+        # The upstream context comes from stored history, not from the request
+        return None
+    if validated_data.fallbacks:
+        # The answer may come from any of the candidate providers
+        return None
+    # Transport-only fields do not change the answer, so they stay out of the key
+    return canonical_hash(validated_data.model_dump(
+        exclude={'stream', 'conversation_id', 'use_history', 'timeout', 'hedge_after'}))
+
+def cached_chat_response(cache_key, cache_control=None):
+    """Look up a cached response unless the client asked to revalidate"""
+    if cache_key is None or (cache_control and 'no-cache' in cache_control.lower()):
+        return None
+    return response_cache.get(cache_key)
+
+def cache_status(cache_key, hit):
+    if cache_key is None:
+        return 'BYPASS'
+    return 'HIT' if hit else 'MISS'
+
+# Single-flight coalescing of identical in-flight upstream calls
+REQUEST_COALESCING = os.getenv('REQUEST_COALESCING', 'True').lower() in ('true', '1', 't')
+
+coalescing_stats = {
+    "requests": {"upstream": 0, "coalesced": 0},
+    "streams": {"upstream": 0, "coalesced": 0}
+}
+
+def coalesce_key(provider, messages, system, tools, model, temperature, max_tokens, top_p, stream):
+    """Canonical key of the upstream call a chat request will make, or None if it must not be shared"""
+    if request_deadline.get() is not None:
+        # A shared call would run under the first caller's deadline
+        return None
+    return canonical_hash([provider, model, system, messages, tools, temperature, max_tokens, top_p, stream])
+
+class StreamBroadcast:
+    """Buffered chunks of one upstream stream, replayed to every subscriber"""
+
+    def __init__(self, condition=None):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.condition = condition or threading.Condition()
+        self.task = None
+        self.scope = None
+
+class SingleFlight:
+    """Share one upstream call between identical concurrent requests (thread-based)"""
+
+    def __init__(self):
+        self.calls = {}
+        self.streams = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"event": threading.Event(), "result": None, "error": None}
+                self.calls[key] = call
+                coalescing_stats["requests"]["upstream"] += 1
+            else:
+                coalescing_stats["requests"]["coalesced"] += 1
+
+        if leader:
+            try:
+                call["result"] = fn()
+            except Exception as e:
+                call["error"] = e
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call["event"].set()
+        else:
+            call["event"].wait()
+
+        if call["error"] is not None:
+            raise call["error"]
+        return call["result"]
+
+    def stream(self, key, factory, admit=None):
+        """Subscribe to the stream in flight for key, or lead a new one.
+
+        Leadership is decided under the lock, and the leader is admitted
+        (``admit``) before this returns, so a rejection raises here. The
+        returned iterator is already subscribed; closing it unsubscribes.
+        """
+        chunks = self._subscribe(key, factory, admit)
+        next(chunks)
+        return chunks
+
+    def _subscribe(self, key, factory, admit):
+        with self.lock:
+            broadcast = self.streams.get(key)
+            leader = broadcast is None
+            if leader:
+                broadcast = StreamBroadcast()
+                broadcast.scope = CancelScope()
+                self.streams[key] = broadcast
+                coalescing_stats["streams"]["upstream"] += 1
+            else:
+                coalescing_stats["streams"]["coalesced"] += 1
+            with broadcast.condition:
+                broadcast.subscribers += 1
+
+        try:
+            if leader:
+                try:
+                    admission = admit() if admit is not None else Admission()
+                except BaseException as e:
+                    self._finish(key, broadcast, e)
+                    raise
+                threading.Thread(target=contextvars.copy_context().run,
+                                 args=(self._pump, key, broadcast, factory, admission), daemon=True).start()
+            # stream() stops here: from now on the finally below unsubscribes
+            yield None
+            position = 0
+            while True:
+                with broadcast.condition:
+                    while position >= len(broadcast.chunks) and not broadcast.done:
+                        broadcast.condition.wait()
+                    pending = broadcast.chunks[position:]
+                    position += len(pending)
+                    done = broadcast.done and position >= len(broadcast.chunks)
+                for chunk in pending:
+                    yield chunk
+                if done:
+                    if broadcast.error is not None:
+                        raise broadcast.error
+                    return
+        finally:
+            with self.lock:
+                with broadcast.condition:
+                    broadcast.subscribers -= 1
+                    abandoned = broadcast.subscribers == 0 and not broadcast.done
+                if abandoned and self.streams.get(key) is broadcast:
+                    del self.streams[key]
+            if abandoned:
+                # Abort the upstream read now rather than when its next chunk arrives
+                broadcast.scope.cancel()
+
+    def _pump(self, key, broadcast, factory, admission):
+        """Read the upstream stream once, stopping early if every subscriber has left"""
+        upstream = None
+        error = None
+        # Cancelled by the last subscriber to leave, which shuts down the upstream connection
+        cancel_scope.set(broadcast.scope)
+        try:
+            upstream = factory()
+            for chunk in upstream:
+                with broadcast.condition:
+                    broadcast.chunks.append(chunk)
+                    broadcast.condition.notify_all()
+                    if broadcast.subscribers == 0:
+                        break
+        except Exception as e:
+            error = e
+        finally:
+            self._finish(key, broadcast, error)
+            if hasattr(upstream, 'close'):
+                upstream.close()
+            admission.release()
+
+    def _finish(self, key, broadcast, error=None):
+        """Stop new subscribers joining and wake the current ones to see the end (or error)"""
+        with self.lock:
+            if self.streams.get(key) is broadcast:
+                del self.streams[key]
+        with broadcast.condition:
+            broadcast.error = error
+            broadcast.done = True
+            broadcast.condition.notify_all()
+
+chat_flight = SingleFlight()
+
+def coalesced_request(key, fn, admit=None):
+    """Call fn, or share an identical call in flight; only the caller making the call is admitted"""
+    def call():
+        admission = admit() if admit is not None else Admission()
+        try:
+            return fn()
+        finally:
+            admission.release()
+
+    return chat_flight.do(key, call) if REQUEST_COALESCING and key is not None else call()
+
+def coalesced_stream(key, factory, admit=None):
+    """Stream from factory, or share an identical stream in flight.
+
+    Returns the chunks and the admission this caller must release (empty when
+    the shared stream holds it).
+    """
+    if REQUEST_COALESCING and key is not None:
+        return chat_flight.stream(key, factory, admit), Admission()
+    admission = admit() if admit is not None else Admission()
+    return factory(), admission
+
+# Admission control: per-provider and per-model concurrency and token-rate
+# limits, with a bounded priority queue in front of upstream calls.
+ADMISSION_QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE', 100))
+ADMISSION_TIMEOUT = float(os.getenv('ADMISSION_TIMEOUT', 30))
+PROVIDER_CONCURRENCY = {
+    "ollama": int(os.getenv('OLLAMA_CONCURRENCY', 4 * len(OLLAMA_HOSTS))),
+    "openai": int(os.getenv('OPENAI_CONCURRENCY', 64)),
+    "anthropic": int(os.getenv('ANTHROPIC_CONCURRENCY', 32)),
+    "mistral": int(os.getenv('MISTRAL_CONCURRENCY', 32))
+}
+PROVIDER_TOKENS_PER_MINUTE = {
+    "ollama": int(os.getenv('OLLAMA_TOKENS_PER_MINUTE', 0)),
+    "openai": int(os.getenv('OPENAI_TOKENS_PER_MINUTE', 0)),
+    "anthropic": int(os.getenv('ANTHROPIC_TOKENS_PER_MINUTE', 0)),
+    "mistral": int(os.getenv('MISTRAL_TOKENS_PER_MINUTE', 0))
+}
+PRIORITIES = {"interactive": 0, "batch": 1}
+
+def parse_model_limits(value):
+    """Parse 'model=limit,model=limit' (model names may contain ':')"""
+    limits = {}
+    for item in value.split(','):
+        if '=' in item:
+            model, limit = item.rsplit('=', 1)
+            limits[model.strip()] = int(limit)
+    return limits
+
+MODEL_CONCURRENCY = parse_model_limits(os.getenv('MODEL_CONCURRENCY', ''))
+MODEL_TOKENS_PER_MINUTE = parse_model_limits(os.getenv('MODEL_TOKENS_PER_MINUTE', ''))
+
+admission_requests = register_metric(MetricCounter(
+    "proxy_admission_total", "Admission decisions per limiter", ("limiter", "outcome")))
+admission_wait = register_metric(MetricHistogram(
+    "proxy_admission_wait_seconds", "Time spent queued before admission", ("limiter",)))
+
+class AdmissionRejected(Exception):
+    """The admission queue is full or the wait for capacity timed out"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+# How often a worker re-checks capacity that is held by other workers
+LIMITER_POLL_INTERVAL = float(os.getenv('LIMITER_POLL_INTERVAL', 0.05))
+
+class SharedLimiterTable:
+    """Limiter state in a memory-mapped file, so every worker draws on one budget.
+
+    A slot holds a limiter's name hash, token bucket level and refill time, and
+    its in-flight count per worker, so a crashed worker's slots can be zeroed.
+    """
+
+    slots = 256
+
+    def __init__(self, path, workers):
+        self.path = path
+        self.workers = workers
+        self.slot = struct.Struct(f'<Qdd{workers}q')
+        size = self.slots * self.slot.size
+        # Start from a clean table: the state of a previous run is stale
+        with open(path, 'wb') as f:
+            f.truncate(size)
+        with open(path, 'r+b') as f:
+            self.map = mmap.mmap(f.fileno(), size)
+        self.lock = FileLock(f"{path}.lock")
+
+    def claim(self, name, tokens):
+        """Offset of a limiter's slot, claimed on first use; None if the table is full"""
+        key = int.from_bytes(hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+        with self.lock:
+            for probe in range(self.slots):
+                offset = (key + probe) % self.slots * self.slot.size
+                slot_key = struct.unpack_from('<Q', self.map, offset)[0]
+                if slot_key == key:
+                    return offset
+                if slot_key == 0:
+                    self.slot.pack_into(self.map, offset, key, tokens, time.monotonic(), *[0] * self.workers)
+                    return offset
+        return None
+
+    def load(self, offset):
+        """Bucket level, refill time and requests in flight on other workers (lock held)"""
+        _, tokens, refilled, *active = self.slot.unpack_from(self.map, offset)
+        return tokens, refilled, sum(active) - active[worker_index]
+
+    def store(self, offset, tokens, refilled, active):
+        struct.pack_into('<dd', self.map, offset + 8, tokens, refilled)
+        struct.pack_into('<q', self.map, offset + 24 + 8 * worker_index, active)
+
+    def reset_worker(self, index):
+        """Drop the slots held by a worker that exited"""
+        with self.lock:
+            for offset in range(0, self.slots * self.slot.size, self.slot.size):
+                if struct.unpack_from('<Q', self.map, offset)[0]:
+                    struct.pack_into('<q', self.map, offset + 24 + 8 * index, 0)
+
+# Created by the supervisor before it forks workers (see run_workers)
+shared_limits = None
+
+class Limiter:
+    """Concurrency slots and a token bucket for one provider or model.
+
+    Requests that cannot start right away wait in a bounded heap ordered by
+    priority then arrival; slots are handed out by ``_dispatch`` as they free
+    up, which wakes the waiter through its callback (a thread event or an
+    asyncio future), so sync and async requests share one queue. With several
+    workers the slot counts and bucket live in ``shared_limits``; each worker
+    keeps its own queue and polls for capacity freed by the others.
+    """
+
+    def __init__(self, name, concurrency=0, tokens_per_minute=0, queue_size=ADMISSION_QUEUE_SIZE):
+        self.name = name
+        self.concurrency = concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.active = 0
+        self.waiting = []
+        self.sequence = 0
+        self.tokens = float(tokens_per_minute)
+        self.refilled = time.monotonic()
+        self.hold = 1.0
+        self.timer = None
+        self.others = 0
+        self.slot = shared_limits.claim(name, float(tokens_per_minute)) if shared_limits else None
+
+    @contextmanager
+    def _locked(self):
+        """Hold the limiter, syncing the shared state of all workers in and out"""
+        with self.lock:
+            if self.slot is None:
+                yield
+                return
+            with shared_limits.lock:
+                self.tokens, self.refilled, self.others = shared_limits.load(self.slot)
+                try:
+                    yield
+                finally:
+                    shared_limits.store(self.slot, self.tokens, self.refilled, self.active)
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.tokens_per_minute:
+            self.tokens = min(self.tokens_per_minute,
+                              self.tokens + (now - self.refilled) * self.tokens_per_minute / 60)
+        self.refilled = now
+
+    def _cost(self, tokens):
+        # A request larger than the whole bucket waits for a full bucket
+        return min(tokens, self.tokens_per_minute)
+
+    def _slot_free(self):
+        return not self.concurrency or self.active + self.others < self.concurrency
+
+    def _fits(self, tokens):
+        return self._slot_free() and (not self.tokens_per_minute or self.tokens >= self._cost(tokens))
+
+    def _grant(self, tokens):
+        self.active += 1
+        if self.tokens_per_minute:
+            self.tokens -= self._cost(tokens)
+        admission_requests.inc((self.name, "admitted"))
+
+    def _dispatch(self):
+        """Hand free capacity to queued requests in priority order (lock held)"""
+        self._refill()
+        while self.waiting and self._fits(self.waiting[0][2]):
+            entry = heapq.heappop(self.waiting)
+            self._grant(entry[2])
+            entry[4] = True
+            entry[3]()
+        if not self.waiting or self.timer is not None:
+            return
+        if self._slot_free():
+            # The head is waiting on the token bucket: check again once it has refilled
+            delay = (self._cost(self.waiting[0][2]) - self.tokens) * 60 / self.tokens_per_minute
+        elif self.others:
+            # Other workers do not wake this one when they release a slot
+            delay = LIMITER_POLL_INTERVAL
+        else:
+            return
+        self.timer = threading.Timer(delay, self._on_timer)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _on_timer(self):
+        with self._locked():
+            self.timer = None
+            self._dispatch()
+
+    def _retry_after(self, tokens):
+        wait_time = self.hold * (len(self.waiting) + 1) / (self.concurrency or 1)
+        if self.tokens_per_minute:
+            wait_time = max(wait_time, (self._cost(tokens) - self.tokens) * 60 / self.tokens_per_minute)
+        return max(1, math.ceil(wait_time))
+
+    def enqueue(self, priority, tokens, wake):
+        """Admit right away (returns None) or queue the request and return its entry"""
+        with self._locked():
+            self._refill()
+            if not self.waiting and self._fits(tokens):
+                self._grant(tokens)
+                return None
+            if len(self.waiting) >= self.queue_size:
+                admission_requests.inc((self.name, "rejected"))
+                raise AdmissionRejected(f"Too many queued requests for {self.name}", self._retry_after(tokens))
+            self.sequence += 1
+            entry = [priority, self.sequence, tokens, wake, False]
+            heapq.heappush(self.waiting, entry)
+            admission_requests.inc((self.name, "queued"))
+            self._dispatch()
+            return entry
+
+    def cancel(self, entry):
+        """Withdraw a queued request; False if it was admitted in the meantime"""
+        with self._locked():
+            if entry[4]:
+                return False
+            self.waiting.remove(entry)
+            heapq.heapify(self.waiting)
+            admission_requests.inc((self.name, "timeout"))
+            return True
+
+    def acquire(self, priority, tokens, timeout):
+        start = time.monotonic()
+        event = threading.Event()
+        entry = self.enqueue(priority, tokens, event.set)
+        if entry is not None:
+            if not event.wait(timeout) and self.cancel(entry):
+                raise AdmissionRejected(f"Timed out waiting for {self.name} capacity", self._retry_after(tokens))
+            admission_wait.observe((self.name,), time.monotonic() - start)
+        return time.monotonic()
+
+    async def _off_loop(self, func, *args):
+        """Shared limiters sync through a file lock other workers may hold: wait for it in a thread"""
+        if self.slot is None:
+            return func(*args)
+        return await asyncio.to_thread(func, *args)
+
+    async def aacquire(self, priority, tokens, timeout):
+        start = time.monotonic()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        entry = await self._off_loop(self.enqueue, priority, tokens, wake)
+        if entry is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(future), timeout)
+            except asyncio.TimeoutError:
+                if await self._off_loop(self.cancel, entry):
+                    raise AdmissionRejected(f"Timed out waiting for {self.name} capacity", self._retry_after(tokens))
+            except asyncio.CancelledError:
+                # Shielded so a second cancellation cannot leak the slot
+                await asyncio.shield(self._off_loop(self._abandon, entry))
+                raise
+            admission_wait.observe((self.name,), time.monotonic() - start)
+        return time.monotonic()
+
+    def _abandon(self, entry):
+        """Withdraw a cancelled waiter, or give back the slot it was granted meanwhile"""
+        if not self.cancel(entry):
+            self.release(time.monotonic())
+
+    def release(self, started):
+        with self._locked():
+            self.active -= 1
+            # Smoothed slot hold time, used to estimate Retry-After
+            self.hold = 0.8 * self.hold + 0.2 * (time.monotonic() - started)
+            self._dispatch()
+
+    def stats(self):
+        with self._locked():
+            self._refill()
+            return {
+                "concurrency": self.concurrency or None,
+                "tokens_per_minute": self.tokens_per_minute or None,
+                "active": self.active + self.others,
+                "queued": len(self.waiting),
+                "queue_size": self.queue_size,
+                "tokens_available": round(self.tokens) if self.tokens_per_minute else None,
+                "avg_hold_seconds": round(self.hold, 3)
+            }
+
+limiters = {}
+limiters_lock = threading.Lock()
+
+def get_limiters(provider, model):
+    """Model limiter (if configured) then provider limiter; always acquired in this order"""
+    with limiters_lock:
+        chain = []
+        if model in MODEL_CONCURRENCY or model in MODEL_TOKENS_PER_MINUTE:
+            name = f"{provider}/{model}"
+            if name not in limiters:
+                limiters[name] = Limiter(name, MODEL_CONCURRENCY.get(model, 0), MODEL_TOKENS_PER_MINUTE.get(model, 0))
+            chain.append(limiters[name])
+        if provider not in limiters:
+            limiters[provider] = Limiter(provider, PROVIDER_CONCURRENCY.get(provider, 0),
+                                         PROVIDER_TOKENS_PER_MINUTE.get(provider, 0))
+        chain.append(limiters[provider])
+        return chain
+
+class Admission:
+    """Limiter slots held by one admitted request; release() is idempotent"""
+
+    def __init__(self, held=None):
+        self.held = held or []
+
+    def release(self):
+        # pop() is atomic, so a hedge cancelling the request may race its own release
+        while True:
+            try:
+                limiter, started = self.held.pop()
+            except IndexError:
+                return
+            limiter.release(started)
+
+    async def arelease(self):
+        """release() for the event loop; shared limiters take the file lock in a thread"""
+        if any(limiter.slot is not None for limiter, _ in self.held):
+            await asyncio.to_thread(self.release)
+        else:
+            self.release()
+
+def request_cost(messages, system, max_tokens):
+    """Token-bucket cost of a chat request: prompt estimate plus the completion budget"""
+    return estimate_tokens({"content": system}) + sum(estimate_tokens(m) for m in messages) + max_tokens
+
+def request_priority(value):
+    return PRIORITIES.get((value or 'interactive').lower(), 0)
+
+def admission_timeout():
+    """How long a request may queue: ADMISSION_TIMEOUT, clipped to its deadline"""
+    remaining = remaining_time()
+    if remaining is None:
+        return ADMISSION_TIMEOUT
+    if remaining <= 0:
+        raise DeadlineExceeded("Request deadline exceeded")
+    return min(ADMISSION_TIMEOUT, remaining)
+
+def admit(provider, model, priority, tokens, timeout=None):
+    """Wait for capacity on every limiter for the request; raises AdmissionRejected"""
+    timeout = admission_timeout() if timeout is None else timeout
+    admission = Admission()
+    deadline = time.monotonic() + timeout
+    try:
+        with span("admission", provider=provider, model=model):
+            for limiter in get_limiters(provider, model):
+                started = limiter.acquire(priority, tokens, max(0.0, deadline - time.monotonic()))
+                admission.held.append((limiter, started))
+    except BaseException:
+        admission.release()
+        raise
+    return admission
+
+async def aadmit(provider, model, priority, tokens, timeout=None):
+    timeout = admission_timeout() if timeout is None else timeout
+    admission = Admission()
+    deadline = time.monotonic() + timeout
+    try:
+        with span("admission", provider=provider, model=model):
+            for limiter in get_limiters(provider, model):
+                started = await limiter.aacquire(priority, tokens, max(0.0, deadline - time.monotonic()))
+                admission.held.append((limiter, started))
+    except BaseException:
+        await asyncio.shield(admission.arelease())
+        raise
+    return admission
+
+def admission_stats():
+    with limiters_lock:
+        items = list(limiters.items())
+    return {"queue_size": ADMISSION_QUEUE_SIZE, "timeout": ADMISSION_TIMEOUT,
+            "limiters": {name: limiter.stats() for name, limiter in items}}
+
+# Hedged requests and failover: a request may list fallback provider/model
+# pairs that are tried when the current one fails or is slow to answer.
+HEDGE_AFTER = float(os.getenv('HEDGE_AFTER', 2.0))
+CIRCUIT_FAILURES = int(os.getenv('CIRCUIT_FAILURES', 5))
+CIRCUIT_COOLDOWN = float(os.getenv('CIRCUIT_COOLDOWN', 30))
+
+hedge_attempts = register_metric(MetricCounter(
+    "proxy_hedge_attempts_total", "Routed attempts by why they started and how they ended",
+    ("provider", "model", "reason", "outcome")))
+
+class CircuitOpenError(Exception):
+    """Every candidate provider is skipped by its circuit breaker"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """Opens after CIRCUIT_FAILURES consecutive failures; lets one trial call through after CIRCUIT_COOLDOWN"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial or time.monotonic() - self.opened_at < CIRCUIT_COOLDOWN:
+                return False
+            self.trial = True
+            return True
+
+    def release_trial(self):
+        """Free the trial slot if the call let through ended without a verdict (deadline, rejection, cancellation)"""
+        with self.lock:
+            self.trial = False
+
+    def record(self, ok):
+        with self.lock:
+            self.trial = False
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.failures >= CIRCUIT_FAILURES:
+                    self.opened_at = time.monotonic()
+
+    def retry_after(self):
+        with self.lock:
+            if self.opened_at is None:
+                return 0
+            return max(1, math.ceil(CIRCUIT_COOLDOWN - (time.monotonic() - self.opened_at)))
+
+    def stats(self):
+        with self.lock:
+            state = "closed" if self.opened_at is None else ("half-open" if self.trial else "open")
+            return {"state": state, "consecutive_failures": self.failures}
+
+circuit_breakers = {}
+
+def circuit_breaker(provider):
+    breaker = circuit_breakers.get(provider)
+    if breaker is None:
+        breaker = circuit_breakers.setdefault(provider, CircuitBreaker())
+    return breaker
+
+def provider_failure(exc):
+    """Whether an error says the provider is unhealthy rather than the request being bad"""
+    if isinstance(exc, (UpstreamError, ollama.ResponseError)):
+        return exc.status_code >= 500 or exc.status_code == 429
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                            httpx.TransportError, ConnectionError, TimeoutError))
+
+def record_failure(provider, error):
+    # Timeouts caused by the client's own deadline, a missing API key, a 4xx or a
+    # hedge cancelling its loser say nothing about the provider
+    if not deadline_expired() and not attempt_cancelled() and provider_failure(error):
+        circuit_breaker(provider).record(False)
+
+def route_candidates(provider, model, fallbacks):
+    """The primary provider/model followed by the request's fallbacks, without repeats"""
+    candidates = []
+    for candidate in [(provider, model)] + [(f.get('provider'), f.get('model') or model) for f in fallbacks or []]:
+        if candidate not in candidates:
+            candidates.append(candidate)
+    return candidates
+
+hedge_executor = ThreadPoolExecutor(max_workers=int(os.getenv('HEDGE_WORKERS', 64)), thread_name_prefix='hedge')
+
+def hedged_call(candidates, call, hedge_after, discard=None):
+    """Run call(provider, model) against candidates in order until one succeeds.
+
+    The next candidate starts as soon as the current ones have all failed, or
+    when hedge_after seconds pass without an answer (a hedge). The first
+    success wins; results that arrive later from losers go to ``discard``.
+    Returns ((provider, model), result).
+    """
+    remaining = deque(candidates)
+    running = {}
+    scopes = {}
+    last_error = None
+
+    def attempt(scope, provider, model):
+        cancel_scope.set(scope)
+        try:
+            return call(provider, model)
+        finally:
+            # A verdict (record) already freed it; anything else must not leave the breaker half-open for good
+            circuit_breaker(provider).release_trial()
+
+    def launch(reason):
+        while remaining:
+            provider, model = remaining.popleft()
+            if circuit_breaker(provider).allow():
+                scope = CancelScope()
+                future = hedge_executor.submit(contextvars.copy_context().run, attempt, scope, provider, model)
+                running[future] = (provider, model, reason)
+                scopes[future] = scope
+                return True
+            hedge_attempts.inc((provider, model, reason, "skipped"))
+        return False
+
+    launch("primary")
+    while running:
+        done, _ = wait(running, timeout=hedge_after if remaining else None, return_when=FIRST_COMPLETED)
+        if not done:
+            launch("hedge")
+            continue
+        for future in done:
+            provider, model, reason = running.pop(future)
+            if future.exception() is None:
+                hedge_attempts.inc((provider, model, reason, "won"))
+                for loser, (loser_provider, loser_model, loser_reason) in running.items():
+                    hedge_attempts.inc((loser_provider, loser_model, loser_reason, "cancelled"))
+                    if loser.cancel():
+                        # Never started, so nothing else will free a trial it was let through as
+                        circuit_breaker(loser_provider).release_trial()
+                        continue
+                    # Running: free its slot now and abort its upstream call
+                    scopes[loser].cancel()
+                    if discard is not None:
+                        loser.add_done_callback(lambda f: f.exception() is None and discard(f.result()))
+                return (provider, model), future.result()
+            last_error = future.exception()
+            hedge_attempts.inc((provider, model, reason, "failed"))
+            logger.warning("Routed attempt to %s/%s failed: %s", provider, model, last_error)
+            launch("failover")
+
+    if last_error is not None:
+        raise last_error
+    retry_after = min(circuit_breaker(provider).retry_after() for provider, _ in candidates)
+    raise CircuitOpenError("All candidate providers are unavailable (circuit open)", retry_after)
+
+def hedge_delay(validated_data):
+    return HEDGE_AFTER if validated_data.hedge_after is None else validated_data.hedge_after
+
+def routed_request(validated_data, messages, priority, cost, admit=admit):
+    """Non-streaming chat over the provider and its fallbacks; returns ((provider, model), response)"""
+    def attempt(provider, model):
+        admission = admit(provider, model, priority, cost)
+        release_on_cancel(admission)
+        try:
+            return timed_request(provider, model, providers[provider].request, messages, validated_data.system,
+                                 validated_data.tools, model, validated_data.temperature,
+                                 validated_data.max_tokens, validated_data.top_p)
+        finally:
+            admission.release()
+
+    candidates = route_candidates(validated_data.provider, validated_data.model, validated_data.fallbacks)
+    return hedged_call(candidates, attempt, hedge_delay(validated_data))
+
+def routed_stream(validated_data, messages, priority, cost):
+    """Streaming chat that hedges on time to first chunk.
+
+    Returns ((provider, model), (first chunk, rest of the stream, admission)).
+    """
+    def start(provider, model):
+        admission = admit(provider, model, priority, cost)
+        release_on_cancel(admission)
+        try:
+            chunks = timed_stream(provider, model, providers[provider].stream(
+                messages, validated_data.system, validated_data.tools, model, validated_data.temperature,
+                validated_data.max_tokens, validated_data.top_p))
+            first = next(chunks, None)
+        except BaseException:
+            admission.release()
+            raise
+        return first, chunks, admission
+
+    def discard(started):
+        _, chunks, admission = started
+        chunks.close()
+        admission.release()
+
+    candidates = route_candidates(validated_data.provider, validated_data.model, validated_data.fallbacks)
+    return hedged_call(candidates, start, hedge_delay(validated_data), discard)
+
+def resume_stream(first, chunks):
+    """Yield an already-read first chunk, then the rest of the stream"""
+    try:
+        if first is not None:
+            yield first
+        yield from chunks
+    finally:
+        chunks.close()
+
+class ChatSchema(BaseModel):
+    messages: List[Dict[str, str]] = Field(..., description="List of messages")
+    system: str = Field(..., description="System message")
+    tools: Optional[List[str]] = Field(None, description="List of tools")
+    model: str = Field("llama2", description="Model to use")
+    provider: str = Field("ollama", description="Provider to use", pattern="^(ollama|openai|anthropic|mistral)$")
+    temperature: float = Field(0.7, description="Temperature for the model", ge=0, le=2)
+    max_tokens: int = Field(1000, description="Maximum number of tokens", gt=0)
+    top_p: float = Field(0.9, description="Top-p sampling", ge=0, le=1)
+    stream: bool = Field(False, description="Whether to stream the response")
+    conversation_id: Optional[str] = Field(None, description="Conversation ID")
+    use_history: bool = Field(False, description="Build context from stored history; messages holds only the new turn")
+    fallbacks: Optional[List[Dict[str, str]]] = Field(None, description="Fallback provider/model pairs, in order")
+    hedge_after: Optional[float] = Field(None, description="Seconds without a first token before hedging", ge=0)
+    timeout: Optional[float] = Field(None, description="Seconds the whole request may take", gt=0)
+
+@app.route('/api/v1/chat', methods=['POST'])
+def chat():
+    logger.info("Received request at /api/v1/chat")
+    try:
+        # Validate input data straight from the body: one pass, no intermediate dicts or copies of messages
+        try:
+            with span("parse"):
+                validated_data = ChatSchema.model_validate_json(request.get_data())
+        except ValidationError as e:
+            logger.error("Validation errors: %s", e.errors())
+            return jsonify({"error": "Invalid input data format", "details": e.errors()}), 400
+
+        # Extract parameters
+        messages = validated_data.messages
+        system = validated_data.system
+        tools = validated_data.tools
+        model = validated_data.model
+        provider = validated_data.provider
+        temperature = validated_data.temperature
+        max_tokens = validated_data.max_tokens
+        top_p = validated_data.top_p
+        stream = validated_data.stream
+        conversation_id = validated_data.conversation_id
+        deadline = apply_timeout(validated_data.timeout)
+        prefix_scope.set(prompt_cache_scope(validated_data))
+
+        # Log the request details
+        logger.info("Processing request with provider: %s, model: %s, stream: %s", provider, model, stream)
+        annotate(provider=provider, model=model, stream=stream)
+
+        upstream = providers.get(provider)
+        if upstream is None:
+            return jsonify({"error": "Invalid provider specified"}), 400
+        routed = bool(validated_data.fallbacks)
+        if routed and any(fallback.get('provider') not in providers for fallback in validated_data.fallbacks):
+            return jsonify({"error": "Invalid fallback provider specified"}), 400
+        chat_requests.inc((provider, model, "true" if stream else "false"))
+
+        # Either assemble the context server-side or save the client's history
+        use_history = bool(conversation_id) and validated_data.use_history
+        with span("context"):
+            if use_history:
+                messages = assemble_context(conversation_id, messages, model, system, max_tokens)
+            elif conversation_id:
+                save_conversation_history(conversation_id, messages)
+
+        priority = request_priority(request.headers.get('X-Priority'))
+        cost = request_cost(messages, system, max_tokens)
+
+        # Handle streaming response
+        if stream:
+            if routed:
+                # Race the provider and its fallbacks to the first chunk
+                (provider, model), (first, chunks, admission) = routed_stream(validated_data, messages, priority, cost)
+                upstream = providers[provider]
+                source = resume_stream(first, chunks)
+            else:
+                # Identical in-flight streams share one upstream connection (and its admission)
+                key = coalesce_key(provider, messages, system, tools, model, temperature, max_tokens, top_p, True)
+                source, admission = coalesced_stream(key, lambda: timed_stream(provider, model, upstream.stream(
+                    messages, system, tools, model, temperature, max_tokens, top_p)),
+                    lambda: admit(provider, model, priority, cost))
+
+            trace = request_trace.get()
+
+            def generate():
+                parts = []
+                chunks = 0
+                started = time.perf_counter()
+                relay_start = None
+                try:
+                    for chunk in source:
+                        if relay_start is None:
+                            relay_start = time.perf_counter_ns()
+                        check_deadline(deadline)
+                        if use_history:
+                            parts.append(upstream.chunk_text(chunk))
+                        record_prompt_usage(provider, model, upstream.chunk_usage(chunk), messages, system)
+                        chunks += 1
+                        chunk_logger.debug("Relaying chunk %s (%s bytes)", chunks, len(chunk))
+                        yield sse_event(chunk)
+
+                    if use_history:
+                        record_reply(conversation_id, "".join(parts))
+
+                    # End of stream marker
+                    yield "data: [DONE]\n\n"
+
+                except Exception as e:
+                    logger.error("Streaming error: %s", e)
+                    yield sse_event(json_dumps({'error': str(e)}))
+                finally:
+                    # Closing the source tears down the upstream call
+                    if hasattr(source, 'close'):
+                        source.close()
+                    admission.release()
+                    elapsed = time.perf_counter() - started
+                    extra = {"chunks": chunks, "duration_ms": round(elapsed * 1000, 2)}
+                    if trace is not None:
+                        if relay_start is not None:
+                            trace.add("relay", relay_start, chunks=chunks)
+                        extra["phases"] = trace.phases()
+                    logger.info("Stream closed after %s chunks", chunks, extra=extra)
+
+            result = Response(generate(), mimetype='text/event-stream')
+            # Also release (and unsubscribe) if the client goes away before the stream starts
+            result.call_on_close(admission.release)
+            if hasattr(source, 'close'):
+                result.call_on_close(source.close)
+            if routed:
+                result.headers['X-Provider'] = provider
+                result.headers['X-Model'] = model
+            return result
+
+        else:
+            # Serve repeated deterministic requests from the response cache
+            cache_control = request.headers.get('Cache-Control')
+            with span("cache"):
+                cache_key = response_cache_key(validated_data, cache_control)
+                cached = cached_chat_response(cache_key, cache_control)
+            if cached is not None:
+                result = jsonify(cached)
+                result.headers['X-Cache'] = cache_status(cache_key, True)
+                return result
+
+            # Non-streaming response
+            if routed:
+                (provider, model), response = routed_request(validated_data, messages, priority, cost)
+                upstream = providers[provider]
+            else:
+                # Identical in-flight requests share one upstream call
+                key = coalesce_key(provider, messages, system, tools, model, temperature, max_tokens, top_p, False)
+                response = coalesced_request(key, lambda: timed_request(provider, model, upstream.request, messages,
+                                                                        system, tools, model, temperature,
+                                                                        max_tokens, top_p),
+                                             lambda: admit(provider, model, priority, cost))
+
+            if cache_key is not None:
+                response_cache.set(cache_key, response)
+            if use_history:
+                record_reply(conversation_id, upstream.response_text(response))
+
+            with span("respond"):
+                result = jsonify(response)
+            result.headers['X-Cache'] = cache_status(cache_key, False)
+            result.headers.update(prompt_usage_headers(
+                record_prompt_usage(provider, model, upstream.prompt_usage(response), messages, system)))
+            if routed:
+                result.headers['X-Provider'] = provider
+                result.headers['X-Model'] = model
+            return result
+
+    except DeadlineExceeded as e:
+        logger.warning("Request timed out: %s", e)
+        return jsonify({"error": str(e)}), 504
+    except AdmissionRejected as e:
+        if deadline_expired():
+            return jsonify({"error": "Request deadline exceeded"}), 504
+        logger.warning("Rejected request: %s", e)
+        result = jsonify({"error": str(e), "retry_after": e.retry_after})
+        result.headers['Retry-After'] = str(e.retry_after)
+        return result, 429
+    except CircuitOpenError as e:
+        logger.warning("Rejected request: %s", e)
+        result = jsonify({"error": str(e), "retry_after": e.retry_after})
+        result.headers['Retry-After'] = str(e.retry_after)
+        return result, 503
+    except Exception as e:
+        if deadline_expired():
+            logger.warning("Request timed out: %s", e)
+            return jsonify({"error": "Request deadline exceeded", "details": str(e)}), 504
+        logger.error("An error occurred: %s", e)
+        return jsonify({"error": "An internal error occurred", "details": str(e)}), 500
+
+def construct_prompt(messages, system, tools):
+    # Simplified prompt construction, joined once so long histories stay linear
+    parts = [f"{system}\n"]
+    parts.extend(f"{message['role']}: {message['content']}\n" for message in messages)
+    if tools:
+        parts.append(f"Tools available: {', '.join(tools)}")
+    return ''.join(parts)
+
+# Conversation history storage
+# (workers only see each other's conversations through the SQLite store)
+CONVERSATION_STORE = os.getenv('CONVERSATION_STORE', 'sqlite' if WORKERS > 1 else 'memory').lower()
+CONVERSATION_DB_PATH = os.getenv('CONVERSATION_DB_PATH', os.path.join(STATE_DIR, 'conversations.sqlite3'))
+CONVERSATION_MAX_MESSAGES = int(os.getenv('CONVERSATION_MAX_MESSAGES', 200))
+CONVERSATION_MEMORY_BUDGET = int(os.getenv('CONVERSATION_MEMORY_BUDGET', 64 * 1024 * 1024))
+
+def message_size(message):
+    """Approximate in-memory footprint of a message in bytes"""
+    return 64 + sum(len(key) + len(value) for key, value in message.items() if isinstance(value, str))
+
+def estimate_tokens(message):
+    """Cheap token estimate for a message (~4 characters per token plus role overhead)"""
+    return 4 + (len(message.get('content') or '') + 3) // 4
+
+class MemoryConversationStore:
+    """In-process conversation store with LRU eviction under a global memory budget"""
+
+    def __init__(self, max_messages=200, memory_budget=64 * 1024 * 1024):
+        self.max_messages = max_messages
+        self.memory_budget = memory_budget
+        # conversation_id -> [deque of (message, size, tokens), total length, bytes]
+        self.conversations = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def _evict(self):
+        while self.total_bytes > self.memory_budget and len(self.conversations) > 1:
+            _, (_, _, size) = self.conversations.popitem(last=False)
+            self.total_bytes -= size
+        if self.total_bytes > self.memory_budget and self.conversations:
+            # One conversation is over the budget on its own: drop its oldest messages
+            conversation_id, entry = next(iter(self.conversations.items()))
+            history = entry[0]
+            while history and self.total_bytes > self.memory_budget:
+                _, size, _ = history.popleft()
+                entry[2] -= size
+                self.total_bytes -= size
+            if not history:
+                del self.conversations[conversation_id]
+
+    def append(self, conversation_id, messages):
+        with self.lock:
+            entry = self.conversations.get(conversation_id)
+            if entry is None:
+                entry = [deque(maxlen=self.max_messages or None), 0, 0]
+                self.conversations[conversation_id] = entry
+            self.conversations.move_to_end(conversation_id)
+            history = entry[0]
+            for message in messages:
+                if len(history) == history.maxlen:
+                    entry[2] -= history[0][1]
+                    self.total_bytes -= history[0][1]
+                size = message_size(message)
+                history.append((message, size, estimate_tokens(message)))
+                entry[1] += 1
+                entry[2] += size
+                self.total_bytes += size
+            self._evict()
+
+    def replace(self, conversation_id, messages):
+        self.delete(conversation_id)
+        self.append(conversation_id, messages)
+
+    def tail(self, conversation_id, n=None):
+        with self.lock:
+            entry = self.conversations.get(conversation_id)
+            if entry is None:
+                return []
+            self.conversations.move_to_end(conversation_id)
+            history = entry[0]
+            if n is None or n >= len(history):
+                return [item[0] for item in history]
+            return [history[i][0] for i in range(len(history) - n, len(history))]
+
+    def tail_within(self, conversation_id, token_budget):
+        """Newest messages whose cached token counts fit in the budget (at least one)"""
+        with self.lock:
+            entry = self.conversations.get(conversation_id)
+            if entry is None:
+                return []
+            self.conversations.move_to_end(conversation_id)
+            selected = []
+            used = 0
+            for message, _, tokens in reversed(entry[0]):
+                if selected and used + tokens > token_budget:
+                    break
+                selected.append(message)
+                used += tokens
+        selected.reverse()
+        return selected
+
+    def length(self, conversation_id):
+        with self.lock:
+            entry = self.conversations.get(conversation_id)
+            return entry[1] if entry else 0
+
+    def delete(self, conversation_id):
+        with self.lock:
+            entry = self.conversations.pop(conversation_id, None)
+            if entry is None:
+                return False
+            self.total_bytes -= entry[2]
+            return True
+
+    def stats(self):
+        return {"backend": "memory", "conversations": len(self.conversations),
+                "bytes": self.total_bytes, "memory_budget": self.memory_budget}
+
+class SqliteConversationStore:
+    """Conversation store in an SQLite file, shared by every worker process on the host"""
+
+    def __init__(self, path, max_messages=200):
+        self.path = path
+        self.max_messages = max_messages
+        self.local = threading.local()
+        db = self._db()
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "conversation_id TEXT PRIMARY KEY, length INTEGER NOT NULL, updated_at REAL NOT NULL)"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "conversation_id TEXT NOT NULL, seq INTEGER NOT NULL, message TEXT NOT NULL, tokens INTEGER NOT NULL, "
+            "PRIMARY KEY (conversation_id, seq)) WITHOUT ROWID"
+        )
+        db.commit()
+
+    def _db(self):
+        # One connection per thread; WAL lets readers run alongside a writer in another process
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+            # Connections opened before fork() stay with the parent
+            self.local.pid = os.getpid()
+        return db
+
+    @contextmanager
+    def _writing(self):
+        """Write transaction holding the database lock from the start, so reads inside it cannot go stale"""
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.rollback()
+            raise
+        db.commit()
+
+    def _append(self, db, conversation_id, messages):
+        row = db.execute("SELECT length FROM conversations WHERE conversation_id = ?",
+                         (conversation_id,)).fetchone()
+        start = row[0] if row else 0
+        db.executemany(
+            "INSERT INTO messages (conversation_id, seq, message, tokens) VALUES (?, ?, ?, ?)",
+            [(conversation_id, start + i, json_dumps(m).decode('utf-8'), estimate_tokens(m))
+             for i, m in enumerate(messages)]
+        )
+        length = start + len(messages)
+        db.execute(
+            "INSERT OR REPLACE INTO conversations (conversation_id, length, updated_at) VALUES (?, ?, ?)",
+            (conversation_id, length, time.time())
+        )
+        if self.max_messages:
+            db.execute("DELETE FROM messages WHERE conversation_id = ? AND seq < ?",
+                       (conversation_id, length - self.max_messages))
+
+    def append(self, conversation_id, messages):
+        with self._writing() as db:
+            self._append(db, conversation_id, messages)
+
+    def replace(self, conversation_id, messages):
+        with self._writing() as db:
+            db.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+            db.execute("DELETE FROM conversations WHERE conversation_id = ?", (conversation_id,))
+            self._append(db, conversation_id, messages)
+
+    def tail(self, conversation_id, n=None):
+        limit = -1 if n is None else n
+        rows = self._db().execute(
+            "SELECT message FROM messages WHERE conversation_id = ? ORDER BY seq DESC LIMIT ?",
+            (conversation_id, limit)
+        ).fetchall()
+        return [json_loads(row[0]) for row in reversed(rows)]
+
+    def tail_within(self, conversation_id, token_budget):
+        """Newest messages whose stored token counts fit in the budget (at least one)"""
+        cursor = self._db().execute(
+            "SELECT message, tokens FROM messages WHERE conversation_id = ? ORDER BY seq DESC",
+            (conversation_id,)
+        )
+        selected = []
+        used = 0
+        for message, tokens in cursor:
+            if selected and used + tokens > token_budget:
+                break
+            selected.append(json_loads(message))
+            used += tokens
+        cursor.close()
+        selected.reverse()
+        return selected
+
+    def length(self, conversation_id):
+        row = self._db().execute("SELECT length FROM conversations WHERE conversation_id = ?",
+                                 (conversation_id,)).fetchone()
+        return row[0] if row else 0
+
+    def delete(self, conversation_id):
+        with self._writing() as db:
+            db.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+            deleted = db.execute("DELETE FROM conversations WHERE conversation_id = ?",
+                                 (conversation_id,)).rowcount
+        return deleted > 0
+
+    def stats(self):
+        count = self._db().execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+        return {"backend": "sqlite", "path": self.path, "conversations": count}
+
+if CONVERSATION_STORE == 'sqlite':
+    conversation_store = SqliteConversationStore(CONVERSATION_DB_PATH, CONVERSATION_MAX_MESSAGES)
+else:
+    conversation_store = MemoryConversationStore(CONVERSATION_MAX_MESSAGES, CONVERSATION_MEMORY_BUDGET)
+
+def save_conversation_history(conversation_id, messages):
+    """Store conversation history, appending only messages not already stored"""
+    stored = conversation_store.length(conversation_id)
+    if stored and len(messages) >= stored:
+        last = conversation_store.tail(conversation_id, 1)
+        if last and messages[stored - 1] == last[0]:
+            if len(messages) > stored:
+                conversation_store.append(conversation_id, messages[stored:])
+            return
+    conversation_store.replace(conversation_id, messages)
+
+def get_conversation_history(conversation_id):
+    """Retrieve conversation history"""
+    return conversation_store.tail(conversation_id)
+
+# Context windows (in tokens) by model name prefix; the longest matching prefix wins
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4o": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385,
+    "claude-3": 200000,
+    "claude-2": 100000,
+    "claude-instant": 100000,
+    "mistral": 32000,
+    "llama3": 8192,
+    "llama2": 4096,
+    "nemotron-mini": 4096
+}
+DEFAULT_CONTEXT_WINDOW = int(os.getenv('DEFAULT_CONTEXT_WINDOW', 4096))
+
+def context_token_budget(model, system, max_tokens):
+    """Tokens available for history once the system prompt and reply are reserved"""
+    window = DEFAULT_CONTEXT_WINDOW
+    prefix_length = 0
+    for prefix, size in MODEL_CONTEXT_WINDOWS.items():
+        if model.startswith(prefix) and len(prefix) > prefix_length:
+            window, prefix_length = size, len(prefix)
+    return max(window - max_tokens - estimate_tokens({"content": system}), 0)
+
+def assemble_context(conversation_id, messages, model, system, max_tokens):
+    """Append new messages to stored history and return the context that fits the model"""
+    if messages:
+        conversation_store.append(conversation_id, messages)
+    context = conversation_store.tail_within(conversation_id, context_token_budget(model, system, max_tokens))
+    # Providers expect the conversation to open with a user turn
+    while len(context) > 1 and context[0].get('role') == 'assistant':
+        context.pop(0)
+    return context
+
+def record_reply(conversation_id, text):
+    """Store the assistant reply so the next turn can build on it"""
+    if text:
+        conversation_store.append(conversation_id, [{"role": "assistant", "content": text}])
+
+# Prompt prefix reuse: multi-turn traffic resends a growing, stable prefix.
+# Ollama keeps it in the KV cache of the runner that served the last turn,
+# Anthropic caches it when the prefix is marked with cache_control blocks.
+PROMPT_CACHING = os.getenv('PROMPT_CACHING', 'conversations').lower()
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '30m')
+
+prefix_scope = contextvars.ContextVar('prefix_scope', default=None)
+
+prompt_tokens = register_metric(MetricCounter(
+    "proxy_prompt_tokens_total", "Prompt tokens served from the provider's prefix cache vs processed fresh",
+    ("provider", "model", "source")))
+
+def prompt_cache_scope(validated_data):
+    """Key under which a request's prompt prefix is expected to repeat, or None to skip prefix reuse"""
+    if PROMPT_CACHING == 'off':
+        return None
+    if validated_data.conversation_id:
+        return validated_data.conversation_id
+    if PROMPT_CACHING == 'always':
+        return canonical_hash([validated_data.system])
+    return None
+
+def record_prompt_usage(provider, model, usage, messages, system):
+    """Count cached vs fresh prompt tokens; returns them, or None if the provider did not say"""
+    if usage is None:
+        return None
+    cached, fresh = usage
+    if cached is None:
+        # Only the freshly evaluated count is reported (Ollama): the rest of the prompt was reused
+        estimate = estimate_tokens({"content": system}) + sum(estimate_tokens(m) for m in messages)
+        cached = max(0, estimate - fresh)
+    prompt_tokens.inc((provider, model, "cached"), cached)
+    prompt_tokens.inc((provider, model, "fresh"), fresh)
+    return cached, fresh
+
+def prompt_usage_headers(usage):
+    """Response headers reporting a request's cached vs fresh prompt tokens"""
+    if usage is None:
+        return {}
+    return {'X-Prompt-Tokens-Cached': str(usage[0]), 'X-Prompt-Tokens-Fresh': str(usage[1])}
+
+def chat_messages(messages, system):
+    """Prepend the system prompt to the conversation messages"""
+    return [
+        {"role": "system", "content": system},
+        *[{"role": m["role"], "content": m["content"]} for m in messages]
+    ]
+
+def ollama_options(temperature, max_tokens, top_p):
+    """Sampling options in Ollama format"""
+    return {
+        "temperature": temperature,
+        "top_p": top_p,
+        "num_predict": max_tokens
+    }
+
+# Raw prompt mode: render the chat template in the proxy and call /api/generate
+# with raw=true. Each conversation's rendered prefix is cached and extended turn
+# by turn, and the prompt bytes of earlier turns never change, so the runner's
+# KV cache matches them exactly.
+OLLAMA_PROMPT_MODE = os.getenv('OLLAMA_PROMPT_MODE', 'chat').lower()
+OLLAMA_PROMPT_CACHE_SIZE = int(os.getenv('OLLAMA_PROMPT_CACHE_SIZE', 1000))
+OLLAMA_PROMPT_CACHE_BUDGET = int(os.getenv('OLLAMA_PROMPT_CACHE_BUDGET', 64 * 1024 * 1024))
+
+prompt_segments = register_metric(MetricCounter(
+    "proxy_ollama_prompt_segments_total", "Raw-mode prompt turns reused from a cached prefix vs rendered",
+    ("model", "source")))
+
+class PromptTemplate:
+    """A chat format compiled to a prefix and suffix per role, so rendering a turn is one concatenation.
+
+    ``sources`` are the Ollama Go templates known to render exactly this
+    format; a model whose template is not one of them keeps the chat API.
+    """
+
+    def __init__(self, name, turn, stop, roles=None, sources=()):
+        self.name = name
+        self.stop = stop
+        self.sources = sources
+        head, tail = turn.split('{content}')
+        roles = roles or {}
+        self.parts = {role: (head.replace('{role}', roles.get(role, role)), tail.replace('{role}', roles.get(role, role)))
+                      for role in ('system', 'user', 'assistant')}
+        # The open assistant turn the model completes
+        self.generation = self.parts['assistant'][0]
+
+    def segment(self, role, content):
+        head, tail = self.parts.get(role) or self.parts['user']
+        return head + (content or '') + tail
+
+# Ollama renders a template without .Messages once per (system, prompt, response)
+# turn, so these legacy templates produce exactly one segment per message
+PROMPT_TEMPLATES = {template.name: template for template in (
+    PromptTemplate("llama3", "<|start_header_id|>{role}<|end_header_id|>\n\n{content}<|eot_id|>",
+                   ["<|eot_id|>", "<|start_header_id|>"], sources=(
+                       "{{ if .System }}<|start_header_id|>system<|end_header_id|>\n\n{{ .System }}<|eot_id|>{{ end }}"
+                       "{{ if .Prompt }}<|start_header_id|>user<|end_header_id|>\n\n{{ .Prompt }}<|eot_id|>{{ end }}"
+                       "<|start_header_id|>assistant<|end_header_id|>\n\n{{ .Response }}<|eot_id|>",)),
+    PromptTemplate("chatml", "<|im_start|>{role}\n{content}<|im_end|>\n", ["<|im_end|>", "<|im_start|>"], sources=(
+        "{{ if .System }}<|im_start|>system\n{{ .System }}<|im_end|>\n{{ end }}"
+        "{{ if .Prompt }}<|im_start|>user\n{{ .Prompt }}<|im_end|>\n{{ end }}"
+        "<|im_start|>assistant\n{{ .Response }}<|im_end|>\n",)),
+    PromptTemplate("phi3", "<|{role}|>\n{content}<|end|>\n", ["<|end|>", "<|user|>"], sources=(
+        "{{ if .System }}<|system|>\n{{ .System }}<|end|>\n{{ end }}"
+        "{{ if .Prompt }}<|user|>\n{{ .Prompt }}<|end|>\n{{ end }}"
+        "<|assistant|>\n{{ .Response }}<|end|>\n",)),
+    # Gemma has no system role: the system prompt goes first as a user turn
+    PromptTemplate("gemma", "<start_of_turn>{role}\n{content}<end_of_turn>\n", ["<end_of_turn>"],
+                   roles={"system": "user", "assistant": "model"}, sources=(
+                       "{{- range $i, $_ := .Messages }}\n"
+                       "{{- $last := eq (len (slice $.Messages $i)) 1 }}\n"
+                       "{{- if or (eq .Role \"user\") (eq .Role \"system\") }}<start_of_turn>user\n"
+                       "{{ .Content }}<end_of_turn>\n"
+                       "{{ if $last }}<start_of_turn>model\n"
+                       "{{ end }}\n"
+                       "{{- else if eq .Role \"assistant\" }}<start_of_turn>model\n"
+                       "{{ .Content }}{{ if not $last }}<end_of_turn>\n"
+                       "{{ end }}\n"
+                       "{{- end }}\n"
+                       "{{- end }}",)),
+)}
+
+def template_fingerprint(source):
+    """Short hash of a Go template; only line endings are normalized, since whitespace renders"""
+    return hashlib.sha256(source.replace('\r\n', '\n').encode()).hexdigest()[:16]
+
+# Template fingerprint -> format. OLLAMA_PROMPT_FORMATS adds more, as
+# fingerprint=format pairs, for templates checked to render the same bytes.
+PROMPT_TEMPLATE_FINGERPRINTS = {template_fingerprint(source): template
+                                for template in PROMPT_TEMPLATES.values() for source in template.sources}
+for entry in filter(None, (entry.strip() for entry in os.getenv('OLLAMA_PROMPT_FORMATS', '').split(','))):
+    fingerprint, _, name = entry.partition('=')
+    if name.strip() in PROMPT_TEMPLATES:
+        PROMPT_TEMPLATE_FINGERPRINTS[fingerprint.strip()] = PROMPT_TEMPLATES[name.strip()]
+    else:
+        logger.warning("Ignoring OLLAMA_PROMPT_FORMATS entry %r: unknown format", entry)
+
+def compile_prompt_template(source):
+    """The known chat format a model's Go template renders, or None to keep using the chat API.
+
+    Only an exact match counts: templates that share a format's markers can
+    still differ (Zephyr's <|assistant|>, the Llama 3.1 tool preamble).
+    """
+    return PROMPT_TEMPLATE_FINGERPRINTS.get(template_fingerprint(source))
+
+def extend_prompt_digest(digest, turns):
+    """Feed (role, content) turns to a running hash of a conversation"""
+    for role, content in turns:
+        digest.update(b'\0' + role.encode('utf-8') + b'\0' + (content or '').encode('utf-8'))
+
+class PromptRenderer:
+    """Per-model prompt templates and the rendered prefix of each conversation"""
+
+    def __init__(self, cache_size, memory_budget):
+        # model -> PromptTemplate, or None for models whose template is not a known format
+        self.templates = {}
+        # (prefix scope, model) -> (turn count, digest of the system prompt and those turns,
+        # rendered text without the open assistant turn), least recently used first
+        self.prefixes = OrderedDict()
+        self.cache_size = cache_size
+        self.memory_budget = memory_budget
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def learn(self, model, response):
+        """Compile a model's template from its /api/show response; an error is retried next request"""
+        if response.status_code != 200:
+            logger.warning("Could not read the template of %s: %s", model, response.status_code)
+            return None
+        source = json_loads(response.content).get("template") or ""
+        template = compile_prompt_template(source)
+        if template is None:
+            logger.info("No raw prompt format for %s (template %s), using the chat API",
+                        model, template_fingerprint(source))
+        self.templates[model] = template
+        return template
+
+    def cached(self, key):
+        with self.lock:
+            entry = self.prefixes.get(key)
+            if entry is not None:
+                self.prefixes.move_to_end(key)
+            return entry
+
+    def store(self, key, entry):
+        with self.lock:
+            previous = self.prefixes.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= len(previous[2])
+            if len(entry[2]) > self.memory_budget:
+                # Larger than the whole budget: rendered from scratch every turn instead
+                return
+            self.prefixes[key] = entry
+            self.total_bytes += len(entry[2])
+            while self.total_bytes > self.memory_budget or len(self.prefixes) > self.cache_size:
+                _, evicted = self.prefixes.popitem(last=False)
+                self.total_bytes -= len(evicted[2])
+
+    def render(self, template, model, messages, system):
+        turns = [(message["role"], message["content"]) for message in messages]
+        scope = prefix_scope.get()
+        cached = self.cached((scope, model)) if scope is not None else None
+        # Hash the turns the cached prefix claims to cover: a match means the
+        # history is unchanged, and the same digest then runs on over the new turns
+        digest = hashlib.blake2b((system or '').encode('utf-8'), digest_size=16)
+        count = cached[0] if cached is not None and cached[0] <= len(turns) else 0
+        extend_prompt_digest(digest, turns[:count])
+        if count and digest.digest() == cached[1]:
+            reused = count
+            text = cached[2]
+        else:
+            reused = 0
+            text = template.segment("system", system) if system else ''
+        extend_prompt_digest(digest, turns[count:])
+        text = ''.join([text, *(template.segment(role, content) for role, content in turns[reused:])])
+        if scope is not None:
+            self.store((scope, model), (len(turns), digest.digest(), text))
+        prompt_segments.inc((model, "reused"), reused)
+        prompt_segments.inc((model, "rendered"), len(turns) - reused)
+        return text + template.generation
+
+prompt_renderer = PromptRenderer(OLLAMA_PROMPT_CACHE_SIZE, OLLAMA_PROMPT_CACHE_BUDGET)
+
+def ollama_chat_response(response):
+    """Reshape an /api/generate response or stream line like /api/chat, which is what clients get"""
+    response.pop("context", None)
+    response["message"] = {"role": "assistant", "content": response.pop("response", "")}
+    return response
+
+def as_dict(response):
+    """Convert Ollama client response objects into plain dicts"""
+    if hasattr(response, 'model_dump'):
+        return response.model_dump(exclude_none=True)
+    return response
+
+def sse_event(payload):
+    """Frame pre-encoded JSON bytes as a Server-Sent Event"""
+    if b"\n" in payload:
+        payload = payload.replace(b"\n", b"\ndata: ")
+    return b"data: " + payload + b"\n\n"
+
+class SSEParser:
+    """Incremental Server-Sent Events parser that works on raw bytes.
+
+    Network chunks are fed as they arrive; complete events are split on blank
+    lines and returned as ``(event, data)`` pairs where ``data`` is the raw
+    bytes of the data field, ready to relay or parse without a decode step.
+    """
+
+    def __init__(self):
+        self.buffer = b''
+
+    def feed(self, data):
+        if self.buffer:
+            data = self.buffer + data
+        if b'\r' in data:
+            data = data.replace(b'\r\n', b'\n')
+        events = []
+        start = 0
+        while True:
+            end = data.find(b'\n\n', start)
+            if end == -1:
+                break
+            block = data[start:end]
+            start = end + 2
+            if block.startswith(b'data: ') and b'\n' not in block:
+                # Fast path: a single data line, the common case for every provider
+                events.append((None, block[6:]))
+                continue
+            event = None
+            payload = None
+            for line in block.split(b'\n'):
+                if line.startswith(b'data:'):
+                    value = line[6:] if line[5:6] == b' ' else line[5:]
+                    payload = value if payload is None else payload + b'\n' + value
+                elif line.startswith(b'event:'):
+                    event = line[6:].strip()
+            if payload is not None:
+                events.append((event, payload))
+        self.buffer = data[start:]
+        return events
+
+class NDJSONParser:
+    """Split a byte stream into newline-delimited JSON lines, keeping partial lines buffered"""
+
+    def __init__(self):
+        self.buffer = b''
+
+    def feed(self, data):
+        if self.buffer:
+            data = self.buffer + data
+        lines = data.split(b'\n')
+        self.buffer = lines.pop()
+        return [line for line in lines if line.strip()]
+
+# Model warm-up: keep the Ollama models that get traffic resident, within a
+# per-host memory budget, so interactive requests rarely wait for a model load.
+OLLAMA_SCHEDULER = os.getenv('OLLAMA_SCHEDULER', 'false').lower() in ('1', 'true', 'yes', 'on')
+OLLAMA_SCHEDULER_INTERVAL = float(os.getenv('OLLAMA_SCHEDULER_INTERVAL', 30))
+OLLAMA_PRELOAD = [model.strip() for model in os.getenv('OLLAMA_PRELOAD', '').split(',') if model.strip()]
+OLLAMA_HOT_RATE = float(os.getenv('OLLAMA_HOT_RATE', 0.2))
+OLLAMA_RATE_HALF_LIFE = float(os.getenv('OLLAMA_RATE_HALF_LIFE', 900))
+OLLAMA_MODEL_STATS_PATH = os.getenv('OLLAMA_MODEL_STATS_PATH', os.path.join(STATE_DIR, 'ollama_models.json'))
+
+def parse_size(value):
+    """Bytes from a size such as 24GB, 512MiB or 1000000; 0 when unset"""
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)(i?)B?\s*', str(value or 0), re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Invalid size: {value}")
+    base = 1024 if match[3] or not match[2] else 1000
+    return int(float(match[1]) * base ** " KMGT".index(match[2].upper() or " "))
+
+def parse_duration(value):
+    """Seconds in an Ollama keep_alive duration ("30m", "1h", "300"); None if it never expires"""
+    match = re.fullmatch(r'\s*(-?[\d.]+)\s*(ms|s|m|h)?\s*', str(value))
+    if match is None:
+        return None
+    seconds = float(match[1]) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600, None: 1}[match[2]]
+    return None if seconds < 0 else seconds
+
+OLLAMA_MEMORY_BUDGET = parse_size(os.getenv('OLLAMA_MEMORY_BUDGET', '0'))
+
+model_actions = register_metric(MetricCounter(
+    "proxy_ollama_model_actions_total", "Model loads, keep-alive pings and unloads issued by the scheduler",
+    ("host", "model", "action")))
+
+class ModelScheduler:
+    """Keeps hot Ollama models loaded and unloads cold ones to stay within the memory budget.
+
+    Each model's request rate is an exponentially decaying count (half-life
+    OLLAMA_RATE_HALF_LIFE). On every tick the models at or above
+    OLLAMA_HOT_RATE requests per minute, plus OLLAMA_PRELOAD, are ranked and
+    placed on hosts: a model stays where it is loaded, or goes to the host
+    with the most budget left. Models that do not fit, or are not hot,
+    become candidates for unloading, coldest first. Unloading only happens
+    when room is needed for a hot model. Loaded hot models get a keep_alive
+    ping before they would expire. Rates are saved to
+    OLLAMA_MODEL_STATS_PATH, so the next start preloads the models that were
+    hot.
+    """
+
+    def __init__(self, pool, path):
+        self.pool = pool
+        self.path = path
+        self.lock = threading.Lock()
+        # model -> [decaying request count, monotonic time of the count, wall time last requested]
+        self.models = {}
+        # (host name, model) -> monotonic time of the last request or ping, which resets Ollama's expiry
+        self.activity = {}
+        self.actions = deque(maxlen=100)
+        self.keep_alive = parse_duration(OLLAMA_KEEP_ALIVE)
+        self.wake = threading.Event()
+        self.pid = None
+        self._restore()
+
+    def _restore(self):
+        """Resume from the rates saved by the last run (downtime does not decay them)"""
+        try:
+            with open(self.path, 'rb') as f:
+                saved = json_loads(f.read())
+        except (OSError, ValueError):
+            return
+        now = time.monotonic()
+        for model, rate in saved.get("rates", {}).items():
+            self.models[model] = [rate / 60 * OLLAMA_RATE_HALF_LIFE / math.log(2), now, None]
+
+    def _save(self):
+        now = time.monotonic()
+        with self.lock:
+            rates = {model: self._rate(entry, now) for model, entry in self.models.items()}
+        temp_path = f"{self.path}.tmp"
+        with suppress(OSError):
+            with open(temp_path, 'wb') as f:
+                f.write(json_dumps({"rates": {model: rate for model, rate in rates.items() if rate >= 0.001}}))
+            os.replace(temp_path, self.path)
+
+    def _rate(self, entry, now):
+        """Requests per minute over this worker's traffic, scaled to all workers (lock held)"""
+        count = entry[0] * 0.5 ** ((now - entry[1]) / OLLAMA_RATE_HALF_LIFE)
+        return count * math.log(2) / OLLAMA_RATE_HALF_LIFE * 60 * WORKERS
+
+    def record(self, model, host=None):
+        """Count a request for a model (and the host serving it, whose expiry it just reset)"""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.models.get(model)
+            if entry is None:
+                entry = self.models[model] = [0.0, now, None]
+            entry[0] = entry[0] * 0.5 ** ((now - entry[1]) / OLLAMA_RATE_HALF_LIFE) + 1
+            entry[1] = now
+            entry[2] = time.time()
+            if host is not None:
+                self.activity[(host.name, model)] = now
+
+    def rates(self):
+        now = time.monotonic()
+        with self.lock:
+            return {model: self._rate(entry, now) for model, entry in self.models.items()}
+
+    def start(self):
+        """Run the scheduler thread in this process (idempotent, restarted after fork)"""
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+        threading.Thread(target=self.run, name='ollama-scheduler', daemon=True).start()
+
+    def run(self):
+        while True:
+            try:
+                self.tick()
+            except Exception as e:
+                logger.warning("Model scheduler tick failed: %s", e)
+            self.wake.wait(OLLAMA_SCHEDULER_INTERVAL)
+            self.wake.clear()
+
+    def tick(self):
+        for host in self.pool.hosts:
+            self.pool.probe(host)
+        for host, model, action in self.plan():
+            self.act(host, model, action, "schedule")
+        self._save()
+
+    def plan(self):
+        """(host, model, action) steps that move the hosts towards the hot set"""
+        now = time.monotonic()
+        rates = self.rates()
+        with self.pool.lock:
+            hosts = [host for host in self.pool.hosts if host.healthy(now)]
+            loaded = {host: set(host.loaded) for host in hosts}
+            available = {host: set(host.available) for host in hosts}
+            sizes = {host: dict(host.sizes) for host in hosts}
+        pinned = [ollama_model_name(model) for model in OLLAMA_PRELOAD]
+        hot = pinned + sorted((model for model, rate in rates.items() if rate >= OLLAMA_HOT_RATE and model not in pinned),
+                              key=rates.get, reverse=True)
+
+        budget = OLLAMA_MEMORY_BUDGET or math.inf
+        room = {host: budget for host in hosts}
+        wanted = {host: set() for host in hosts}
+        for model in hot:
+            placed = [host for host in hosts if model in loaded[host]]
+            if not placed:
+                candidates = [host for host in hosts if model in available[host]]
+                placed = [max(candidates, key=room.get)] if candidates else []
+            for host in placed:
+                size = sizes[host].get(model, 0)
+                if size <= room[host]:
+                    wanted[host].add(model)
+                    room[host] -= size
+
+        steps = []
+        for host in hosts:
+            used = sum(sizes[host].get(model, 0) for model in loaded[host])
+            # Loads the proxy did not plan (a request for a cold model) can leave a host over budget
+            for model in sorted(wanted[host] - loaded[host], key=hot.index) + [None]:
+                size = sizes[host].get(model, 0)
+                # Make room by unloading models that are not wanted, coldest first; skip ones serving requests
+                for victim in sorted(loaded[host] - wanted[host], key=lambda name: rates.get(name, 0)):
+                    if used + size <= budget:
+                        break
+                    if now - self.activity.get((host.name, victim), -math.inf) < OLLAMA_SCHEDULER_INTERVAL:
+                        continue
+                    steps.append((host, victim, "unload"))
+                    loaded[host].discard(victim)
+                    used -= sizes[host].get(victim, 0)
+                if model is not None and used + size <= budget:
+                    steps.append((host, model, "load"))
+                    used += size
+            if self.keep_alive is not None:
+                for model in wanted[host] & loaded[host]:
+                    # Ping while at least a tick remains before Ollama would unload it
+                    idle = now - self.activity.get((host.name, model), -math.inf)
+                    if idle >= self.keep_alive - 2 * OLLAMA_SCHEDULER_INTERVAL:
+                        steps.append((host, model, "ping"))
+        return steps
+
+    def act(self, host, model, action, reason):
+        """Load or ping (keep_alive) or unload (keep_alive 0) a model on a host; returns an action record"""
+        started = time.monotonic()
+        record = {"time": time.time(), "host": host.name, "model": model, "action": action, "reason": reason}
+        try:
+            response = host.http.post('/api/generate', content=json_dumps(
+                {"model": model, "keep_alive": 0 if action == "unload" else OLLAMA_KEEP_ALIVE}))
+            if response.status_code != 200:
+                raise ollama.ResponseError(response.text, response.status_code)
+        except Exception as e:
+            record["error"] = str(e)
+            logger.warning("Model %s of %s on %s failed: %s", action, model, host.name, e)
+        else:
+            with self.pool.lock:
+                if action == "unload":
+                    host.loaded.discard(model)
+                else:
+                    host.loaded.add(model)
+            with self.lock:
+                self.activity[(host.name, model)] = time.monotonic()
+            model_actions.inc((host.name, model, action))
+            logger.info("Model %s: %s on %s (%s)", action, model, host.name, reason,
+                        extra={"duration_ms": round((time.monotonic() - started) * 1000, 2)})
+        record["seconds"] = round(time.monotonic() - started, 3)
+        self.actions.append(record)
+        return record
+
+    def preload(self, model):
+        """Load a model now and count it as hot so the scheduler keeps it warm while the boost decays"""
+        model = ollama_model_name(model)
+        with self.lock:
+            entry = self.models.setdefault(model, [0.0, time.monotonic(), None])
+            floor = OLLAMA_HOT_RATE * 2 / 60 * OLLAMA_RATE_HALF_LIFE / math.log(2) / WORKERS
+            entry[0] = max(entry[0] * 0.5 ** ((time.monotonic() - entry[1]) / OLLAMA_RATE_HALF_LIFE), floor)
+            entry[1] = time.monotonic()
+        with self.pool.lock:
+            hosts = self.pool.healthy_hosts()
+            placed = [host for host in hosts if model in host.loaded]
+            if not placed:
+                placed = [min([host for host in hosts if model in host.available] or hosts,
+                              key=lambda host: host.outstanding)]
+        return [self.act(host, model, "ping" if model in host.loaded else "load", "demand") for host in placed]
+
+    def unload(self, model):
+        """Unload a model from every host holding it and forget its rate"""
+        model = ollama_model_name(model)
+        with self.lock:
+            self.models.pop(model, None)
+        with self.pool.lock:
+            hosts = [host for host in self.pool.hosts if model in host.loaded]
+        return [self.act(host, model, "unload", "demand") for host in hosts]
+
+    def stats(self):
+        rates = self.rates()
+        with self.lock:
+            last_used = {model: entry[2] for model, entry in self.models.items()}
+        hosts = self.pool.stats()
+        pinned = [ollama_model_name(model) for model in OLLAMA_PRELOAD]
+        return {
+            "enabled": OLLAMA_SCHEDULER,
+            "running": self.pid == os.getpid(),
+            "interval": OLLAMA_SCHEDULER_INTERVAL,
+            "hot_rate": OLLAMA_HOT_RATE,
+            "memory_budget": OLLAMA_MEMORY_BUDGET or None,
+            "keep_alive": OLLAMA_KEEP_ALIVE,
+            "models": [{
+                "model": model,
+                "requests_per_minute": round(rates.get(model, 0.0), 3),
+                "hot": model in pinned or rates.get(model, 0.0) >= OLLAMA_HOT_RATE,
+                "pinned": model in pinned,
+                "last_used": last_used.get(model),
+                "loaded_on": [host["host"] for host in hosts if model in host["loaded_models"]]
+            } for model in sorted(set(rates) | set(pinned), key=lambda name: -rates.get(name, 0.0))],
+            "recent_actions": list(self.actions)[-20:]
+        }
+
+model_scheduler = ModelScheduler(ollama_pool, OLLAMA_MODEL_STATS_PATH)
+
+# Provider registry: chat() and the ASGI handler dispatch through providers[name]
+providers = {}
+
+def register_provider(cls):
+    providers[cls.name] = cls()
+    return cls
+
+class Provider(ABC):
+    """Base class for an upstream chat provider.
+
+    ``request`` returns the upstream JSON response; ``stream`` yields each chunk
+    as pre-encoded JSON bytes so it can be relayed without re-serializing.
+    ``arequest`` and ``astream`` are the non-blocking twins used in ASGI mode.
+    A provider missing any of them fails when it is registered.
+    """
+
+    name = None
+    label = None
+
+    def api_key(self):
+        return None
+
+    def check_configured(self):
+        pass
+
+    @abstractmethod
+    def request(self, messages, system, tools, model, temperature=0.7, max_tokens=1000, top_p=0.9):
+        """Non-streaming chat call"""
+
+    @abstractmethod
+    def stream(self, messages, system, tools, model, temperature=0.7, max_tokens=1000, top_p=0.9):
+        """Streaming chat call: a generator of encoded chunks"""
+
+    @abstractmethod
+    async def arequest(self, messages, system, tools, model, temperature=0.7, max_tokens=1000, top_p=0.9):
+        """Non-blocking request()"""
+
+    @abstractmethod
+    def astream(self, messages, system, tools, model, temperature=0.7, max_tokens=1000, top_p=0.9):
+        """Non-blocking stream(): an async generator of encoded chunks"""
+
+    def list_models(self):
+        """Model names currently offered by the provider"""
+        return []
+
+    def response_text(self, response):
+        """Assistant text from a non-streaming response"""
+        return ""
+
+    def chunk_text(self, chunk):
+        """Assistant text carried by one encoded stream chunk"""
+        return ""
+
+    def prompt_usage(self, response):
+        """(cached, fresh) prompt tokens of a non-streaming response, or None if not reported"""
+        return None
+
+    def chunk_usage(self, chunk):
+        """(cached, fresh) prompt tokens if this stream chunk reports them, else None"""
+        return None
+
+class HTTPProvider(Provider):
+    """Provider reached over HTTPS with an API key and an SSE streaming endpoint"""
+
+    url = None
+
+    def check_configured(self):
+        if not self.api_key():
+            raise ValueError(f"{self.label} API key not configured")
+
+    @abstractmethod
+    def headers(self):
+        """Request headers, including the API key"""
+
+    @abstractmethod
+    def payload(self, messages, system, tools, model, temperature, max_tokens, top_p, stream=False):
+        """Request body for the provider's chat endpoint"""
+
+    def request(self, messages, system, tools, model, temperature=0.7, max_tokens=1000, top_p=0.9):
+        self.check_configured()
+
+        with span("encode", provider=self.name):
+            body = json_dumps(self.payload(messages, system, tools, model, temperature, max_tokens, top_p))
+        with span("upstream", provider=self.name, model=model):
+            response = get_session(self.name).post(self.url, headers=self.headers(), data=body,
+                                                   timeout=upstream_timeout())
+
+        if response.status_code != 200:
+            raise UpstreamError(f"{self.label} API error: {response.text}", response.status_code)
+
+        with span("decode", provider=self.name):
+            return json_loads(response.content)
+
+    def stream(self, messages, system, tools, model, temperature=0.7, max_tokens=1000, top_p=0.9):
+        self.check_configured()
+
+        with span("encode", provider=self.name):
+            body = json_dumps(self.payload(messages, system, tools, model, temperature, max_tokens, top_p,
+                                           stream=True))
+        # Until the response headers arrive; the rest of the wait for the first chunk is in first_token
+        with span("upstream", provider=self.name, model=model):
+            response = get_session(self.name).post(self.url, headers=self.headers(), data=body, stream=True,
+                                                   timeout=upstream_timeout())
+
+        if response.status_code != 200:
+            raise UpstreamError(f"{self.label} API error: {response.status_code}", response.status_code)
+
+        try:
+            parser = SSEParser()
+            for data in response.iter_content(chunk_size=None):
+                for _, payload in parser.feed(data):
+                    if payload == b'[DONE]':
+                        return
+                    yield payload
+        finally:
+            response.close()
+
+    async def arequest(self, messages, system, tools, model, temperature=0.7, max_tokens=1000, top_p=0.9):
+        self.check_configured()
+
+        with span("encode", provider=self.name):
+            body = json_dumps(self.payload(messages, system, tools, model, temperature, max_tokens, top_p))
+        with span("upstream", provider=self.name, model=model):
+            response = await get_async_client(self.name).post(self.url, headers=self.headers(), content=body,
+                                                              timeout=httpx_timeout(),
+                                                              extensions=httpx_trace(asynchronous=True))
+
+        if response.status_code != 200:
+            raise UpstreamError(f"{self.label} API error: {response.text}", response.status_code)
+
+        with span("decode", provider=self.name):
+            return json_loads(response.content)
+
+    async def astream(self, messages, system, tools, model, temperature=0.7, max_tokens=1000, top_p=0.9):
+        self.check_configured()
+
+        with span("encode", provider=self.name):
+            body = json_dumps(self.payload(messages, system, tools, model, temperature, max_tokens, top_p,
+                                           stream=True))
+        started = time.perf_counter_ns()
+        async with get_async_client(self.name).stream("POST", self.url, headers=self.headers(), content=body,
+                                                      timeout=httpx_timeout(),
+                                                      extensions=httpx_trace(asynchronous=True)) as response:
+            record_span("upstream", started, provider=self.name, model=model)
+            if response.status_code != 200:
+                raise UpstreamError(f"{self.label} API error: {response.status_code}", response.status_code)
+
+            parser = SSEParser()
+            async for data in response.aiter_bytes():
+                for _, payload in parser.feed(data):
+                    if payload == b'[DONE]':
+                        return
+                    yield payload
+
+@register_provider
+class OllamaProvider(Provider):
+    name = "ollama"
+    label = "Ollama"
+
+    def api_key(self):
+        return OLLAMA_API_KEY
+
+    def payload(self, messages, system, model, temperature, max_tokens, top_p, stream=False, template=None):
+        if template is None:
+            payload = {
+                "model": model,
+                "messages": chat_messages(messages, system),
+                "options": ollama_options(temperature, max_tokens, top_p),
+                "stream": stream
+            }
+        else:
+            payload = {
+                "model": model,
+                "prompt": prompt_renderer.render(template, ollama_model_name(model), messages, system),
+                "raw": True,
+                "options": {**ollama_options(temperature, max_tokens, top_p), "stop": template.stop},
+                "stream": stream
+            }
+        if prefix_scope.get() is not None or OLLAMA_SCHEDULER:
+            # Keep the runner (and the conversation's KV cache) resident between turns;
+            # with the scheduler on, residency is its call, so every request sets the same expiry
+            payload["keep_alive"] = OLLAMA_KEEP_ALIVE
+        return payload
+
+    def raw_template(self, host, model):
+        """The compiled template for raw mode, or None to use the chat API"""
+        if OLLAMA_PROMPT_MODE != 'raw':
+            return None
+        model = ollama_model_name(model)
+        if model in prompt_renderer.templates:
+            return prompt_renderer.templates[model]
+        return prompt_renderer.learn(model, host.http.post('/api/show', timeout=httpx_timeout(),
+                                                           content=json_dumps({"model": model})))
+
+    async def araw_template(self, host, model):
+        if OLLAMA_PROMPT_MODE != 'raw':
+            return None
+        model = ollama_model_name(model)
+        if model in prompt_renderer.templates:
+            return prompt_renderer.templates[model]
+        return prompt_renderer.learn(model, await host.async_http().post(
+            '/api/show', timeout=httpx_timeout(), content=json_dumps({"model": model})))
+
+    def request(self, messages, system, tools, model, temperature=0.7, max_tokens=1000, top_p=0.9):
+        # Call the chat API (or generate API in raw mode) of the host picked for this model
+        with ollama_pool.lease(model, prefix_scope.get()) as host:
+            template = self.raw_template(host, model)
+            with span("encode", provider=self.name):
+                body = json_dumps(self.payload(messages, system, model, temperature, max_tokens, top_p,
+                                               template=template))
+            with span("upstream", provider=self.name, model=model, host=host.name):
+                response = host.http.post('/api/chat' if template is None else '/api/generate',
+                                          timeout=httpx_timeout(), content=body, extensions=httpx_trace())
+            if response.status_code != 200:
+                raise ollama.ResponseError(response.text, response.status_code)
+            with span("decode", provider=self.name):
+                response = json_loads(response.content)
+                return response if template is None else ollama_chat_response(response)
+
+    def stream(self, messages, system, tools, model, temperature=0.7, max_tokens=1000, top_p=0.9):
+        with ollama_pool.lease(model, prefix_scope.get()) as host:
+            template = self.raw_template(host, model)
+            with span("encode", provider=self.name):
+                body = json_dumps(self.payload(messages, system, model, temperature, max_tokens, top_p,
+                                               stream=True, template=template))
+            # Leaving this block (client gone, deadline hit) closes the connection,
+            # which makes Ollama stop generating
+            started = time.perf_counter_ns()
+            with host.http.stream('POST', '/api/chat' if template is None else '/api/generate',
+                                  timeout=httpx_timeout(), content=body, extensions=httpx_trace()) as response:
+                record_span("upstream", started, provider=self.name, model=model, host=host.name)
+                if response.status_code != 200:
+                    raise ollama.ResponseError(response.read().decode('utf-8', 'replace'), response.status_code)
+                parser = NDJSONParser()
+                for data in response.iter_raw():
+                    for line in parser.feed(data):
+                        yield self.checked_line(line, template)
+
+    async def arequest(self, messages, system, tools, model, temperature=0.7, max_tokens=1000, top_p=0.9):
+        async with ollama_pool.alease(model, prefix_scope.get()) as host:
+            template = await self.araw_template(host, model)
+            with span("encode", provider=self.name):
+                body = json_dumps(self.payload(messages, system, model, temperature, max_tokens, top_p,
+                                               template=template))
+            with span("upstream", provider=self.name, model=model, host=host.name):
+                response = await host.async_http().post('/api/chat' if template is None else '/api/generate',
+                                                        timeout=httpx_timeout(), content=body,
+                                                        extensions=httpx_trace(asynchronous=True))
+            if response.status_code != 200:
+                raise ollama.ResponseError(response.text, response.status_code)
+            with span("decode", provider=self.name):
+                response = json_loads(response.content)
+                return response if template is None else ollama_chat_response(response)
+
+    async def astream(self, messages, system, tools, model, temperature=0.7, max_tokens=1000, top_p=0.9):
+        async with ollama_pool.alease(model, prefix_scope.get()) as host:
+            template = await self.araw_template(host, model)
+            with span("encode", provider=self.name):
+                payload = json_dumps(self.payload(messages, system, model, temperature, max_tokens, top_p,
+                                                  stream=True, template=template))
+            started = time.perf_counter_ns()
+            async with host.async_http().stream('POST', '/api/chat' if template is None else '/api/generate',
+                                                timeout=httpx_timeout(), content=payload,
+                                                extensions=httpx_trace(asynchronous=True)) as response:
+                record_span("upstream", started, provider=self.name, model=model, host=host.name)
+                if response.status_code != 200:
+                    raise ollama.ResponseError((await response.aread()).decode('utf-8', 'replace'),
+                                               response.status_code)
+                parser = NDJSONParser()
+                async for data in response.aiter_raw():
+                    for line in parser.feed(data):
+                        yield self.checked_line(line, template)
+
+    def checked_line(self, line, template=None):
+        """Relay a streamed NDJSON line, raising on an in-stream error"""
+        if line.startswith(b'{"error"'):
+            raise ollama.ResponseError(line.decode('utf-8', 'replace'))
+        # Raw-mode lines come from /api/generate and are reshaped to chat chunks
+        return line if template is None else json_dumps(ollama_chat_response(json_loads(line)))
+
+    def list_models(self):
+        # Union of the models pulled on every host still in rotation
+        models = {}
+        error = None
+        for host in ollama_pool.healthy_hosts():
+            try:
+                ollama_models = as_dict(host.client.list())
+            except Exception as e:
+                error = e
+                continue
+            for model in ollama_models.get('models', []):
+                name = model.get('model') or model.get('name')
+                models.setdefault(name, None)
+        if not models and error is not None:
+            raise error
+        return list(models)
+
+    def response_text(self, response):
+        return ((response or {}).get("message") or {}).get("content") or ""
+
+    def chunk_text(self, chunk):
+        return (json_loads(chunk).get("message") or {}).get("content") or ""
+
+    def prompt_usage(self, response):
+        # Ollama only reports the prompt tokens it had to evaluate; the rest came from the KV cache
+        fresh = (response or {}).get("prompt_eval_count")
+        return None if fresh is None else (None, fresh)
+
+    def chunk_usage(self, chunk):
+        if b'"prompt_eval_count"' not in chunk:
+            return None
+        return self.prompt_usage(json_loads(chunk))
+
+@register_provider
+class OpenAIProvider(HTTPProvider):
+    name = "openai"
+    label = "OpenAI"
+    url = f"{OPENAI_BASE_URL}/v1/chat/completions"
+
+    def api_key(self):
+        return OPENAI_API_KEY
+
+    def headers(self):
+        return {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key()}"
+        }
+
+    def payload(self, messages, system, tools, model, temperature, max_tokens, top_p, stream=False):
+        payload = {
+            "model": model,
+            "messages": chat_messages(messages, system),
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "top_p": top_p
+        }
+        if stream:
+            payload["stream"] = True
+
+        if tools and len(tools) > 0:
+            # Format tools for OpenAI - simplistic implementation
+            payload["tools"] = [{"type": "function", "function": {"name": tool}} for tool in tools]
+        elif not stream:
+            payload["tools"] = []
+
+        return payload
+
+    def list_models(self):
+        response = get_session(self.name).get(f"{OPENAI_BASE_URL}/v1/models",
+                                              headers={"Authorization": f"Bearer {self.api_key()}"},
+                                              timeout=upstream_timeout())
+        if response.status_code != 200:
+            raise Exception(f"{self.label} API error: {response.status_code}")
+        # Filter for only chat models
+        return [model['id'] for model in json_loads(response.content).get('data', [])
+                if model['id'].startswith(('gpt-', 'text-davinci-'))]
+
+    def response_text(self, response):
+        try:
+            return response["choices"][0]["message"].get("content") or ""
+        except (KeyError, IndexError, TypeError):
+            return ""
+
+    def chunk_text(self, chunk):
+        choices = json_loads(chunk).get("choices")
+        return (choices[0].get("delta", {}).get("content") or "") if choices else ""
+
+    def prompt_usage(self, response):
+        # Prefix caching is automatic here; the usage block says how much of the prompt hit it
+        usage = (response or {}).get("usage")
+        if not usage or usage.get("prompt_tokens") is None:
+            return None
+        cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        return cached, usage["prompt_tokens"] - cached
+
+    def chunk_usage(self, chunk):
+        if b'"usage"' not in chunk:
+            return None
+        return self.prompt_usage(json_loads(chunk))
+
+@register_provider
+class MistralProvider(OpenAIProvider):
+    name = "mistral"
+    label = "Mistral"
+    url = f"{MISTRAL_BASE_URL}/v1/chat/completions"
+
+    def api_key(self):
+        return MISTRAL_API_KEY
+
+    def list_models(self):
+        # Hardcoded as API doesn't have a public models endpoint
+        return [
+            "mistral-tiny",
+            "mistral-small",
+            "mistral-medium",
+            "mistral-large-latest"
+        ]
+
+    def payload(self, messages, system, tools, model, temperature, max_tokens, top_p, stream=False):
+        payload = {
+            "model": model,
+            "messages": chat_messages(messages, system),
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "top_p": top_p
+        }
+        if stream:
+            payload["stream"] = True
+        return payload
+
+@register_provider
+class AnthropicProvider(HTTPProvider):
+    name = "anthropic"
+    label = "Anthropic"
+    url = f"{ANTHROPIC_BASE_URL}/v1/messages"
+
+    def api_key(self):
+        return ANTHROPIC_API_KEY
+
+    def list_models(self):
+        # Hardcoded since API doesn't provide a models endpoint
+        return [
+            "claude-3-opus-20240229",
+            "claude-3-sonnet-20240229",
+            "claude-3-haiku-20240307",
+            "claude-2.1",
+            "claude-2.0",
+            "claude-instant-1.2"
+        ]
+
+    def headers(self):
+        return {
+            "Content-Type": "application/json",
+            "x-api-key": self.api_key(),
+            "anthropic-version": "2023-06-01"
+        }
+
+    def payload(self, messages, system, tools, model, temperature, max_tokens, top_p, stream=False):
+        # Convert messages to Anthropic format
+        anthropic_messages = []
+        for message in messages:
+            role = "assistant" if message["role"] == "assistant" else "user"
+            anthropic_messages.append({"role": role, "content": message["content"]})
+
+        if prefix_scope.get() is not None and anthropic_messages:
+            # Cache breakpoints: the system prompt, and everything up to the latest turn,
+            # which is the stable prefix the next turn will resend
+            if system:
+                system = [{"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}]
+            last = anthropic_messages[-1]
+            last["content"] = [{"type": "text", "text": last["content"], "cache_control": {"type": "ephemeral"}}]
+
+        payload = {
+            "model": model,
+            "messages": anthropic_messages,
+            "system": system,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "top_p": top_p
+        }
+        if stream:
+            payload["stream"] = True
+        return payload
+
+    def response_text(self, response):
+        return "".join(block.get("text", "") for block in (response or {}).get("content", []))
+
+    def chunk_text(self, chunk):
+        # Cheap byte check before parsing: only content deltas carry text
+        if b'content_block_delta' not in chunk:
+            return ""
+        return json_loads(chunk).get("delta", {}).get("text", "")
+
+    def prompt_usage(self, response):
+        usage = (response or {}).get("usage")
+        if not usage or usage.get("input_tokens") is None:
+            return None
+        # Cache writes are processed (and billed) like fresh input
+        return (usage.get("cache_read_input_tokens") or 0,
+                usage["input_tokens"] + (usage.get("cache_creation_input_tokens") or 0))
+
+    def chunk_usage(self, chunk):
+        # Prompt usage is reported once, in the message_start event
+        if b'message_start' not in chunk:
+            return None
+        return self.prompt_usage(json_loads(chunk).get("message"))
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    """Simple health check endpoint"""
+    return jsonify({
+        "status": "ok",
+        "version": "1.0",
+        "providers": {
+            "ollama": OLLAMA_API_KEY is not None,
+            "openai": OPENAI_API_KEY is not None,
+            "anthropic": ANTHROPIC_API_KEY is not None,
+            "mistral": MISTRAL_API_KEY is not None
+        }
+    })
+
+@app.route('/api/v1/admission', methods=['GET'])
+def get_admission_stats():
+    """Concurrency, token budget and queue depth of each admission limiter"""
+    try:
+        return jsonify(admission_stats())
+    except Exception as e:
+        logger.error("Error collecting admission stats: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/v1/circuits', methods=['GET'])
+def get_circuit_stats():
+    """Circuit breaker state per provider"""
+    try:
+        return jsonify({"failures": CIRCUIT_FAILURES, "cooldown": CIRCUIT_COOLDOWN,
+                        "providers": {name: breaker.stats() for name, breaker in list(circuit_breakers.items())}})
+    except Exception as e:
+        logger.error("Error collecting circuit breaker stats: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/v1/ollama/hosts', methods=['GET'])
+def get_ollama_hosts():
+    """Load, health and resident models of each Ollama host"""
+    try:
+        return jsonify({"hosts": ollama_pool.stats()})
+    except Exception as e:
+        logger.error("Error collecting Ollama host stats: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/v1/ollama/scheduler', methods=['GET'])
+def get_ollama_scheduler():
+    """Per-model request rates, residency and recent warm-up actions"""
+    return jsonify(model_scheduler.stats())
+
+@app.route('/api/v1/ollama/preload', methods=['POST'])
+def preload_ollama_model():
+    """Load a model now and keep it warm while it is in demand"""
+    model = (request.get_json(silent=True) or {}).get('model')
+    if not isinstance(model, str) or not model:
+        return jsonify({"error": "Missing 'model' field"}), 400
+    actions = model_scheduler.preload(model)
+    status = 502 if all("error" in action for action in actions) else 200
+    return jsonify({"model": ollama_model_name(model), "actions": actions}), status
+
+@app.route('/api/v1/ollama/unload', methods=['POST'])
+def unload_ollama_model():
+    """Unload a model from every host and reset its request rate"""
+    model = (request.get_json(silent=True) or {}).get('model')
+    if not isinstance(model, str) or not model:
+        return jsonify({"error": "Missing 'model' field"}), 400
+    actions = model_scheduler.unload(model)
+    status = 502 if actions and all("error" in action for action in actions) else 200
+    return jsonify({"model": ollama_model_name(model), "actions": actions}), status
+
+@app.route('/api/v1/pools', methods=['GET'])
+def get_pool_stats():
+    """Connection pool statistics per upstream provider"""
+    try:
+        return jsonify(pool_stats())
+    except Exception as e:
+        logger.error("Error collecting pool stats: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/v1/cache', methods=['GET'])
+def get_cache_stats():
+    """Response cache statistics"""
+    return jsonify({"enabled": RESPONSE_CACHE_ENABLED, **response_cache.stats()})
+
+@app.route('/api/v1/cache', methods=['DELETE'])
+def clear_cache():
+    """Drop every cached chat response"""
+    response_cache.clear()
+    return jsonify({"status": "cleared"})
+
+@app.route('/api/v1/coalescing', methods=['GET'])
+def get_coalescing_stats():
+    """Counts of upstream calls made versus requests that joined one in flight"""
+    return jsonify({"enabled": REQUEST_COALESCING, **coalescing_stats})
+
+# Model catalog cache: served stale while a background refresh runs
+MODEL_CATALOG_TTL = float(os.getenv('MODEL_CATALOG_TTL', 300))
+MODEL_CATALOG_RETRY = float(os.getenv('MODEL_CATALOG_RETRY', 10))
+
+model_catalog = {}
+model_catalog_lock = threading.Lock()
+
+def refresh_model_catalog(provider):
+    """Fetch a provider's models and store them; a failure is not cached.
+
+    The previous list, if any, is kept and retried after MODEL_CATALOG_RETRY
+    seconds instead of a full TTL; with no list yet, the next request fetches again.
+    """
+    try:
+        models = providers[provider].list_models()
+    except Exception as e:
+        logger.warning("Error fetching %s models: %s", providers[provider].label, e)
+        models = None
+    with model_catalog_lock:
+        entry = model_catalog.get(provider)
+        if models is None:
+            if entry is None:
+                return []
+            entry["fetched_at"] = time.time() - MODEL_CATALOG_TTL + MODEL_CATALOG_RETRY
+            entry["refreshing"] = False
+            return entry["models"]
+        model_catalog[provider] = {"models": models, "fetched_at": time.time(), "refreshing": False}
+    for model in models:
+        mark_model_known(model)
+    return models
+
+def catalog_models(provider, force=False):
+    """Cached model list for a provider, revalidated in the background once stale"""
+    with model_catalog_lock:
+        entry = model_catalog.get(provider)
+        if entry is not None and not force:
+            stale = time.time() - entry["fetched_at"] > MODEL_CATALOG_TTL
+            if stale and not entry["refreshing"]:
+                entry["refreshing"] = True
+                threading.Thread(target=refresh_model_catalog, args=(provider,), daemon=True).start()
+            return entry["models"]
+    # First request (or forced refresh) fetches synchronously
+    return refresh_model_catalog(provider)
+
+@app.route('/api/v1/models', methods=['GET'])
+def list_models():
+    """List available models for each provider"""
+    provider = request.args.get('provider')
+    force = request.args.get('refresh', 'false').lower() in ('true', '1', 't')
+    models = {}
+
+    try:
+        for name, upstream in providers.items():
+            if provider and provider != name:
+                continue
+            # Hosted providers are only listed when their API key is configured
+            if name != 'ollama' and not upstream.api_key():
+                continue
+            models[name] = catalog_models(name, force)
+
+        # Pollers revalidate with If-None-Match and get a 304 while nothing changed
+        result = jsonify({"models": models})
+        result.set_etag(canonical_hash(models)[:32])
+        return result.make_conditional(request)
+
+    except Exception as e:
+        logger.error("Error listing models: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+class MmapEmbeddingCache:
+    """Content-addressed float32 embedding store backed by memory-mapped files.
+
+    Vectors of each dimension are appended to ``embeddings-<dim>.f32`` and the
+    SHA-256 digest of every row to ``embeddings-<dim>.idx``, so the index can be
+    rebuilt on startup and rows are read straight from the page cache. Appends
+    hold a file lock, so worker processes can share one directory; rows added
+    by other workers are picked up on a miss.
+
+    The files stay within ``max_bytes``: when the current generation of a
+    dimension holds half of it, it is renamed to ``embeddings-<dim>.prev``
+    (dropping the generation before) and a fresh one is started, so the most
+    recently added vectors are kept.
+    """
+
+    def __init__(self, directory, max_bytes=0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.lock = FileLock(os.path.join(directory, '.lock')) if fcntl else threading.Lock()
+        # digest -> (dim, generation, row), generation being '' (current) or '.prev'
+        self.rows = {}
+        self.maps = {}
+        self.counts = {}
+        # dim -> inode of the current index file; a new inode means another worker rotated it
+        self.inodes = {}
+        self.hits = 0
+        self.misses = 0
+        with self.lock:
+            self._refresh()
+
+    def _paths(self, dim, generation=''):
+        base = os.path.join(self.directory, f"embeddings-{dim}{generation}")
+        return f"{base}.f32", f"{base}.idx"
+
+    def _capacity(self, dim):
+        """Rows a generation may hold"""
+        if not self.max_bytes:
+            return math.inf
+        return max(1, self.max_bytes // 2 // (dim * 4 + 32))
+
+    def _refresh(self):
+        """Index rows appended since the last look, by this or another process (lock held)"""
+        for name in os.listdir(self.directory):
+            dim = name[len('embeddings-'):-len('.idx')]
+            if name.startswith('embeddings-') and name.endswith('.idx') and dim.isdigit():
+                self._load(int(dim))
+
+    def _load(self, dim):
+        try:
+            inode = os.stat(self._paths(dim)[1]).st_ino
+        except FileNotFoundError:
+            return
+        if self.inodes.get(dim) != inode:
+            self._forget(dim)
+            self.inodes[dim] = inode
+            self._index(dim, '.prev', 0)
+        self.counts[dim] = self._index(dim, '', self.counts.get(dim, 0))
+
+    def _index(self, dim, generation, start):
+        """Index a generation's rows from ``start`` on; returns its row count"""
+        data_path, index_path = self._paths(dim, generation)
+        try:
+            with open(index_path, 'rb') as f:
+                f.seek(start * 32)
+                digests = f.read()
+            data_rows = os.path.getsize(data_path) // (dim * 4)
+        except FileNotFoundError:
+            return start
+        # Ignore a torn trailing write in either file
+        count = min(start + len(digests) // 32, data_rows)
+        for row in range(start, count):
+            offset = (row - start) * 32
+            self.rows[digests[offset:offset + 32].hex()] = (dim, generation, row)
+        return max(start, count)
+
+    def _forget(self, dim):
+        self.rows = {key: location for key, location in self.rows.items() if location[0] != dim}
+        self.maps = {key: mapped for key, mapped in self.maps.items() if key[0] != dim}
+        self.counts[dim] = 0
+        self.inodes.pop(dim, None)
+
+    def _rotate(self, dim):
+        """Retire the full current generation to .prev, dropping the older one (lock held)"""
+        for current, previous in zip(self._paths(dim), self._paths(dim, '.prev')):
+            os.replace(current, previous)
+        self._forget(dim)
+        self._index(dim, '.prev', 0)
+
+    def _mapped(self, dim, generation, row):
+        mapped = self.maps.get((dim, generation))
+        if mapped is None or row >= mapped.shape[0]:
+            data_path, _ = self._paths(dim, generation)
+            mapped = np.memmap(data_path, dtype=np.float32, mode='r',
+                               shape=(os.path.getsize(data_path) // (dim * 4), dim))
+            self.maps[(dim, generation)] = mapped
+        return mapped
+
+    def get(self, key):
+        with self.lock:
+            location = self.rows.get(key)
+            if location is None:
+                self._refresh()
+                location = self.rows.get(key)
+            if location is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self._mapped(*location)[location[2]]
+
+    def set(self, key, value):
+        vector = np.ascontiguousarray(value, dtype='<f4')
+        dim = vector.shape[0]
+        with self.lock:
+            self._load(dim)
+            if key in self.rows:
+                return
+            if self.counts.get(dim, 0) >= self._capacity(dim):
+                self._rotate(dim)
+            data_path, index_path = self._paths(dim)
+            with open(data_path, 'ab') as f:
+                f.write(vector.tobytes())
+            with open(index_path, 'ab') as f:
+                f.write(bytes.fromhex(key))
+            self.inodes.setdefault(dim, os.stat(index_path).st_ino)
+            row = self.counts.get(dim, 0)
+            self.rows[key] = (dim, '', row)
+            self.counts[dim] = row + 1
+
+    def __len__(self):
+        return len(self.rows)
+
+    def stats(self):
+        size = sum(entry.stat().st_size for entry in os.scandir(self.directory)
+                   if entry.name.startswith('embeddings-'))
+        return {"backend": "mmap", "path": self.directory, "size": len(self), "bytes": size,
+                "max_bytes": self.max_bytes or None, "dimensions": sorted(self.counts),
+                "hits": self.hits, "misses": self.misses}
+
+# Embedding batching, fan-out and caching
+EMBEDDING_CONCURRENCY = int(os.getenv('EMBEDDING_CONCURRENCY', 4))
+EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE', 100000))
+# Memory-mapped float32 files by default; an empty EMBEDDING_CACHE_DIR keeps an in-process LRU instead
+EMBEDDING_CACHE_DIR = os.getenv('EMBEDDING_CACHE_DIR', os.path.join(STATE_DIR, 'embeddings'))
+EMBEDDING_CACHE_MAX_BYTES = parse_size(os.getenv('EMBEDDING_CACHE_MAX_BYTES', '1GiB'))
+
+if EMBEDDING_CACHE_DIR:
+    embedding_cache = MmapEmbeddingCache(EMBEDDING_CACHE_DIR, EMBEDDING_CACHE_MAX_BYTES)
+else:
+    embedding_cache = LRUCache(EMBEDDING_CACHE_SIZE)
+
+embedding_executor = ThreadPoolExecutor(max_workers=EMBEDDING_CONCURRENCY, thread_name_prefix='embeddings')
+
+def embed_openai_batch(texts, model):
+    """Embed a batch of texts with a single OpenAI request"""
+    if not OPENAI_API_KEY:
+        raise UpstreamError("OpenAI API key not configured", 500)
+
+    response = get_session("openai").post(f"{OPENAI_BASE_URL}/v1/embeddings",
+                                          headers=providers["openai"].headers(),
+                                          data=json_dumps({"input": texts, "model": model}),
+                                          timeout=upstream_timeout())
+
+    if response.status_code != 200:
+        raise UpstreamError(f"OpenAI API error: {response.text}", response.status_code)
+
+    data = sorted(json_loads(response.content).get('data', []), key=lambda item: item['index'])
+    return [item['embedding'] for item in data]
+
+def embed_ollama_batch(texts, model):
+    """Embed a batch of texts with a single Ollama request"""
+    with ollama_pool.lease(model) as host:
+        response = host.client.embed(model=model, input=texts,
+                                     keep_alive=OLLAMA_KEEP_ALIVE if OLLAMA_SCHEDULER else None)
+    return as_dict(response)['embeddings']
+
+# Batch function, default model and largest batch accepted per provider
+embedding_backends = {
+    "openai": (embed_openai_batch, "text-embedding-ada-002", int(os.getenv('OPENAI_EMBEDDING_BATCH_SIZE', 2048))),
+    "ollama": (embed_ollama_batch, "llama3.1:8b", int(os.getenv('OLLAMA_EMBEDDING_BATCH_SIZE', 64)))
+}
+
+def embed_texts(texts, provider, model):
+    """Embed texts, deduplicating inputs and serving repeats from the embedding cache.
+
+    Returns the float32 vectors in input order and the number served from cache.
+    """
+    embed_batch, _, batch_size = embedding_backends[provider]
+    keys = [canonical_hash([provider, model, text]) for text in texts]
+
+    vectors = {}
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key in vectors or key in missing:
+            continue
+        vector = embedding_cache.get(key)
+        if vector is None:
+            missing[key] = text
+        else:
+            vectors[key] = vector
+    cached = len(vectors)
+
+    pending = list(missing.items())
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    embedding_texts.inc((provider, model, "cache"), cached)
+    embedding_texts.inc((provider, model, "upstream"), len(pending))
+    futures = [embedding_executor.submit(contextvars.copy_context().run, timed_request, provider, model, embed_batch,
+                                         [text for _, text in batch], model, mode="embeddings")
+               for batch in batches]
+    for batch, future in zip(batches, futures):
+        for (key, _), embedding in zip(batch, future.result()):
+            vector = np.asarray(embedding, dtype=np.float32)
+            embedding_cache.set(key, vector)
+            vectors[key] = vector
+
+    return [vectors[key] for key in keys], cached
+
+# Embedding response encodings: JSON floats, base64-packed little-endian arrays, or a raw binary body
+EMBEDDING_ENCODINGS = ("float", "base64", "binary")
+EMBEDDING_DTYPES = {"float32": "<f4", "float16": "<f2", "int8": "i1"}
+
+def quantize_embeddings(vectors, dtype):
+    """Pack vectors into a little-endian (count, dimensions) matrix of dtype.
+
+    int8 uses symmetric per-vector scaling; the float32 scales (value = int8 * scale) are returned alongside.
+    """
+    matrix = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+    if dtype != "int8":
+        return matrix.astype(EMBEDDING_DTYPES[dtype]), None
+    scales = np.abs(matrix).max(axis=1) / 127
+    scales[scales == 0] = 1
+    return np.rint(matrix / scales[:, None]).astype(np.int8), scales.astype("<f4")
+
+def encode_embeddings(vectors, encoding_format, dtype):
+    """Response 'data' items for the JSON encodings"""
+    if encoding_format == "float":
+        return [{"object": "embedding", "index": i, "embedding": v} for i, v in enumerate(vectors)]
+    matrix, scales = quantize_embeddings(vectors, dtype)
+    items = []
+    for i, row in enumerate(matrix):
+        item = {"object": "embedding", "index": i, "embedding": base64.b64encode(row).decode("ascii")}
+        if scales is not None:
+            item["scale"] = float(scales[i])
+        items.append(item)
+    return items
+
+def binary_embeddings_response(vectors, dtype, provider, model, cached):
+    """Raw row-major matrix body; int8 bodies are followed by one float32 scale per vector"""
+    matrix, scales = quantize_embeddings(vectors, dtype)
+    body = matrix.tobytes() + (scales.tobytes() if scales is not None else b"")
+    response = Response(body, mimetype="application/octet-stream")
+    response.headers.update({
+        "X-Embedding-Provider": provider,
+        "X-Embedding-Model": model,
+        "X-Embedding-Dtype": dtype,
+        "X-Embedding-Count": str(matrix.shape[0]),
+        "X-Embedding-Dimensions": str(matrix.shape[1]),
+        "X-Embeddings-Cached": str(cached)
+    })
+    return response
+
+@app.route('/api/v1/embeddings', methods=['POST'])
+def generate_embeddings():
+    """Generate embeddings for text"""
+    try:
+        data = request.json
+        if not data or 'text' not in data:
+            return jsonify({"error": "Missing 'text' field"}), 400
+
+        text = data.get('text')
+        provider = data.get('provider', 'openai')
+        model = data.get('model')
+
+        if provider in embedding_backends:
+            single = isinstance(text, str)
+            texts = [text] if single else text
+            if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+                return jsonify({"error": "'text' must be a string or a list of strings"}), 400
+            if not texts:
+                return jsonify({"error": "'text' must not be an empty list"}), 400
+
+            binary_accepted = request.accept_mimetypes.best_match(
+                ['application/json', 'application/octet-stream']) == 'application/octet-stream'
+            encoding_format = data.get('encoding_format') or ('binary' if binary_accepted else 'float')
+            dtype = data.get('dtype', 'float32')
+            if encoding_format not in EMBEDDING_ENCODINGS:
+                return jsonify({"error": f"'encoding_format' must be one of {', '.join(EMBEDDING_ENCODINGS)}"}), 400
+            if dtype not in EMBEDDING_DTYPES:
+                return jsonify({"error": f"'dtype' must be one of {', '.join(EMBEDDING_DTYPES)}"}), 400
+            if encoding_format == 'float' and dtype != 'float32':
+                return jsonify({"error": "'dtype' requires encoding_format 'base64' or 'binary'"}), 400
+
+            model = model or embedding_backends[provider][1]
+            vectors, cached = embed_texts(texts, provider, model)
+
+            if encoding_format == 'binary':
+                return binary_embeddings_response(vectors, dtype, provider, model, cached)
+
+            result = {
+                "object": "list",
+                "provider": provider,
+                "model": model,
+                "data": encode_embeddings(vectors, encoding_format, dtype),
+                "cached": cached
+            }
+            if encoding_format != 'float':
+                result.update(encoding_format=encoding_format, dtype=dtype,
+                              dimensions=len(vectors[0]) if vectors else 0)
+            if single:
+                result["embedding"] = result["data"][0]["embedding"]
+                if "scale" in result["data"][0]:
+                    result["scale"] = result["data"][0]["scale"]
+            return jsonify(result)
+
+        elif provider == 'anthropic':
+            if not ANTHROPIC_API_KEY:
+                return jsonify({"error": "Anthropic API key not configured"}), 500
+
+            headers = {
+                "Content-Type": "application/json",
+                "x-api-key": ANTHROPIC_API_KEY,
+                "anthropic-version": "2023-06-01"
+            }
+            payload = {
+                "model": model or "claude-2",
+                "prompt": text
+            }
+
+            response = get_session("anthropic").post(f"{ANTHROPIC_BASE_URL}/v1/complete",
+                                                     headers=headers,
+                                                     data=json_dumps(payload),
+                                                     timeout=upstream_timeout())
+
+            if response.status_code != 200:
+                return jsonify({"error": f"Anthropic API error: {response.text}"}), response.status_code
+
+            return jsonify(json_loads(response.content))
+
+        else:
+            return jsonify({"error": "Unsupported provider for embeddings"}), 400
+
+    except UpstreamError as e:
+        logger.error("Error generating embeddings: %s", e)
+        return jsonify({"error": str(e)}), e.status_code
+    except Exception as e:
+        logger.error("Error generating embeddings: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/v1/conversations/<conversation_id>', methods=['GET'])
+def get_conversation(conversation_id):
+    """Retrieve conversation history"""
+    try:
+        history = get_conversation_history(conversation_id)
+        return jsonify({"conversation_id": conversation_id, "messages": history})
+    except Exception as e:
+        logger.error("Error retrieving conversation: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/v1/conversations/<conversation_id>', methods=['DELETE'])
+def delete_conversation(conversation_id):
+    """Delete conversation history"""
+    try:
+        if conversation_store.delete(conversation_id):
+            return jsonify({"status": "deleted", "conversation_id": conversation_id})
+        else:
+            return jsonify({"error": "Conversation not found"}), 404
+    except Exception as e:
+        logger.error("Error deleting conversation: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+# Bulk JSONL batch processing
+BATCH_DIR = os.getenv('BATCH_DIR', 'batches')
+BATCH_CONCURRENCY = {
+    "ollama": int(os.getenv('BATCH_OLLAMA_CONCURRENCY', 2)),
+    "openai": int(os.getenv('BATCH_OPENAI_CONCURRENCY', 16)),
+    "anthropic": int(os.getenv('BATCH_ANTHROPIC_CONCURRENCY', 8)),
+    "mistral": int(os.getenv('BATCH_MISTRAL_CONCURRENCY', 8))
+}
+
+def read_batch_records(lines, skip=()):
+    """Yield (line number, record) for each non-empty JSONL line not in skip"""
+    for number, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip() or number in skip:
+            continue
+        try:
+            yield number, json_loads(line)
+        except ValueError:
+            yield number, None
+
+def completed_batch_lines(output_path):
+    """Line numbers already answered successfully in an existing output file.
+
+    Failed lines are run again on resume and append a fresh result, so the
+    file is rewritten without their old errors: each line keeps only its
+    last result. Call with the job's lock held.
+    """
+    if not os.path.exists(output_path):
+        return set()
+    completed = {}
+    stale = False
+    with open(output_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json_loads(line)
+            except ValueError:
+                # A torn final line from an interrupted run
+                stale = True
+                continue
+            if 'error' in result or result.get('line') in completed:
+                stale = True
+            else:
+                completed[result.get('line')] = line
+    if stale:
+        partial = f"{output_path}.tmp"
+        with open(partial, 'w', encoding='utf-8') as f:
+            f.writelines(completed.values())
+        os.replace(partial, output_path)
+    return set(completed)
+
+# In-process stand-ins for the per-job file locks where flock() is unavailable
+batch_locks = {}
+
+def lock_batch_job(output_path):
+    """Take a batch job's exclusive lock for the whole run, across workers and the CLI.
+
+    Returns a function that releases it (safe to call twice), or None if
+    another run of the job holds it.
+    """
+    if fcntl is None:
+        lock = batch_locks.setdefault(output_path, threading.Lock())
+        if not lock.acquire(blocking=False):
+            return None
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                lock.release()
+        return release
+
+    lock = FileLock(f"{output_path}.lock")
+    if not lock.acquire(blocking=False):
+        lock.close()
+        return None
+    # Closing the descriptor drops the flock; a second close is a no-op
+    return lock.close
+
+def admit_batch(provider, model, priority, tokens):
+    """admit() for batch records: back off and retry while the queue is full"""
+    while True:
+        try:
+            return admit(provider, model, priority, tokens)
+        except AdmissionRejected as e:
+            if attempt_cancelled():
+                # A hedge already answered this record
+                raise
+            time.sleep(e.retry_after)
+
+def run_batch_record(record):
+    """Process one batch record; never raises so a bad record cannot stop the job"""
+    if not isinstance(record, dict):
+        return {"error": "Invalid JSON record"}
+    result = {"custom_id": record["custom_id"]} if "custom_id" in record else {}
+    try:
+        # Unknown keys such as custom_id are ignored by the schema
+        validated_data = ChatSchema.model_validate(record)
+    except ValidationError as e:
+        result.update({"error": "Invalid input data format", "details": e.errors(include_url=False)})
+        return result
+
+    try:
+        prefix_scope.set(prompt_cache_scope(validated_data))
+        cache_key = response_cache_key(validated_data)
+        response = cached_chat_response(cache_key)
+        if response is None:
+            cost = request_cost(validated_data.messages, validated_data.system, validated_data.max_tokens)
+            if validated_data.fallbacks:
+                _, response = routed_request(validated_data, validated_data.messages, PRIORITIES["batch"], cost,
+                                             admit_batch)
+            else:
+                admission = admit_batch(validated_data.provider, validated_data.model, PRIORITIES["batch"], cost)
+                try:
+                    response = timed_request(
+                        validated_data.provider, validated_data.model, providers[validated_data.provider].request,
+                        validated_data.messages, validated_data.system, validated_data.tools, validated_data.model,
+                        validated_data.temperature, validated_data.max_tokens, validated_data.top_p
+                    )
+                finally:
+                    admission.release()
+            if cache_key is not None:
+                response_cache.set(cache_key, response)
+        result["response"] = response
+    except Exception as e:
+        result["error"] = str(e)
+    return result
+
+def run_batch(records, output, concurrency=None):
+    """Run batch records concurrently under per-provider caps.
+
+    Results are appended to ``output`` and yielded in completion order; each
+    carries the input ``line`` so an interrupted job can resume from the output.
+    """
+    limits = {**BATCH_CONCURRENCY, **(concurrency or {})}
+    total = sum(limits.values())
+    queues = {}
+    in_flight = {}
+    futures = {}
+    buffered = 0
+    exhausted = False
+    executor = ThreadPoolExecutor(max_workers=total, thread_name_prefix='batch')
+    try:
+        while True:
+            # Read ahead only a bounded number of records
+            while not exhausted and buffered < total * 4:
+                try:
+                    number, record = next(records)
+                except StopIteration:
+                    exhausted = True
+                    break
+                provider = record.get('provider', 'ollama') if isinstance(record, dict) else None
+                queues.setdefault(provider if provider in limits else None, deque()).append((number, record))
+                buffered += 1
 
-app = Flask(__name__)
+            for provider, pending in queues.items():
+                limit = limits.get(provider, 1)
+                while pending and in_flight.get(provider, 0) < limit:
+                    number, record = pending.popleft()
+                    buffered -= 1
+                    in_flight[provider] = in_flight.get(provider, 0) + 1
+                    futures[executor.submit(run_batch_record, record)] = (number, provider)
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-handler = RotatingFileHandler('app.log', maxBytes=10000, backupCount=1)
-handler.setLevel(logging.INFO)
-app.logger.addHandler(handler)
+            if not futures:
+                break
 
-@app.errorhandler(404)
-def not_found_error(error):
-    return jsonify({"error": "Resource not found"}), 404
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                number, provider = futures.pop(future)
+                in_flight[provider] -= 1
+                result = {"line": number, **future.result()}
+                output.write(json_dumps(result, default=str).decode('utf-8') + "\n")
+                output.flush()
+                yield result
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
-@app.errorhandler(500)
-def internal_error(error):
-    return jsonify({"error": "Internal server error"}), 500
+def batch_job_paths(job_id):
+    return (os.path.join(BATCH_DIR, f"{job_id}.input.jsonl"),
+            os.path.join(BATCH_DIR, f"{job_id}.output.jsonl"))
 
-class ChatSchema(BaseModel):
-    messages: List[Dict[str, str]] = Field(..., description="List of messages")
-    system: str = Field(..., description="System message")
-    tools: Optional[List[str]] = Field(None, description="List of tools")
-    model: str = Field("llama2", description="Model to use")
-    provider: str = Field("ollama", description="Provider to use", pattern="^(ollama|openai|anthropic|mistral)$")
-    temperature: float = Field(0.7, description="Temperature for the model", ge=0, le=2)
-    max_tokens: int = Field(1000, description="Maximum number of tokens", gt=0)
-    top_p: float = Field(0.9, description="Top-p sampling", ge=0, le=1)
-    stream: bool = Field(False, description="Whether to stream the response")
-    conversation_id: Optional[str] = Field(None, description="Conversation ID")
+@app.route('/api/v1/chat/batch', methods=['POST'])
+def chat_batch():
+    """Run a JSONL file of ChatSchema records, streaming JSONL results as they complete"""
+    try:
+        job_id = request.args.get('job_id') or uuid.uuid4().hex
+        if not re.fullmatch(r'[A-Za-z0-9_-]{1,64}', job_id):
+            return jsonify({"error": "Invalid job_id"}), 400
 
-@app.route('/api/v1/chat', methods=['POST'])
-def chat():
-    logger.info("Received request at /api/v1/chat")
+        os.makedirs(BATCH_DIR, exist_ok=True)
+        input_path, output_path = batch_job_paths(job_id)
+
+        upload = request.files.get('file')
+        body = upload.read() if upload else request.get_data()
+        # Two runs of one job would both append every result to its output
+        release = lock_batch_job(output_path)
+        if release is None:
+            return jsonify({"error": f"Batch job {job_id} is already running"}), 409
+        try:
+            if body and os.path.exists(input_path):
+                # Results are matched to input lines by number, so a job keeps the input it started with
+                with open(input_path, 'rb') as f:
+                    if f.read() != body:
+                        release()
+                        return jsonify({"error": f"Batch job {job_id} already exists with a different input"}), 409
+            elif body:
+                with open(input_path, 'wb') as f:
+                    f.write(body)
+            elif not os.path.exists(input_path):
+                release()
+                return jsonify({"error": "Missing JSONL body or 'file' upload"}), 400
+
+            # Resume: skip lines that already have a successful result
+            completed = completed_batch_lines(output_path)
+        except BaseException:
+            release()
+            raise
+        logger.info("Batch job %s: resuming with %s completed records", job_id, len(completed))
+
+        def generate():
+            try:
+                with open(input_path, 'rb') as lines, open(output_path, 'a', encoding='utf-8') as output:
+                    for result in run_batch(read_batch_records(lines, completed), output):
+                        yield json_dumps(result, default=str) + b"\n"
+            finally:
+                release()
+
+        result = Response(generate(), mimetype='application/x-ndjson', headers={'X-Batch-Job-Id': job_id})
+        # Also release if the client goes away before the run starts
+        result.call_on_close(release)
+        return result
+
+    except Exception as e:
+        logger.error("Error starting batch job: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/v1/chat/batch/<job_id>', methods=['GET'])
+def get_chat_batch(job_id):
+    """Download the results written so far for a batch job"""
+    if not re.fullmatch(r'[A-Za-z0-9_-]{1,64}', job_id):
+        return jsonify({"error": "Invalid job_id"}), 400
+    _, output_path = batch_job_paths(job_id)
+    if not os.path.exists(output_path):
+        return jsonify({"error": "Batch job not found"}), 404
+    return send_file(os.path.abspath(output_path), mimetype='application/x-ndjson')
+
+def batch_cli(argv):
+    """Command-line entry point: run a JSONL batch file without the HTTP server"""
+    parser = argparse.ArgumentParser(prog='ollama-prompt.py batch',
+                                     description="Run a JSONL file of chat requests concurrently")
+    parser.add_argument('input', help="JSONL file of ChatSchema records")
+    parser.add_argument('output', help="JSONL file results are appended to (also the resume checkpoint)")
+    parser.add_argument('--concurrency', action='append', default=[], metavar='PROVIDER=N',
+                        help="Per-provider concurrency cap, e.g. openai=32 (repeatable)")
+    parser.add_argument('--restart', action='store_true', help="Ignore results already in the output file")
+    args = parser.parse_args(argv)
+
+    concurrency = {}
+    for item in args.concurrency:
+        provider, _, value = item.partition('=')
+        concurrency[provider] = int(value)
+
+    release = lock_batch_job(args.output)
+    if release is None:
+        logger.error("Another run is already writing %s", args.output)
+        return 1
     try:
-        data = request.json
+        if args.restart and os.path.exists(args.output):
+            os.remove(args.output)
+        completed = completed_batch_lines(args.output)
+        if completed:
+            logger.info("Resuming: %s records already completed", len(completed))
+
+        processed = errors = 0
+        with open(args.input, 'rb') as lines, open(args.output, 'a', encoding='utf-8') as output:
+            for result in run_batch(read_batch_records(lines, completed), output, concurrency):
+                processed += 1
+                errors += 'error' in result
+                if processed % 100 == 0:
+                    logger.info("Batch progress: %s processed, %s errors", processed, errors)
+    finally:
+        release()
+
+    logger.info("Batch finished: %s processed, %s errors", processed, errors)
+    return 1 if errors else 0
 
-        # Validate input data
+# Local vector index: named, memory-mapped float32 stores with top-k search
+INDEX_DIR = os.getenv('INDEX_DIR', os.path.join(STATE_DIR, 'indexes'))
+INDEX_SEARCH_BLOCK = int(os.getenv('INDEX_SEARCH_BLOCK', 65536))
+INDEX_NPROBE = int(os.getenv('INDEX_NPROBE', 8))
+INDEX_TRAIN_SAMPLE = int(os.getenv('INDEX_TRAIN_SAMPLE', 100000))
+INDEX_MAX_K = int(os.getenv('INDEX_MAX_K', 1000))
+INDEX_METRICS = ("cosine", "dot")
+
+index_queries = register_metric(MetricHistogram(
+    "proxy_index_query_seconds", "Vector index query duration", ("index", "mode")))
+index_rows_scored = register_metric(MetricCounter(
+    "proxy_index_rows_scored_total", "Stored vectors compared against queries", ("index", "mode")))
+
+def decode_vector(value):
+    """Vector from a JSON list of numbers or a base64 string of little-endian float32 values"""
+    if isinstance(value, str):
         try:
-            validated_data = ChatSchema(**data)
-        except ValidationError as e:
-            logger.error(f"Validation errors: {e.errors()}")
-            return jsonify({"error": "Invalid input data format", "details": e.errors()}), 400
+            raw = base64.b64decode(value, validate=True)
+        except ValueError:
+            raise ValueError("Vector is not valid base64")
+        if not raw or len(raw) % 4:
+            raise ValueError("base64 vector must hold little-endian float32 values")
+        return np.frombuffer(raw, dtype='<f4').astype(np.float32)
+    vector = np.asarray(value, dtype=np.float32)
+    if vector.ndim != 1 or not vector.size:
+        raise ValueError("Vector must be a non-empty list of numbers")
+    return vector
 
-        # Extract parameters
-        messages = validated_data.messages
-        system = validated_data.system
-        tools = validated_data.tools
-        model = validated_data.model
-        provider = validated_data.provider
-        temperature = validated_data.temperature
-        max_tokens = validated_data.max_tokens
-        top_p = validated_data.top_p
-        stream = validated_data.stream
-        conversation_id = validated_data.conversation_id
+def nearest_centroids(block, centroids, norms):
+    """Index of the closest centroid (L2) for each row; norms are the centroids' squared lengths"""
+    return np.argmax(block @ centroids.T - norms / 2, axis=1)
 
-        # Log the request details
-        logger.info(f"Processing request with provider: {provider}, model: {model}, stream: {stream}")
+def kmeans(data, count, iterations, rng):
+    """Lloyd's k-means over the rows of data; empty clusters are reseeded from random rows"""
+    centroids = data[rng.choice(len(data), count, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.concatenate([
+            nearest_centroids(data[start:start + INDEX_SEARCH_BLOCK], centroids, (centroids ** 2).sum(axis=1))
+            for start in range(0, len(data), INDEX_SEARCH_BLOCK)])
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, data)
+        sizes = np.bincount(assignments, minlength=count)
+        empty = sizes == 0
+        centroids = sums / np.maximum(sizes, 1)[:, None]
+        centroids[empty] = data[rng.choice(len(data), int(empty.sum()))]
+    return centroids.astype(np.float32)
 
-        # Save conversation history if conversation_id is provided
-        if conversation_id:
-            save_conversation_history(conversation_id, messages)
+class VectorIndex:
+    """Named vector store kept in memory-mapped files, searched with NumPy.
 
-        # Handle streaming response
-        if stream:
-            def generate():
-                try:
-                    # Route to the appropriate provider for streaming
-                    if provider == "ollama":
-                        for chunk in process_ollama_stream(messages, system, tools, model, temperature, max_tokens, top_p):
-                            yield f"data: {json.dumps(chunk)}\n\n"
-                    elif provider == "openai":
-                        for chunk in process_openai_stream(messages, system, tools, model, temperature, max_tokens, top_p):
-                            yield f"data: {json.dumps(chunk)}\n\n"
-                    elif provider == "anthropic":
-                        for chunk in process_anthropic_stream(messages, system, tools, model, temperature, max_tokens, top_p):
-                            yield f"data: {json.dumps(chunk)}\n\n"
-                    elif provider == "mistral":
-                        for chunk in process_mistral_stream(messages, system, tools, model, temperature, max_tokens, top_p):
-                            yield f"data: {json.dumps(chunk)}\n\n"
-                    else:
-                        yield f"data: {json.dumps({'error': 'Invalid provider specified'})}\n\n"
+    ``meta.json`` names the current files: float32 rows (unit length for the
+    cosine metric) and a JSON-lines journal of upserts and deletes that maps
+    IDs to rows. Rows are only appended; the latest row for an ID is live and
+    older ones are skipped until ``compact`` rewrites the files. ``train``
+    clusters the rows with k-means and assigns every row to a list, so
+    queries only score the ``nprobe`` lists closest to the query (IVF).
+    Rewrites go to new files and become current when ``meta.json`` is
+    replaced, so a crash never leaves a half-written index. Changes hold a
+    file lock and every call first applies what other workers wrote.
+    """
 
-                    # End of stream marker
-                    yield f"data: [DONE]\n\n"
+    def __init__(self, directory):
+        self.directory = directory
+        # The lock file lives beside the directory so it outlasts dropping and recreating the index
+        lock_path = os.path.join(os.path.dirname(directory), f".{os.path.basename(directory)}.lock")
+        self.lock = FileLock(lock_path) if fcntl else threading.Lock()
+        self.meta_stat = None
 
-                except Exception as e:
-                    logger.error(f"Streaming error: {e}")
-                    yield f"data: {json.dumps({'error': str(e)})}\n\n"
+    @classmethod
+    def create(cls, directory, metric="cosine", dimensions=None, provider=None, model=None):
+        index = cls(directory)
+        with index.lock:
+            if os.path.exists(index._path('meta.json')):
+                raise FileExistsError(directory)
+            os.makedirs(directory, exist_ok=True)
+            index._write_meta({"metric": metric, "dimensions": dimensions, "provider": provider, "model": model,
+                               "generation": 0, "lists": 0, "vectors": "vectors.0.f32",
+                               "journal": "journal.0.jsonl"})
+        return index
 
-            return Response(generate(), mimetype='text/event-stream')
+    def _path(self, name):
+        return os.path.join(self.directory, name)
 
-        else:
-            # Non-streaming response
-            # Route to the appropriate provider
-            if provider == "ollama":
-                response = process_ollama_request(messages, system, tools, model, temperature, max_tokens, top_p)
-            elif provider == "openai":
-                response = process_openai_request(messages, system, tools, model, temperature, max_tokens, top_p)
-            elif provider == "anthropic":
-                response = process_anthropic_request(messages, system, tools, model, temperature, max_tokens, top_p)
-            elif provider == "mistral":
-                response = process_mistral_request(messages, system, tools, model, temperature, max_tokens, top_p)
-            else:
-                return jsonify({"error": "Invalid provider specified"}), 400
+    def _write_meta(self, meta):
+        temp_path = self._path('meta.json.tmp')
+        with open(temp_path, 'wb') as f:
+            f.write(json_dumps(meta))
+        os.replace(temp_path, self._path('meta.json'))
 
-            return jsonify(response)
+    def _reload(self, stat):
+        with open(self._path('meta.json'), 'rb') as f:
+            self.meta = json_loads(f.read())
+        self.meta_stat = stat
+        self.ids = {}
+        self.row_ids = []
+        self.live = bytearray()
+        self.metadata = {}
+        self.texts = {}
+        self.offset = 0
+        self.vectors = None
+        self.assignments = None
+        self.centroids = None
+        self.lists = []
+        if self.meta["lists"]:
+            self.centroids = np.fromfile(self._path(self.meta["centroids"]), dtype='<f4').reshape(self.meta["lists"], -1)
+            self.centroid_norms = (self.centroids ** 2).sum(axis=1)
+            self.lists = [array('i') for _ in range(self.meta["lists"])]
 
-    except Exception as e:
-        logger.error(f"An error occurred: {e}")
-        return jsonify({"error": "An internal error occurred", "details": str(e)}), 500
+    def _refresh(self):
+        """Apply changes made since the last call, by this or another process (lock held)"""
+        try:
+            stat = os.stat(self._path('meta.json'))
+        except FileNotFoundError:
+            raise LookupError("Index not found")
+        if (stat.st_ino, stat.st_mtime_ns) != self.meta_stat:
+            self._reload((stat.st_ino, stat.st_mtime_ns))
 
-def construct_prompt(messages, system, tools):
-    # Simplified prompt construction
-    prompt = f"{system}\n"
-    for message in messages:
-        prompt += f"{message['role']}: {message['content']}\n"
-    if tools and len(tools) > 0:
-        prompt += f"Tools available: {', '.join(tools)}"
-    return prompt
+        journal_path = self._path(self.meta["journal"])
+        if os.path.exists(journal_path) and os.path.getsize(journal_path) > self.offset:
+            with open(journal_path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+            # Ignore a torn trailing line
+            end = data.rfind(b'\n') + 1
+            for line in data[:end].splitlines():
+                self._apply(json_loads(line))
+            self.offset += end
 
-# Conversation history storage
-conversation_histories = {}
+        count = len(self.row_ids)
+        if count and (self.vectors is None or self.vectors.shape[0] != count):
+            start = 0 if self.vectors is None else self.vectors.shape[0]
+            self.vectors = np.memmap(self._path(self.meta["vectors"]), dtype='<f4', mode='r',
+                                     shape=(count, self.meta["dimensions"]))
+            if self.centroids is not None:
+                self.assignments = np.memmap(self._path(self.meta["assignments"]), dtype='<i4', mode='r',
+                                             shape=(count,))
+                self._extend_lists(start, count)
 
-def save_conversation_history(conversation_id, messages):
-    """Store conversation history in memory"""
-    conversation_histories[conversation_id] = messages
-    # Trim history if it gets too large (limit to last 20 messages)
-    if len(conversation_histories[conversation_id]) > 20:
-        conversation_histories[conversation_id] = conversation_histories[conversation_id][-20:]
+    def _extend_lists(self, start, count):
+        """Add rows start..count to the inverted lists"""
+        assignments = np.asarray(self.assignments[start:count])
+        order = np.argsort(assignments, kind='stable')
+        bounds = np.searchsorted(assignments[order], np.arange(len(self.lists) + 1))
+        rows = (order + start).astype('<i4')
+        for number, members in enumerate(self.lists):
+            if bounds[number + 1] > bounds[number]:
+                members.frombytes(rows[bounds[number]:bounds[number + 1]].tobytes())
 
-def get_conversation_history(conversation_id):
-    """Retrieve conversation history"""
-    return conversation_histories.get(conversation_id, [])
-
-def process_ollama_request(messages, system, tools, model, temperature=0.7, max_tokens=1000, top_p=0.9):
-    """Process a request to the Ollama API"""
-    # Use the ollama client to get a response
-    response = ollama.chat(
-        model=model,
-        messages=[
-            {"role": "system", "content": system},
-            *[{"role": m["role"], "content": m["content"]} for m in messages]
-        ],
-        options={
-            "temperature": temperature,
-            "top_p": top_p,
-            "num_predict": max_tokens
-        }
-    )
+    def _apply(self, entry):
+        previous = self.ids.get(entry["id"])
+        if previous is not None:
+            self.live[previous] = 0
+            self.row_ids[previous] = None
+        self.metadata.pop(entry["id"], None)
+        self.texts.pop(entry["id"], None)
+        if entry["op"] == "delete":
+            self.ids.pop(entry["id"], None)
+            return
+        self.ids[entry["id"]] = entry["row"]
+        self.row_ids.append(entry["id"])
+        self.live.append(1)
+        if entry.get("metadata") is not None:
+            self.metadata[entry["id"]] = entry["metadata"]
+        if entry.get("text") is not None:
+            self.texts[entry["id"]] = entry["text"]
 
-    return response
+    def _prepare(self, vectors):
+        """Validate a (count, dimensions) float32 matrix, normalizing rows for cosine"""
+        dimensions = self.meta["dimensions"]
+        if vectors.shape[1] != dimensions:
+            raise ValueError(f"Index holds {dimensions}-dimensional vectors, got {vectors.shape[1]}")
+        if self.meta["metric"] == "cosine":
+            norms = np.linalg.norm(vectors, axis=1)
+            if not norms.all():
+                raise ValueError("Zero vectors have no cosine similarity")
+            vectors = vectors / norms[:, None]
+        return np.ascontiguousarray(vectors, dtype='<f4')
 
-def process_ollama_stream(messages, system, tools, model, temperature=0.7, max_tokens=1000, top_p=0.9):
-    """Stream a response from the Ollama API"""
-    for chunk in ollama.chat(
-        model=model,
-        messages=[
-            {"role": "system", "content": system},
-            *[{"role": m["role"], "content": m["content"]} for m in messages]
-        ],
-        options={
-            "temperature": temperature,
-            "top_p": top_p,
-            "num_predict": max_tokens
-        },
-        stream=True
-    ):
-        yield chunk
-
-def process_openai_request(messages, system, tools, model, temperature=0.7, max_tokens=1000, top_p=0.9):
-    """Process a request to the OpenAI API"""
-    if not OPENAI_API_KEY:
-        raise ValueError("OpenAI API key not configured")
+    def upsert(self, items):
+        """Insert or replace vectors; items are dicts with id, vector and optional metadata and text"""
+        with self.lock:
+            self._refresh()
+            matrix = np.stack([item["vector"] for item in items])
+            if self.meta["dimensions"] is None:
+                self.meta["dimensions"] = matrix.shape[1]
+                self._write_meta(self.meta)
+                self._refresh()
+            matrix = self._prepare(matrix)
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {OPENAI_API_KEY}"
-    }
+            count = len(self.row_ids)
+            vectors_path = self._path(self.meta["vectors"])
+            with open(vectors_path, 'ab') as f:
+                f.truncate(count * matrix.shape[1] * 4)
+                f.write(matrix.tobytes())
+            if self.centroids is not None:
+                assignments = nearest_centroids(matrix, self.centroids, self.centroid_norms).astype('<i4')
+                with open(self._path(self.meta["assignments"]), 'ab') as f:
+                    f.truncate(count * 4)
+                    f.write(assignments.tobytes())
+            # The journal is written last: rows only exist once their entry does
+            lines = [json_dumps({"op": "upsert", "id": item["id"], "row": count + number,
+                                 "metadata": item.get("metadata"), "text": item.get("text")})
+                     for number, item in enumerate(items)]
+            with open(self._path(self.meta["journal"]), 'ab') as f:
+                f.write(b"\n".join(lines) + b"\n")
+            self._refresh()
+        return len(items)
 
-    payload = {
-        "model": model,
-        "messages": [
-            {"role": "system", "content": system},
-            *[{"role": m["role"], "content": m["content"]} for m in messages]
-        ],
-        "temperature": temperature,
-        "max_tokens": max_tokens,
-        "top_p": top_p
-    }
+    def delete(self, ids):
+        """Remove IDs from the index; returns how many existed"""
+        with self.lock:
+            self._refresh()
+            present = [item_id for item_id in dict.fromkeys(ids) if item_id in self.ids]
+            if present:
+                with open(self._path(self.meta["journal"]), 'ab') as f:
+                    f.write(b"".join(json_dumps({"op": "delete", "id": item_id}) + b"\n" for item_id in present))
+                self._refresh()
+        return len(present)
 
-    if tools and len(tools) > 0:
-        # Format tools for OpenAI - simplistic implementation
-        payload["tools"] = [{"type": "function", "function": {"name": tool}} for tool in tools]
-    else:
-        payload["tools"] = []
+    def search(self, query, k=10, nprobe=None):
+        """Top-k (id, score) matches by cosine similarity or dot product, best first"""
+        start = time.perf_counter()
+        with self.lock:
+            self._refresh()
+            if self.meta["dimensions"] is None or not self.row_ids:
+                return []
+            query = self._prepare(query[None, :])[0]
+            vectors, row_ids = self.vectors, self.row_ids
+            live = np.frombuffer(self.live, dtype=np.bool_).copy()
+            candidates = None
+            if self.centroids is not None:
+                nprobe = min(nprobe or INDEX_NPROBE, len(self.lists))
+                if nprobe < len(self.lists):
+                    closeness = self.centroids @ query - self.centroid_norms / 2
+                    probes = np.argpartition(-closeness, nprobe - 1)[:nprobe]
+                    candidates = np.sort(np.concatenate(
+                        [np.frombuffer(self.lists[probe], dtype=np.int32) for probe in probes]))
 
-    response = requests.post("https://api.openai.com/v1/chat/completions",
-                           headers=headers,
-                           json=payload)
+        def top(scores, rows):
+            if len(scores) > k:
+                best = np.argpartition(-scores, k - 1)[:k]
+                return scores[best], rows[best]
+            return scores, rows
 
-    if response.status_code != 200:
-        raise Exception(f"OpenAI API error: {response.text}")
+        found = []
+        total = len(live) if candidates is None else len(candidates)
+        for offset in range(0, total, INDEX_SEARCH_BLOCK):
+            if candidates is None:
+                rows = np.arange(offset, min(offset + INDEX_SEARCH_BLOCK, total))
+                block = vectors[offset:offset + len(rows)]
+            else:
+                rows = candidates[offset:offset + INDEX_SEARCH_BLOCK]
+                block = vectors[rows]
+            scores = block @ query
+            scores[~live[rows]] = -np.inf
+            found.append(top(scores, rows))
 
-    return response.json()
+        mode = "exact" if candidates is None else "ivf"
+        index_rows_scored.inc((os.path.basename(self.directory), mode), total)
+        index_queries.observe((os.path.basename(self.directory), mode), time.perf_counter() - start)
+        if not found:
+            return []
+        scores, rows = top(np.concatenate([item[0] for item in found]), np.concatenate([item[1] for item in found]))
+        order = np.argsort(-scores, kind='stable')
+        return [(row_ids[row], float(score)) for score, row in zip(scores[order], rows[order])
+                if np.isfinite(score) and row_ids[row] is not None]
 
-def process_openai_stream(messages, system, tools, model, temperature=0.7, max_tokens=1000, top_p=0.9):
-    """Stream a response from the OpenAI API"""
-    if not OPENAI_API_KEY:
-        raise ValueError("OpenAI API key not configured")
+    def describe(self, item_id):
+        """Metadata and text stored with an ID"""
+        return self.metadata.get(item_id), self.texts.get(item_id)
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {OPENAI_API_KEY}"
-    }
+    def train(self, lists, iterations=10, seed=0):
+        """Cluster the live rows into k-means lists and assign every row, enabling IVF queries"""
+        rng = np.random.default_rng(seed)
+        with self.lock:
+            self._refresh()
+            if self.vectors is None:
+                raise ValueError("Index is empty")
+            vectors, generation = self.vectors, self.meta["generation"]
+            rows = np.flatnonzero(np.frombuffer(self.live, dtype=np.bool_))
+        if len(rows) < lists:
+            raise ValueError(f"Training {lists} lists needs at least as many vectors ({len(rows)} stored)")
 
-    payload = {
-        "model": model,
-        "messages": [
-            {"role": "system", "content": system},
-            *[{"role": m["role"], "content": m["content"]} for m in messages]
-        ],
-        "temperature": temperature,
-        "max_tokens": max_tokens,
-        "top_p": top_p,
-        "stream": True
-    }
+        # Cluster a sample and assign the rows present now without holding the lock
+        sample = np.sort(rng.choice(rows, min(len(rows), max(INDEX_TRAIN_SAMPLE, lists)), replace=False))
+        centroids = kmeans(np.asarray(vectors[sample], dtype=np.float32), lists, iterations, rng)
+        norms = (centroids ** 2).sum(axis=1)
+        assignments = [nearest_centroids(vectors[start:start + INDEX_SEARCH_BLOCK], centroids, norms)
+                       for start in range(0, len(vectors), INDEX_SEARCH_BLOCK)]
 
-    if tools and len(tools) > 0:
-        payload["tools"] = [{"type": "function", "function": {"name": tool}} for tool in tools]
+        with self.lock:
+            self._refresh()
+            if self.meta["generation"] != generation:
+                # Compacted meanwhile: row numbers changed
+                assignments = []
+            trained = sum(len(block) for block in assignments)
+            if self.vectors.shape[0] > trained:
+                assignments.append(nearest_centroids(self.vectors[trained:], centroids, norms))
+            generation = self.meta["generation"] + 1
+            meta = dict(self.meta, generation=generation, lists=lists,
+                        centroids=f"centroids.{generation}.f32", assignments=f"lists.{generation}.i32")
+            centroids.astype('<f4').tofile(self._path(meta["centroids"]))
+            np.concatenate(assignments).astype('<i4').tofile(self._path(meta["assignments"]))
+            self._replace_meta(meta)
 
-    response = requests.post("https://api.openai.com/v1/chat/completions",
-                           headers=headers,
-                           json=payload,
-                           stream=True)
+    def compact(self):
+        """Rewrite the files without replaced or deleted rows; returns the rows reclaimed"""
+        with self.lock:
+            self._refresh()
+            rows = np.flatnonzero(np.frombuffer(self.live, dtype=np.bool_))
+            reclaimed = len(self.row_ids) - len(rows)
+            if not reclaimed:
+                return 0
+            generation = self.meta["generation"] + 1
+            meta = dict(self.meta, generation=generation, vectors=f"vectors.{generation}.f32",
+                        journal=f"journal.{generation}.jsonl")
+            with open(self._path(meta["vectors"]), 'wb') as f:
+                for start in range(0, len(rows), INDEX_SEARCH_BLOCK):
+                    f.write(np.asarray(self.vectors[rows[start:start + INDEX_SEARCH_BLOCK]]).tobytes())
+            with open(self._path(meta["journal"]), 'wb') as f:
+                for number, row in enumerate(rows):
+                    item_id = self.row_ids[row]
+                    f.write(json_dumps({"op": "upsert", "id": item_id, "row": number,
+                                        "metadata": self.metadata.get(item_id),
+                                        "text": self.texts.get(item_id)}) + b"\n")
+            if self.centroids is not None:
+                meta["assignments"] = f"lists.{generation}.i32"
+                np.asarray(self.assignments)[rows].astype('<i4').tofile(self._path(meta["assignments"]))
+            self._replace_meta(meta)
+        return reclaimed
 
-    if response.status_code != 200:
-        raise Exception(f"OpenAI API error: {response.status_code}")
+    def _replace_meta(self, meta):
+        """Make meta current and remove the files it no longer names (lock held)"""
+        self._write_meta(meta)
+        current = {meta.get(name) for name in ("vectors", "journal", "centroids", "assignments")}
+        for name in os.listdir(self.directory):
+            if name.endswith(('.f32', '.jsonl', '.i32')) and name not in current:
+                os.remove(self._path(name))
+        self._refresh()
 
-    for line in response.iter_lines():
-        if line:
-            line = line.decode('utf-8')
-            if line.startswith('data: '):
-                if line.startswith('data: [DONE]'):
-                    break
-                data = json.loads(line[6:])
-                yield data
-
-def process_anthropic_request(messages, system, tools, model, temperature=0.7, max_tokens=1000, top_p=0.9):
-    """Process a request to the Anthropic API"""
-    if not ANTHROPIC_API_KEY:
-        raise ValueError("Anthropic API key not configured")
-
-    headers = {
-        "Content-Type": "application/json",
-        "x-api-key": ANTHROPIC_API_KEY,
-        "anthropic-version": "2023-06-01"
-    }
+    def stats(self):
+        with self.lock:
+            self._refresh()
+            return {"name": os.path.basename(self.directory), "metric": self.meta["metric"],
+                    "dimensions": self.meta["dimensions"], "provider": self.meta["provider"],
+                    "model": self.meta["model"], "size": len(self.ids), "rows": len(self.row_ids),
+                    "lists": self.meta["lists"], "generation": self.meta["generation"]}
 
-    # Convert messages to Anthropic format
-    anthropic_messages = []
-    for message in messages:
-        role = "assistant" if message["role"] == "assistant" else "user"
-        anthropic_messages.append({"role": role, "content": message["content"]})
-
-    payload = {
-        "model": model,
-        "messages": anthropic_messages,
-        "system": system,
-        "max_tokens": max_tokens,
-        "temperature": temperature,
-        "top_p": top_p
-    }
+vector_indexes = {}
+vector_indexes_lock = threading.Lock()
 
-    response = requests.post("https://api.anthropic.com/v1/messages",
-                           headers=headers,
-                           json=payload)
+def index_path(name):
+    if not re.fullmatch(r'[A-Za-z0-9_-][A-Za-z0-9_.-]{0,63}', name):
+        raise ValueError("Invalid index name")
+    return os.path.join(INDEX_DIR, name)
 
-    if response.status_code != 200:
-        raise Exception(f"Anthropic API error: {response.text}")
+def get_vector_index(name):
+    """Open a named index; raises LookupError when it does not exist"""
+    directory = index_path(name)
+    with vector_indexes_lock:
+        if not os.path.exists(os.path.join(directory, 'meta.json')):
+            vector_indexes.pop(name, None)
+            raise LookupError("Index not found")
+        index = vector_indexes.get(name)
+        if index is None:
+            index = vector_indexes[name] = VectorIndex(directory)
+    return index
 
-    return response.json()
+def index_route(handler):
+    """Map index errors to responses: bad input is a 400, a missing index a 404"""
+    @wraps(handler)
+    def wrapper(*args, **kwargs):
+        try:
+            return handler(*args, **kwargs)
+        except LookupError as e:
+            return jsonify({"error": str(e)}), 404
+        except (ValueError, TypeError) as e:
+            return jsonify({"error": str(e)}), 400
+        except UpstreamError as e:
+            return jsonify({"error": str(e)}), e.status_code
+        except Exception as e:
+            logger.error("Vector index error: %s", e)
+            return jsonify({"error": str(e)}), 500
+    return wrapper
 
-def process_anthropic_stream(messages, system, tools, model, temperature=0.7, max_tokens=1000, top_p=0.9):
-    """Stream a response from the Anthropic API"""
-    if not ANTHROPIC_API_KEY:
-        raise ValueError("Anthropic API key not configured")
+def index_embedding_source(index, data):
+    """Provider and model used to embed texts for an index"""
+    meta = index.stats()
+    provider = data.get('provider') or meta["provider"] or 'openai'
+    if provider not in embedding_backends:
+        raise ValueError(f"Provider '{provider}' cannot embed texts")
+    return provider, data.get('model') or meta["model"] or embedding_backends[provider][1]
 
-    headers = {
-        "Content-Type": "application/json",
-        "x-api-key": ANTHROPIC_API_KEY,
-        "anthropic-version": "2023-06-01"
-    }
+@app.route('/api/v1/index', methods=['GET'])
+@index_route
+def list_vector_indexes():
+    """List the vector indexes"""
+    names = sorted(name for name in os.listdir(INDEX_DIR)) if os.path.isdir(INDEX_DIR) else []
+    return jsonify({"indexes": [get_vector_index(name).stats() for name in names
+                                if os.path.exists(os.path.join(INDEX_DIR, name, 'meta.json'))]})
 
-    # Convert messages to Anthropic format
-    anthropic_messages = []
-    for message in messages:
-        role = "assistant" if message["role"] == "assistant" else "user"
-        anthropic_messages.append({"role": role, "content": message["content"]})
-
-    payload = {
-        "model": model,
-        "messages": anthropic_messages,
-        "system": system,
-        "max_tokens": max_tokens,
-        "temperature": temperature,
-        "top_p": top_p,
-        "stream": True
-    }
+@app.route('/api/v1/index/<name>', methods=['PUT'])
+@index_route
+def create_vector_index(name):
+    """Create a vector index"""
+    data = request.get_json(silent=True) or {}
+    metric = data.get('metric', 'cosine')
+    if metric not in INDEX_METRICS:
+        raise ValueError(f"'metric' must be one of {', '.join(INDEX_METRICS)}")
+    dimensions = data.get('dimensions')
+    if dimensions is not None and (not isinstance(dimensions, int) or dimensions <= 0):
+        raise ValueError("'dimensions' must be a positive integer")
+    directory = index_path(name)
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    with vector_indexes_lock:
+        try:
+            index = VectorIndex.create(directory, metric, dimensions, data.get('provider'), data.get('model'))
+        except FileExistsError:
+            return jsonify({"error": "Index already exists"}), 409
+        vector_indexes[name] = index
+    return jsonify(index.stats()), 201
 
-    response = requests.post("https://api.anthropic.com/v1/messages",
-                           headers=headers,
-                           json=payload,
-                           stream=True)
+@app.route('/api/v1/index/<name>', methods=['GET'])
+@index_route
+def get_vector_index_stats(name):
+    """Describe a vector index"""
+    return jsonify(get_vector_index(name).stats())
 
-    if response.status_code != 200:
-        raise Exception(f"Anthropic API error: {response.status_code}")
+@app.route('/api/v1/index/<name>', methods=['DELETE'])
+@index_route
+def drop_vector_index(name):
+    """Delete a vector index and its files"""
+    index = get_vector_index(name)
+    with vector_indexes_lock, index.lock:
+        shutil.rmtree(index.directory)
+        vector_indexes.pop(name, None)
+    return jsonify({"status": "deleted", "index": name})
 
-    for line in response.iter_lines():
-        if line:
-            line = line.decode('utf-8')
-            if line.startswith('event: content_block_delta'):
-                # Skip to the actual data
-                continue
-            if line.startswith('data: '):
-                if line.startswith('data: [DONE]'):
-                    break
-                data = json.loads(line[6:])
-                yield data
+@app.route('/api/v1/index/<name>/upsert', methods=['POST'])
+@index_route
+def upsert_vectors(name):
+    """Insert or replace vectors by ID; items without a vector have their text embedded"""
+    index = get_vector_index(name)
+    data = request.get_json(silent=True) or {}
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        raise ValueError("'items' must be a non-empty list")
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get('id'), str):
+            raise ValueError("Each item needs a string 'id'")
+        if item.get('vector') is None and not isinstance(item.get('text'), str):
+            raise ValueError(f"Item '{item['id']}' needs a 'vector' or a 'text'")
 
-def process_mistral_request(messages, system, tools, model, temperature=0.7, max_tokens=1000, top_p=0.9):
-    """Process a request to the Mistral API"""
-    if not MISTRAL_API_KEY:
-        raise ValueError("Mistral API key not configured")
+    pending = [item for item in items if item.get('vector') is None]
+    cached = 0
+    if pending:
+        provider, model = index_embedding_source(index, data)
+        vectors, cached = embed_texts([item['text'] for item in pending], provider, model)
+        for item, vector in zip(pending, vectors):
+            item['vector'] = vector
+    records = [{"id": item['id'], "vector": decode_vector(item['vector']),
+                "metadata": item.get('metadata'), "text": item.get('text') if data.get('store_text', True) else None}
+               for item in items]
+    return jsonify({"index": name, "upserted": index.upsert(records), "embedded": len(pending), "cached": cached})
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {MISTRAL_API_KEY}"
-    }
+@app.route('/api/v1/index/<name>/delete', methods=['POST'])
+@index_route
+def delete_vectors(name):
+    """Remove vectors by ID"""
+    ids = (request.get_json(silent=True) or {}).get('ids')
+    if not isinstance(ids, list) or not all(isinstance(item_id, str) for item_id in ids):
+        raise ValueError("'ids' must be a list of strings")
+    return jsonify({"index": name, "deleted": get_vector_index(name).delete(ids)})
 
-    payload = {
-        "model": model,
-        "messages": [
-            {"role": "system", "content": system},
-            *[{"role": m["role"], "content": m["content"]} for m in messages]
-        ],
-        "temperature": temperature,
-        "max_tokens": max_tokens,
-        "top_p": top_p
-    }
+@app.route('/api/v1/index/<name>/query', methods=['POST'])
+@index_route
+def query_vectors(name):
+    """Top-k nearest stored vectors to a query vector or text"""
+    index = get_vector_index(name)
+    data = request.get_json(silent=True) or {}
+    k = data.get('k', 10)
+    if not isinstance(k, int) or not 0 < k <= INDEX_MAX_K:
+        raise ValueError(f"'k' must be an integer between 1 and {INDEX_MAX_K}")
+    nprobe = data.get('nprobe')
+    if nprobe is not None and (not isinstance(nprobe, int) or nprobe <= 0):
+        raise ValueError("'nprobe' must be a positive integer")
+    if data.get('vector') is not None:
+        query = decode_vector(data['vector'])
+    elif isinstance(data.get('text'), str):
+        provider, model = index_embedding_source(index, data)
+        query = embed_texts([data['text']], provider, model)[0][0]
+    else:
+        raise ValueError("Query needs a 'vector' or a 'text'")
 
-    response = requests.post("https://api.mistral.ai/v1/chat/completions",
-                           headers=headers,
-                           json=payload)
+    matches = []
+    for item_id, score in index.search(query, k, nprobe):
+        metadata, text = index.describe(item_id)
+        match = {"id": item_id, "score": score}
+        if metadata is not None:
+            match["metadata"] = metadata
+        if text is not None:
+            match["text"] = text
+        matches.append(match)
+    return jsonify({"index": name, "matches": matches})
 
-    if response.status_code != 200:
-        raise Exception(f"Mistral API error: {response.text}")
+@app.route('/api/v1/index/<name>/train', methods=['POST'])
+@index_route
+def train_vector_index(name):
+    """Partition the index into k-means lists for sub-linear (IVF) queries"""
+    index = get_vector_index(name)
+    data = request.get_json(silent=True) or {}
+    lists = data.get('lists')
+    if lists is None:
+        lists = max(1, int(math.sqrt(index.stats()["size"])))
+    iterations = data.get('iterations', 10)
+    if not isinstance(lists, int) or lists <= 0 or not isinstance(iterations, int) or iterations <= 0:
+        raise ValueError("'lists' and 'iterations' must be positive integers")
+    start = time.perf_counter()
+    index.train(lists, iterations)
+    return jsonify(dict(index.stats(), trained_in=round(time.perf_counter() - start, 3)))
 
-    return response.json()
+@app.route('/api/v1/index/<name>/compact', methods=['POST'])
+@index_route
+def compact_vector_index(name):
+    """Reclaim the space of replaced and deleted vectors"""
+    index = get_vector_index(name)
+    reclaimed = index.compact()
+    return jsonify(dict(index.stats(), reclaimed=reclaimed))
 
-def process_mistral_stream(messages, system, tools, model, temperature=0.7, max_tokens=1000, top_p=0.9):
-    """Stream a response from the Mistral API"""
-    if not MISTRAL_API_KEY:
-        raise ValueError("Mistral API key not configured")
+# Async serving mode (ASGI): /api/v1/chat runs as non-blocking coroutines,
+# every other route is served by the Flask app through a WSGI bridge.
+async_clients = {}
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {MISTRAL_API_KEY}"
-    }
+def get_async_client(provider):
+    """Return the shared keep-alive async HTTP client for a provider"""
+    client = async_clients.get(provider)
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=POOL_MAXSIZE,
+                max_keepalive_connections=POOL_MAXSIZE,
+                keepalive_expiry=POOL_KEEPALIVE
+            )
+        )
+        async_clients[provider] = client
+    return client
 
-    payload = {
-        "model": model,
-        "messages": [
-            {"role": "system", "content": system},
-            *[{"role": m["role"], "content": m["content"]} for m in messages]
-        ],
-        "temperature": temperature,
-        "max_tokens": max_tokens,
-        "top_p": top_p,
-        "stream": True
-    }
+class AsyncSingleFlight:
+    """Share one upstream call between identical concurrent requests (asyncio-based)"""
 
-    response = requests.post("https://api.mistral.ai/v1/chat/completions",
-                           headers=headers,
-                           json=payload,
-                           stream=True)
+    def __init__(self):
+        self.calls = {}
+        self.streams = {}
 
-    if response.status_code != 200:
-        raise Exception(f"Mistral API error: {response.status_code}")
+    async def do(self, key, factory):
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self.calls[key] = task
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+            coalescing_stats["requests"]["upstream"] += 1
+        else:
+            coalescing_stats["requests"]["coalesced"] += 1
+        # Shield so one caller going away does not cancel the shared call
+        return await asyncio.shield(task)
 
-    for line in response.iter_lines():
-        if line:
-            line = line.decode('utf-8')
-            if line.startswith('data: '):
-                if line.startswith('data: [DONE]'):
+    async def stream(self, key, factory, admit=None):
+        """Async twin of SingleFlight.stream: the leader is admitted before this returns"""
+        chunks = self._subscribe(key, factory, admit)
+        await chunks.__anext__()
+        return chunks
+
+    async def _subscribe(self, key, factory, admit):
+        broadcast = self.streams.get(key)
+        leader = broadcast is None
+        if leader:
+            broadcast = StreamBroadcast(asyncio.Condition())
+            self.streams[key] = broadcast
+            coalescing_stats["streams"]["upstream"] += 1
+        else:
+            coalescing_stats["streams"]["coalesced"] += 1
+        broadcast.subscribers += 1
+
+        try:
+            if leader:
+                try:
+                    admission = await admit() if admit is not None else Admission()
+                except BaseException as e:
+                    # Requests that joined while this one queued must not see a clean end
+                    await self._finish(key, broadcast, e if isinstance(e, Exception)
+                                       else ConnectionError("Upstream stream cancelled"))
+                    raise
+                broadcast.task = asyncio.ensure_future(self._pump(key, broadcast, factory, admission))
+            # stream() stops here: from now on the finally below unsubscribes
+            yield None
+            position = 0
+            while True:
+                async with broadcast.condition:
+                    await broadcast.condition.wait_for(
+                        lambda: position < len(broadcast.chunks) or broadcast.done)
+                    pending = broadcast.chunks[position:]
+                    position += len(pending)
+                    done = broadcast.done and position >= len(broadcast.chunks)
+                for chunk in pending:
+                    yield chunk
+                if done:
+                    if broadcast.error is not None:
+                        raise broadcast.error
+                    return
+        finally:
+            broadcast.subscribers -= 1
+            if broadcast.subscribers == 0 and not broadcast.done and broadcast.task is not None:
+                # Everyone left: tear the upstream call down now rather than at its next chunk
+                broadcast.task.cancel()
+
+    async def _pump(self, key, broadcast, factory, admission):
+        upstream = factory()
+        error = None
+        try:
+            async for chunk in upstream:
+                async with broadcast.condition:
+                    broadcast.chunks.append(chunk)
+                    broadcast.condition.notify_all()
+                if broadcast.subscribers == 0:
                     break
-                data = json.loads(line[6:])
-                yield data
+        except asyncio.CancelledError:
+            # A request joining just as the last subscriber left must not see a clean end
+            error = ConnectionError("Upstream stream cancelled")
+            raise
+        except Exception as e:
+            error = e
+        finally:
+            await self._finish(key, broadcast, error)
+            await upstream.aclose()
+            await admission.arelease()
 
-@app.route('/health', methods=['GET'])
-def health_check():
-    """Simple health check endpoint"""
-    return jsonify({
-        "status": "ok",
-        "version": "1.0",
-        "providers": {
-            "ollama": OLLAMA_API_KEY is not None,
-            "openai": OPENAI_API_KEY is not None,
-            "anthropic": ANTHROPIC_API_KEY is not None,
-            "mistral": MISTRAL_API_KEY is not None
-        }
-    })
+    async def _finish(self, key, broadcast, error=None):
+        if self.streams.get(key) is broadcast:
+            del self.streams[key]
+        async with broadcast.condition:
+            broadcast.error = error
+            broadcast.done = True
+            broadcast.condition.notify_all()
 
-@app.route('/api/v1/models', methods=['GET'])
-def list_models():
-    """List available models for each provider"""
-    provider = request.args.get('provider')
-    models = {}
+async_chat_flight = AsyncSingleFlight()
+
+async def acoalesced_request(key, factory, admit=None):
+    """Async twin of coalesced_request"""
+    async def call():
+        admission = await admit() if admit is not None else Admission()
+        try:
+            return await factory()
+        finally:
+            await admission.arelease()
 
+    return await async_chat_flight.do(key, call) if REQUEST_COALESCING and key is not None else await call()
+
+async def acoalesced_stream(key, factory, admit=None):
+    """Async twin of coalesced_stream"""
+    if REQUEST_COALESCING and key is not None:
+        return await async_chat_flight.stream(key, factory, admit), Admission()
+    admission = await admit() if admit is not None else Admission()
+    return factory(), admission
+
+async def ahedged_call(candidates, call, hedge_after, discard=None):
+    """Async twin of hedged_call; losing attempts are cancelled outright"""
+    remaining = deque(candidates)
+    running = {}
+    last_error = None
+
+    async def attempt(provider, model):
+        try:
+            return await call(provider, model)
+        finally:
+            circuit_breaker(provider).release_trial()
+
+    def launch(reason):
+        while remaining:
+            provider, model = remaining.popleft()
+            if circuit_breaker(provider).allow():
+                running[asyncio.ensure_future(attempt(provider, model))] = (provider, model, reason)
+                return True
+            hedge_attempts.inc((provider, model, reason, "skipped"))
+        return False
+
+    launch("primary")
     try:
-        # Ollama models
-        if not provider or provider == 'ollama':
-            try:
-                ollama_models = ollama.list()
-                models['ollama'] = [model['name'] for model in ollama_models.get('models', [])]
-            except Exception as e:
-                logger.warning(f"Error fetching Ollama models: {e}")
-                models['ollama'] = []
+        while running:
+            done, _ = await asyncio.wait(running, timeout=hedge_after if remaining else None,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                launch("hedge")
+                continue
+            for task in done:
+                provider, model, reason = running.pop(task)
+                if task.exception() is None:
+                    hedge_attempts.inc((provider, model, reason, "won"))
+                    return (provider, model), task.result()
+                last_error = task.exception()
+                hedge_attempts.inc((provider, model, reason, "failed"))
+                logger.warning("Routed attempt to %s/%s failed: %s", provider, model, last_error)
+                launch("failover")
+    finally:
+        for loser, (provider, model, reason) in running.items():
+            hedge_attempts.inc((provider, model, reason, "cancelled"))
+            # A task cancelled before its first step never reaches attempt's finally
+            circuit_breaker(provider).release_trial()
+            if not loser.cancel() and discard is not None:
+                loser.add_done_callback(lambda t: t.cancelled() or t.exception() is not None or discard(t.result()))
 
-        # OpenAI models
-        if (not provider or provider == 'openai') and OPENAI_API_KEY:
-            try:
-                headers = {
-                    "Authorization": f"Bearer {OPENAI_API_KEY}"
-                }
-                response = requests.get("https://api.openai.com/v1/models", headers=headers)
-                if response.status_code == 200:
-                    openai_models = response.json()
-                    # Filter for only chat models
-                    chat_models = [model['id'] for model in openai_models.get('data', [])
-                                if model['id'].startswith(('gpt-', 'text-davinci-'))]
-                    models['openai'] = chat_models
-                else:
-                    models['openai'] = []
-            except Exception as e:
-                logger.warning(f"Error fetching OpenAI models: {e}")
-                models['openai'] = []
-
-        # Anthropic models (hardcoded since API doesn't provide a models endpoint)
-        if (not provider or provider == 'anthropic') and ANTHROPIC_API_KEY:
-            models['anthropic'] = [
-                "claude-3-opus-20240229",
-                "claude-3-sonnet-20240229",
-                "claude-3-haiku-20240307",
-                "claude-2.1",
-                "claude-2.0",
-                "claude-instant-1.2"
-            ]
-
-        # Mistral models (hardcoded as API doesn't have a public models endpoint)
-        if (not provider or provider == 'mistral') and MISTRAL_API_KEY:
-            models['mistral'] = [
-                "mistral-tiny",
-                "mistral-small",
-                "mistral-medium",
-                "mistral-large-latest"
-            ]
-
-        return jsonify({"models": models})
+    if last_error is not None:
+        raise last_error
+    retry_after = min(circuit_breaker(provider).retry_after() for provider, _ in candidates)
+    raise CircuitOpenError("All candidate providers are unavailable (circuit open)", retry_after)
 
-    except Exception as e:
-        logger.error(f"Error listing models: {e}")
-        return jsonify({"error": str(e)}), 500
+async def arouted_request(validated_data, messages, priority, cost):
+    async def attempt(provider, model):
+        admission = await aadmit(provider, model, priority, cost)
+        try:
+            return await atimed_request(provider, model, providers[provider].arequest(
+                messages, validated_data.system, validated_data.tools, model, validated_data.temperature,
+                validated_data.max_tokens, validated_data.top_p))
+        finally:
+            await admission.arelease()
 
-@app.route('/api/v1/embeddings', methods=['POST'])
-def generate_embeddings():
-    """Generate embeddings for text"""
+    candidates = route_candidates(validated_data.provider, validated_data.model, validated_data.fallbacks)
+    return await ahedged_call(candidates, attempt, hedge_delay(validated_data))
+
+async def arouted_stream(validated_data, messages, priority, cost):
+    async def start(provider, model):
+        admission = await aadmit(provider, model, priority, cost)
+        try:
+            chunks = atimed_stream(provider, model, providers[provider].astream(
+                messages, validated_data.system, validated_data.tools, model, validated_data.temperature,
+                validated_data.max_tokens, validated_data.top_p))
+            first = await anext(chunks, None)
+        except BaseException:
+            await asyncio.shield(admission.arelease())
+            raise
+        return first, chunks, admission
+
+    def discard(started):
+        _, chunks, admission = started
+        asyncio.ensure_future(admission.arelease())
+        asyncio.ensure_future(chunks.aclose())
+
+    candidates = route_candidates(validated_data.provider, validated_data.model, validated_data.fallbacks)
+    return await ahedged_call(candidates, start, hedge_delay(validated_data), discard)
+
+async def aresume_stream(first, chunks):
     try:
-        data = request.json
-        if not data or 'text' not in data:
-            return jsonify({"error": "Missing 'text' field"}), 400
+        if first is not None:
+            yield first
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        await chunks.aclose()
 
-        text = data.get('text')
-        provider = data.get('provider', 'openai')
-        model = data.get('model')
+async def asgi_chat(request):
+    """Async twin of chat() with the same ChatSchema contract"""
+    logger.info("Received request at /api/v1/chat (asgi)")
+    try:
+        # Validate input data straight from the body
+        try:
+            body = await request.body()
+            with span("parse"):
+                validated_data = ChatSchema.model_validate_json(body)
+        except ValidationError as e:
+            logger.error("Validation errors: %s", e.errors())
+            return JSONResponse({"error": "Invalid input data format", "details": e.errors()}, status_code=400)
 
-        if provider == 'openai':
-            if not OPENAI_API_KEY:
-                return jsonify({"error": "OpenAI API key not configured"}), 500
+        messages = validated_data.messages
+        provider = validated_data.provider
+        model = validated_data.model
+        stream = validated_data.stream
+        conversation_id = validated_data.conversation_id
+        request_deadline.set(parse_timeout(request.headers.get('X-Request-Timeout')))
+        deadline = apply_timeout(validated_data.timeout)
+        prefix_scope.set(prompt_cache_scope(validated_data))
 
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {OPENAI_API_KEY}"
-            }
+        logger.info("Processing request with provider: %s, model: %s, stream: %s", provider, model, stream)
+        annotate(provider=provider, model=model, stream=stream)
 
-            payload = {
-                "input": text,
-                "model": model or "text-embedding-ada-002"
-            }
+        use_history = bool(conversation_id) and validated_data.use_history
+        # The conversation store and response cache may be SQLite: keep their I/O off the event loop
+        with span("context"):
+            if use_history:
+                messages = await asyncio.to_thread(assemble_context, conversation_id, messages, model,
+                                                   validated_data.system, validated_data.max_tokens)
+            elif conversation_id:
+                await asyncio.to_thread(save_conversation_history, conversation_id, messages)
 
-            response = requests.post("https://api.openai.com/v1/embeddings",
-                                   headers=headers,
-                                   json=payload)
+        args = (messages, validated_data.system, validated_data.tools, model,
+                validated_data.temperature, validated_data.max_tokens, validated_data.top_p)
+        upstream = providers[provider]
+        routed = bool(validated_data.fallbacks)
+        if routed and any(fallback.get('provider') not in providers for fallback in validated_data.fallbacks):
+            return JSONResponse({"error": "Invalid fallback provider specified"}, status_code=400)
+        chat_requests.inc((provider, model, "true" if stream else "false"))
 
-            if response.status_code != 200:
-                return jsonify({"error": f"OpenAI API error: {response.text}"}), response.status_code
+        priority = request_priority(request.headers.get('X-Priority'))
+        cost = request_cost(messages, validated_data.system, validated_data.max_tokens)
 
-            return jsonify(response.json())
+        if stream:
+            headers = {}
+            if routed:
+                (provider, model), (first, chunks, admission) = await arouted_stream(validated_data, messages,
+                                                                                     priority, cost)
+                upstream = providers[provider]
+                source = aresume_stream(first, chunks)
+                headers = {'X-Provider': provider, 'X-Model': model}
+            else:
+                key = coalesce_key(provider, *args, True)
+                source, admission = await acoalesced_stream(
+                    key, lambda: atimed_stream(provider, model, upstream.astream(*args)),
+                    lambda: aadmit(provider, model, priority, cost))
 
-        elif provider == 'anthropic':
-            if not ANTHROPIC_API_KEY:
-                return jsonify({"error": "Anthropic API key not configured"}), 500
+            trace = request_trace.get()
 
-            headers = {
-                "Content-Type": "application/json",
-                "x-api-key": ANTHROPIC_API_KEY,
-                "anthropic-version": "2023-06-01"
-            }
-            payload = {
-                "model": model or "claude-2",
-                "prompt": text
-            }
+            async def generate():
+                parts = []
+                chunks = 0
+                started = time.perf_counter()
+                relay_start = None
+                try:
+                    async for chunk in source:
+                        if relay_start is None:
+                            relay_start = time.perf_counter_ns()
+                        check_deadline(deadline)
+                        if use_history:
+                            parts.append(upstream.chunk_text(chunk))
+                        record_prompt_usage(provider, model, upstream.chunk_usage(chunk), messages,
+                                            validated_data.system)
+                        chunks += 1
+                        chunk_logger.debug("Relaying chunk %s (%s bytes)", chunks, len(chunk))
+                        yield sse_event(chunk)
 
-            response = requests.post("https://api.anthropic.com/v1/complete",
-                                   headers=headers,
-                                   json=payload)
+                    if use_history:
+                        await asyncio.to_thread(record_reply, conversation_id, "".join(parts))
 
-            if response.status_code != 200:
-                return jsonify({"error": f"Anthropic API error: {response.text}"}), response.status_code
+                    # End of stream marker
+                    yield "data: [DONE]\n\n"
+
+                except Exception as e:
+                    logger.error("Streaming error: %s", e)
+                    yield sse_event(json_dumps({'error': str(e)}))
+                finally:
+                    # Closing the source tears down the upstream call
+                    await source.aclose()
+                    await admission.arelease()
+                    elapsed = time.perf_counter() - started
+                    extra = {"chunks": chunks, "duration_ms": round(elapsed * 1000, 2)}
+                    if trace is not None:
+                        if relay_start is not None:
+                            trace.add("relay", relay_start, chunks=chunks)
+                        extra["phases"] = trace.phases()
+                    logger.info("Stream closed after %s chunks", chunks, extra=extra)
 
-            return jsonify(response.json())
+            return StreamingResponse(generate(), media_type='text/event-stream', headers=headers,
+                                     background=BackgroundTask(admission.release))
 
-        elif provider == 'ollama':
-            # Use Ollama for embeddings
-            response = ollama.embeddings(model="llama3.1:8b" or "nemotron-mini:latest", prompt="write ollama's python library as java")
-            return jsonify(response)
+        cache_control = request.headers.get('Cache-Control')
+        with span("cache"):
+            cache_key = response_cache_key(validated_data, cache_control)
+            cached = await asyncio.to_thread(cached_chat_response, cache_key, cache_control)
+        if cached is not None:
+            return JSONResponse(cached, headers={'X-Cache': cache_status(cache_key, True)})
 
+        headers = {'X-Cache': cache_status(cache_key, False)}
+        if routed:
+            (provider, model), response = await arouted_request(validated_data, messages, priority, cost)
+            upstream = providers[provider]
+            headers.update({'X-Provider': provider, 'X-Model': model})
         else:
-            return jsonify({"error": "Unsupported provider for embeddings"}), 400
+            key = coalesce_key(provider, *args, False)
+            response = await acoalesced_request(key, lambda: atimed_request(provider, model, upstream.arequest(*args)),
+                                                lambda: aadmit(provider, model, priority, cost))
+        if cache_key is not None:
+            await asyncio.to_thread(response_cache.set, cache_key, response)
+        if use_history:
+            await asyncio.to_thread(record_reply, conversation_id, upstream.response_text(response))
+        headers.update(prompt_usage_headers(
+            record_prompt_usage(provider, model, upstream.prompt_usage(response), messages, validated_data.system)))
+        with span("respond"):
+            return JSONResponse(response, headers=headers)
 
+    except DeadlineExceeded as e:
+        logger.warning("Request timed out: %s", e)
+        return JSONResponse({"error": str(e)}, status_code=504)
+    except AdmissionRejected as e:
+        if deadline_expired():
+            return JSONResponse({"error": "Request deadline exceeded"}, status_code=504)
+        logger.warning("Rejected request: %s", e)
+        return JSONResponse({"error": str(e), "retry_after": e.retry_after}, status_code=429,
+                            headers={'Retry-After': str(e.retry_after)})
+    except CircuitOpenError as e:
+        logger.warning("Rejected request: %s", e)
+        return JSONResponse({"error": str(e), "retry_after": e.retry_after}, status_code=503,
+                            headers={'Retry-After': str(e.retry_after)})
     except Exception as e:
-        logger.error(f"Error generating embeddings: {e}")
-        return jsonify({"error": str(e)}), 500
+        if deadline_expired():
+            logger.warning("Request timed out: %s", e)
+            return JSONResponse({"error": "Request deadline exceeded", "details": str(e)}, status_code=504)
+        logger.error("An error occurred: %s", e)
+        return JSONResponse({"error": "An internal error occurred", "details": str(e)}, status_code=500)
 
-@app.route('/api/v1/conversations/<conversation_id>', methods=['GET'])
-def get_conversation(conversation_id):
-    """Retrieve conversation history"""
-    try:
-        history = get_conversation_history(conversation_id)
-        return jsonify({"conversation_id": conversation_id, "messages": history})
-    except Exception as e:
-        logger.error(f"Error retrieving conversation: {e}")
-        return jsonify({"error": str(e)}), 500
+def asgi_request_context(endpoint):
+    """ASGI counterpart of the Flask request hooks: request ID, X-Request-ID header and access log"""
+    async def handle(request):
+        request_id.set(request.headers.get('X-Request-ID') or uuid.uuid4().hex)
+        trace = start_trace(request.method, request.url.path, request.headers.get('traceparent'))
+        request_trace.set(trace)
+        start = time.perf_counter()
+        response = await endpoint(request)
+        response.headers['X-Request-ID'] = request_id.get()
+        log_access(request.method, request.url.path, response.status_code, time.perf_counter() - start,
+                   trace.phases() if trace is not None else None)
+        if trace is not None:
+            streamed = isinstance(response, StreamingResponse)
+            trace_response(trace, response.headers, response.status_code, streamed)
+            if streamed:
+                # Runs once the body has been sent
+                finish = BackgroundTask(trace.finish, response.status_code)
+                response.background = BackgroundTasks([task for task in (response.background, finish) if task])
+        return response
+    return handle
 
-@app.route('/api/v1/conversations/<conversation_id>', methods=['DELETE'])
-def delete_conversation(conversation_id):
-    """Delete conversation history"""
-    try:
-        if conversation_id in conversation_histories:
-            del conversation_histories[conversation_id]
-            return jsonify({"status": "deleted", "conversation_id": conversation_id})
-        else:
-            return jsonify({"error": "Conversation not found"}), 404
-    except Exception as e:
-        logger.error(f"Error deleting conversation: {e}")
-        return jsonify({"error": str(e)}), 500
+async def close_async_clients():
+    """Release pooled async connections on shutdown"""
+    for client in list(async_clients.values()):
+        await client.aclose()
+    async_clients.clear()
+    for host in ollama_pool.hosts:
+        if host.ahttp is not None:
+            await host.ahttp.aclose()
+            host.ahttp = None
+
+def create_asgi_app():
+    """Build the ASGI application exposing the same routes as the Flask app"""
+    if Starlette is None:
+        raise RuntimeError("Async serving mode requires starlette (pip install starlette uvicorn a2wsgi)")
+    if WSGIMiddleware.__module__.startswith('starlette'):
+        logger.warning("a2wsgi is not installed; bridging WSGI routes through Starlette's deprecated WSGIMiddleware")
+
+    @asynccontextmanager
+    async def lifespan(_app):
+        yield
+        await close_async_clients()
+
+    # Routes mounted from Flask are compressed by compress_response; native ones need the middleware
+    compression = [Middleware(GZipMiddleware, minimum_size=COMPRESS_MIN_SIZE,
+                              compresslevel=COMPRESS_LEVEL)] if COMPRESS_LEVEL > 0 else []
+
+    return Starlette(
+        routes=[
+            Route('/api/v1/chat', asgi_request_context(asgi_chat), methods=['POST'], middleware=compression),
+            Mount('/', app=WSGIMiddleware(app))
+        ],
+        lifespan=lifespan
+    )
+
+def serve(sock, host, port, ssl_context, server_mode):
+    """Serve the app on an already listening socket (one worker process)"""
+    if server_mode == 'asgi':
+        if uvicorn is None:
+            raise RuntimeError("SERVER_MODE=asgi requires uvicorn (pip install uvicorn)")
+        config = uvicorn.Config(
+            create_asgi_app(),
+            log_config=None,  # uvicorn's loggers propagate to the queued root handler
+            ssl_certfile=ssl_context[0] if ssl_context else None,
+            ssl_keyfile=ssl_context[1] if ssl_context else None
+        )
+        uvicorn.Server(config).run(sockets=[sock])
+    else:
+        make_server(host, port, app, threaded=True, ssl_context=ssl_context, fd=sock.fileno()).serve_forever()
+
+def run_workers(count, host, port, ssl_context, server_mode):
+    """Pre-fork supervisor: bind once, fork workers that accept on the shared socket, replace any that die"""
+    global shared_limits
+    if not hasattr(os, 'fork') or fcntl is None:
+        raise RuntimeError("WORKERS > 1 requires a Unix host")
+    # Must exist before fork() so every worker maps the same table
+    shared_limits = SharedLimiterTable(os.path.join(STATE_DIR, 'limiters.shm'), count)
+    # Saved metrics of a previous run are stale
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    sock = socket.create_server((host, port), backlog=2048)
+    children = {}
+    stopping = False
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            global worker_index
+            worker_index = index
+            # Workers write their own files: rotating one file from several processes loses records
+            if LOG_FILE:
+                root, ext = os.path.splitext(LOG_FILE)
+                start_logging(f"{root}.{index}{ext}")
+            else:
+                start_logging(None)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            start_metrics_flusher()
+            if OLLAMA_SCHEDULER and index == 0:
+                # One worker warms models for all of them
+                model_scheduler.start()
+            status = 0
+            try:
+                serve(sock, host, port, ssl_context, server_mode)
+            except KeyboardInterrupt:
+                pass
+            except Exception as e:
+                logger.error("Worker %s failed: %s", index, e)
+                status = 1
+            os._exit(status)
+        children[pid] = (index, time.monotonic())
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            with suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(count):
+        spawn(index)
+    logger.info("Started %s %s workers on %s:%s", count, server_mode, host, port)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index, started = children.pop(pid, (None, 0))
+        if index is None:
+            continue
+        # Slots the worker held would otherwise never be released
+        shared_limits.reset_worker(index)
+        if not stopping:
+            logger.warning("Worker %s (pid %s) exited with status %s, restarting", index, pid, status)
+            if time.monotonic() - started < 1:
+                time.sleep(1)
+            if not stopping:
+                spawn(index)
+    sock.close()
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        sys.exit(batch_cli(sys.argv[2:]))
+
     ssl_context = None
 
     # Check if SSL certificates exist
@@ -595,18 +5928,37 @@ if __name__ == '__main__':
 
     if cert_path and key_path and os.path.exists(cert_path) and os.path.exists(key_path):
         ssl_context = (cert_path, key_path)
-        logger.info(f"HTTPS enabled with certificates: {cert_path}, {key_path}")
+        logger.info("HTTPS enabled with certificates: %s, %s", cert_path, key_path)
     else:
         logger.warning("HTTPS certificates not found or not configured, running without HTTPS")
 
     host = os.getenv('HOST', '0.0.0.0')
     port = int(os.getenv('PORT', 5000))
 
-    logger.info(f"Starting server on {host}:{port} with HTTPS: {ssl_context is not None}")
+    server_mode = os.getenv('SERVER_MODE', 'wsgi').lower()
 
-    app.run(
-        debug=os.getenv('DEBUG', 'False').lower() in ('true', '1', 't'),
-        host=host,
-        port=port,
-        ssl_context=ssl_context
-    )
+    logger.info("Starting %s server on %s:%s with HTTPS: %s", server_mode, host, port, ssl_context is not None)
+
+    if OLLAMA_SCHEDULER and WORKERS <= 1:
+        model_scheduler.start()
+
+    if WORKERS > 1:
+        run_workers(WORKERS, host, port, ssl_context, server_mode)
+    elif server_mode == 'asgi':
+        if uvicorn is None:
+            raise RuntimeError("SERVER_MODE=asgi requires uvicorn (pip install uvicorn)")
+        uvicorn.run(
+            create_asgi_app(),
+            host=host,
+            port=port,
+            log_config=None,
+            ssl_certfile=ssl_context[0] if ssl_context else None,
+            ssl_keyfile=ssl_context[1] if ssl_context else None
+        )
+    else:
+        app.run(
+            debug=os.getenv('DEBUG', 'False').lower() in ('true', '1', 't'),
+            host=host,
+            port=port,
+            ssl_context=ssl_context
+        )